@@ -0,0 +1,427 @@
+"""Benchmark harness for the ``migrate-resources`` command
+
+This creates a dataset with synthetic, locally uploaded (CKAN filesystem
+storage) resources of configurable sizes, starts a stub Git LFS server which
+accepts uploads and writes them to a local directory, and then runs
+``MigrateResourcesCommand`` against it with one or more concurrency settings.
+
+For each run, it reports resources / second, MB / second and the time spent
+in each of the migration phases:
+
+* ``download_resource`` - fetching the resource from CKAN's storage
+* ``hashing`` - calculating the sha256 of the local file
+* ``upload_resource`` - uploading the file to the LFS server (excl. hashing)
+* ``update_storage_props`` - updating the resource in the DB
+
+Phase times are summed across all migrator threads, so with a concurrency
+higher than 1 they will add up to more than the wall clock time.
+
+**WARNING**: the migrator migrates *all* unmigrated resources in the DB, not
+only the ones created by this script. Only run this against a throw-away
+database such as the one configured in ``test.ini``.
+
+Usage::
+
+    python benchmarks/migrate_resources.py -c test.ini \\
+        --sizes 1K:200,1M:50,100M:5,2G:1 --concurrency 1,2,4
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+from ckan.lib import uploader
+from ckan.lib.cli import load_config
+from ckan.model import Resource, Session, User
+from ckan.plugins import toolkit
+from giftless_client import LfsClient
+from mock import patch
+from six.moves import BaseHTTPServer, socketserver
+from sqlalchemy.orm.attributes import flag_modified
+
+from ckanext.blob_storage import cli, helpers
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+DEFAULT_SIZES = '1K:200,64K:100,1M:50,16M:10,256M:2'
+
+PHASES = ('download_resource', 'hashing', 'upload_resource', 'update_storage_props')
+
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+
+def _log():
+    return logging.getLogger(__name__)
+
+
+def parse_size(size):
+    # type: (str) -> int
+    """Parse a human readable size such as ``16M`` into bytes
+    """
+    size = size.strip().upper().rstrip('B')
+    unit = size[-1] if size[-1] in SIZE_UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_size_distribution(spec):
+    # type: (str) -> List[int]
+    """Parse a ``size:count,size:count`` size distribution spec into a list of file sizes
+    """
+    sizes = []
+    for item in spec.split(','):
+        size, _, count = item.partition(':')
+        sizes.extend([parse_size(size)] * int(count or 1))
+    return sizes
+
+
+class StubLfsServer(object):
+    """A minimal Git LFS server accepting ``basic`` transfer uploads and saving them to a local directory
+
+    This is not a complete implementation of the LFS protocol; It does just
+    enough to let ``giftless_client`` upload objects, with the cost of
+    receiving and writing the data to disk being similar to a real server.
+    """
+
+    def __init__(self, storage_dir, host='127.0.0.1', port=0):
+        self.storage_dir = storage_dir
+        self._server = _ThreadingHTTPServer((host, port), _LfsRequestHandler)
+        self._server.lfs = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[0:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def object_path(self, prefix, oid):
+        return os.path.join(self.storage_dir, prefix, oid[0:2], oid)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def clear(self):
+        shutil.rmtree(self.storage_dir, ignore_errors=True)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _LfsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        prefix, _, endpoint = self.path.strip('/').rpartition('/objects/')
+        if endpoint != 'batch':
+            return self._reply(404)
+
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length).decode('utf-8'))
+        lfs = self.server.lfs
+        objects = []
+        for obj in payload['objects']:
+            obj_spec = {'oid': obj['oid'], 'size': obj['size'], 'authenticated': True}
+            if not os.path.exists(lfs.object_path(prefix, obj['oid'])):
+                obj_spec['actions'] = {'upload': {
+                    'href': '{}/{}/objects/storage/{}'.format(lfs.url, prefix, obj['oid']),
+                    'expires_in': 900}}
+            objects.append(obj_spec)
+
+        self._reply(200, {'transfer': 'basic', 'objects': objects})
+
+    def do_PUT(self):
+        prefix, _, oid = self.path.strip('/').rpartition('/objects/storage/')
+        if not oid:
+            return self._reply(404)
+
+        path = self.server.lfs.object_path(prefix, oid)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        remaining = int(self.headers['Content-Length'])
+        with open(path, 'wb') as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, WRITE_CHUNK_SIZE))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+
+        self._reply(200)
+
+    def _reply(self, status, payload=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', LfsClient.LFS_MIME_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _log().debug(format, *args)
+
+
+class PhaseTimer(object):
+    """Thread safe accumulator of time spent in each migration phase
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = dict.fromkeys(PHASES, 0.0)
+
+    def add(self, phase, duration):
+        with self._lock:
+            self.totals[phase] += duration
+
+    @contextmanager
+    def measure(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start)
+
+    @contextmanager
+    def instrument(self):
+        """Patch the migrator's phase functions so that time spent in them is recorded
+        """
+        download_resource = cli.download_resource
+        update_storage_props = cli.update_storage_props
+        upload_resource = cli.MigrateResourcesCommand.upload_resource
+        get_object_attrs = LfsClient._get_object_attrs
+
+        @contextmanager
+        def timed_download_resource(*args, **kwargs):
+            start = time.time()
+            with download_resource(*args, **kwargs) as resource_file:
+                self.add('download_resource', time.time() - start)
+                yield resource_file
+
+        def timed_update_storage_props(*args, **kwargs):
+            with self.measure('update_storage_props'):
+                return update_storage_props(*args, **kwargs)
+
+        def timed_upload_resource(*args, **kwargs):
+            with self.measure('upload_resource'):
+                return upload_resource(*args, **kwargs)
+
+        def timed_get_object_attrs(*args, **kwargs):
+            with self.measure('hashing'):
+                return get_object_attrs(*args, **kwargs)
+
+        with patch.object(cli, 'download_resource', timed_download_resource), \
+                patch.object(cli, 'update_storage_props', timed_update_storage_props), \
+                patch.object(cli.MigrateResourcesCommand, 'upload_resource', timed_upload_resource), \
+                patch.object(LfsClient, '_get_object_attrs', staticmethod(timed_get_object_attrs)):
+            yield self
+
+    def report(self):
+        """Get phase totals, with hashing time excluded from upload time as it happens inside the upload
+        """
+        totals = dict(self.totals)
+        totals['upload_resource'] = max(0.0, totals['upload_resource'] - totals['hashing'])
+        return totals
+
+
+def create_fixture_resources(sizes):
+    # type: (List[int]) -> Dict[str, Any]
+    """Create a dataset with locally uploaded resources of the given sizes
+
+    Resources are created as links and then converted to un-migrated uploads
+    directly in the DB, as our validators will not allow creating uploads
+    without blob storage attributes through the action API.
+    """
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {'user': site_user['name'], 'ignore_auth': True}
+    resources = [{'name': 'benchmark-{}-{}'.format(i, size), 'url': 'benchmark-{}.bin'.format(i)}
+                 for i, size in enumerate(sizes)]
+    dataset = toolkit.get_action('package_create')(context, {
+        'name': 'blob-storage-benchmark-{}'.format(uuid.uuid4().hex[0:12]),
+        'resources': resources})
+
+    session = Session()
+    session.revisioning_disabled = True
+    for resource_dict, size in zip(dataset['resources'], sizes):
+        resource = session.query(Resource).filter(Resource.id == resource_dict['id']).one()
+        resource.url_type = 'upload'
+        resource.size = size
+        _write_synthetic_file(uploader.get_resource_uploader(resource_dict).get_path(resource.id), size)
+    session.commit()
+
+    _log().info("Created dataset %s with %d resources, %d bytes in total", dataset['name'], len(sizes), sum(sizes))
+    return dataset
+
+
+def _write_synthetic_file(path, size):
+    # type: (str, int) -> None
+    """Write a file of ``size`` bytes; Content is pseudo-random so that object IDs differ
+    """
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    block = os.urandom(min(size, WRITE_CHUNK_SIZE))
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            chunk = block[0:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def reset_fixture_resources(dataset):
+    # type: (Dict[str, Any]) -> None
+    """Mark all fixture resources as un-migrated again
+    """
+    session = Session()
+    session.revisioning_disabled = True
+    for resource_dict in dataset['resources']:
+        resource = session.query(Resource).filter(Resource.id == resource_dict['id']).one()
+        resource.extras.pop('lfs_prefix', None)
+        resource.extras.pop('sha256', None)
+        flag_modified(resource, 'extras')
+    session.commit()
+
+
+def purge_fixture_resources(dataset):
+    # type: (Dict[str, Any]) -> None
+    for resource_dict in dataset['resources']:
+        try:
+            os.unlink(uploader.get_resource_uploader(resource_dict).get_path(resource_dict['id']))
+        except OSError:
+            pass
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    toolkit.get_action('dataset_purge')({'user': site_user['name'], 'ignore_auth': True}, {'id': dataset['id']})
+
+
+def run_migration(concurrency, site_user):
+    # type: (int, Dict[str, Any]) -> float
+    """Run ``concurrency`` migrator threads in parallel until all resources are migrated
+
+    Return the wall clock time it took.
+    """
+    def worker():
+        with cli.app_context() as context:
+            command = cli.MigrateResourcesCommand('migrate-resources')
+            command._user = User.get(site_user['name'])
+            command._retry_delay = 0
+            context.g.user = site_user['name']
+            context.g.userobj = command._user
+            try:
+                command.migrate_all_resources()
+            finally:
+                Session.remove()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+
+def count_migrated(dataset):
+    # type: (Dict[str, Any]) -> int
+    ids = [r['id'] for r in dataset['resources']]
+    resources = Session.query(Resource).filter(Resource.id.in_(ids)).all()
+    migrated = len([r for r in resources if r.extras.get('sha256') and r.extras.get('lfs_prefix')])
+    Session.remove()
+    return migrated
+
+
+def benchmark(dataset, total_bytes, concurrency_levels, lfs_server):
+    # type: (Dict[str, Any], int, List[int], StubLfsServer) -> List[Dict[str, Any]]
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    results = []
+
+    for concurrency in concurrency_levels:
+        reset_fixture_resources(dataset)
+        lfs_server.clear()
+        timer = PhaseTimer()
+        with timer.instrument():
+            elapsed = run_migration(concurrency, site_user)
+
+        migrated = count_migrated(dataset)
+        results.append({
+            'concurrency': concurrency,
+            'resources': migrated,
+            'bytes': total_bytes,
+            'seconds': elapsed,
+            'resources_per_sec': migrated / elapsed if elapsed else 0.0,
+            'mb_per_sec': total_bytes / float(1024 ** 2) / elapsed if elapsed else 0.0,
+            'phases': timer.report(),
+        })
+
+    return results
+
+
+def print_report(results):
+    header = ['concurrency', 'resources', 'seconds', 'res/s', 'MB/s'] + list(PHASES)
+    print(' | '.join(header))
+    for r in results:
+        row = ['{:d}'.format(r['concurrency']),
+               '{:d}'.format(r['resources']),
+               '{:.2f}'.format(r['seconds']),
+               '{:.2f}'.format(r['resources_per_sec']),
+               '{:.2f}'.format(r['mb_per_sec'])]
+        row.extend('{:.2f}'.format(r['phases'][p]) for p in PHASES)
+        print(' | '.join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-c', '--config', default='test.ini', help='CKAN configuration file to use')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='Resource size distribution as size:count pairs, e.g. 1K:100,1M:10,2G:1')
+    parser.add_argument('--concurrency', default='1',
+                        help='Comma separated list of migrator thread counts to benchmark, e.g. 1,2,4')
+    parser.add_argument('--storage-dir', default=None, help='Directory to store uploaded objects in')
+    parser.add_argument('--json', dest='json_file', default=None, help='Also write results to a JSON file')
+    parser.add_argument('--keep', action='store_true', help='Do not purge the benchmark dataset when done')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    load_config(os.path.abspath(args.config))
+
+    storage_dir = args.storage_dir or tempfile.mkdtemp(prefix='ckan-blob-benchmark-')
+    lfs_server = StubLfsServer(storage_dir)
+    lfs_server.start()
+    toolkit.config[helpers.SERVER_URL_CONF_KEY] = lfs_server.url
+
+    sizes = parse_size_distribution(args.sizes)
+    concurrency_levels = [int(c) for c in args.concurrency.split(',')]
+    with cli.app_context():
+        dataset = create_fixture_resources(sizes)
+    try:
+        with cli.app_context():
+            results = benchmark(dataset, sum(sizes), concurrency_levels, lfs_server)
+    finally:
+        lfs_server.stop()
+        if not args.keep:
+            lfs_server.clear()
+            with cli.app_context():
+                purge_fixture_resources(dataset)
+
+    print_report(results)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump({'sizes': args.sizes, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,78 @@
 """Blob Storage API actions
 """
 import ast
+import base64
+import calendar
+import datetime
+import hashlib
+import json
 import logging
-from typing import Any, Dict, Optional
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
+from ckan import authz
 from ckan.plugins import toolkit
-from giftless_client import LfsClient
-from giftless_client.exc import LfsError
-from six import ensure_text
+from six import ensure_binary, ensure_text, string_types
 
-from . import helpers
+from . import cache, helpers, metrics, model, profiling, validators
+
+PARSE_MAX_SIZE_CONF_KEY = 'ckanext.blob_storage.parse_max_size'
+PARSE_MAX_DEPTH_CONF_KEY = 'ckanext.blob_storage.parse_max_depth'
+PARSE_CACHE_SIZE_CONF_KEY = 'ckanext.blob_storage.parse_cache_size'
+
+DEFAULT_PARSE_MAX_SIZE = 10 * 1024 * 1024
+DEFAULT_PARSE_MAX_DEPTH = 32
+DEFAULT_PARSE_CACHE_SIZE = 128
+
+TOP_DOWNLOADS_MAX_LIMIT = 1000
+
+DATASET_READ_TOKENS_CONF_KEY = 'ckanext.blob_storage.dataset_read_tokens'
+DATASET_READ_TOKENS_MAX_AGE_CONF_KEY = 'ckanext.blob_storage.dataset_read_tokens.max_age'
+DEFAULT_DATASET_READ_TOKENS_MAX_AGE = 300
+TOKEN_EXPIRY_MARGIN = 30
+
+# Set in the context by callers passing a resource loaded with ``resource_show`` in ``data_dict``
+RESOURCE_LOADED_CONTEXT_KEY = 'blob_storage_resource_loaded'
+
+OBJECTS_EXIST_CACHE_TTL_CONF_KEY = 'ckanext.blob_storage.objects_exist_cache_ttl'
+DEFAULT_OBJECTS_EXIST_CACHE_TTL = 60
+
+_QUOTED_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+_BRACKET_RE = re.compile(r'[\[\](){}]')
 
 log = logging.getLogger(__name__)
 
 
+class StorageUnavailable(toolkit.ValidationError):
+    """Blob storage is temporarily unavailable; The request can be retried after ``retry_after`` seconds
+
+    This is a validation error, so that API clients get the number of seconds
+    to wait in the response's ``retry_after`` error field.
+    """
+
+    def __init__(self, retry_after):
+        # type: (int) -> None
+        super(StorageUnavailable, self).__init__({
+            'storage': ['Storage is temporarily unavailable, please try again later'],
+            'retry_after': [retry_after]})
+        self.retry_after = retry_after
+
+
 @toolkit.side_effect_free
+@profiling.profiled('get_resource_download_spec')
 def get_resource_download_spec(context, data_dict):
     """Get a signed URL from LFS server to download a resource
+
+    If ``ckanext.blob_storage.server_timing`` is enabled, passing
+    ``debug_timings=true`` will add the time spent in each backend call
+    to the response, as ``timings``.
+
+    If the LFS server is unavailable, :exc:`StorageUnavailable` is raised.
     """
-    resource = _get_resource(context, data_dict)
+    from . import lfs
+    timings = metrics.start_request_timings()
+    resource, loaded = _get_resource(context, data_dict)
     activity_id = data_dict.get('activity_id')
     inline = toolkit.asbool(data_dict.get('inline'))
 
@@ -26,7 +80,13 @@ def get_resource_download_spec(context, data_dict):
         if k not in resource:
             return {}
 
-    return get_lfs_download_spec(context, resource, inline=inline, activity_id=activity_id)
+    try:
+        spec = get_lfs_download_spec(context, resource, inline=inline, activity_id=activity_id, allow_stale=loaded)
+    except lfs.LfsUnavailable as e:
+        raise StorageUnavailable(e.retry_after)
+    if timings is not None and toolkit.asbool(data_dict.get('debug_timings')):
+        spec = dict(spec, timings=timings.as_dict())
+    return spec
 
 
 def get_lfs_download_spec(context,  # type: Dict[str, Any]
@@ -36,7 +96,8 @@ def get_lfs_download_spec(context,  # type: Dict[str, Any]
                           filename=None,  # type: Optional[str]
                           storage_prefix=None,  # type: Optional[str]
                           inline=False,  # type: Optional[bool]
-                          activity_id=None  # type: Optional[str]
+                          activity_id=None,  # type: Optional[str]
+                          allow_stale=False,  # type: bool
                           ):  # type: (...) -> Dict[str, Any]
     """Get the LFS download spec (URL and headers) for a resource
 
@@ -46,6 +107,16 @@ def get_lfs_download_spec(context,  # type: Dict[str, Any]
     sha256 and size to request an object from the LFS server. You should *only* use
     these override arguments if you know what you are doing, as allowing client side
     code to override the sha256 and size could lead to potential security issues.
+
+    Successful specs are kept until they expire; If the LFS server is not
+    available and ``allow_stale`` is set, a still valid spec is returned
+    instead, once the user has been authorized. As the LFS server does not
+    check the user's token in that case, ``allow_stale`` must only be set for
+    resources loaded server side, whose object fields can be trusted.
+
+    Concurrent identical requests by the same user are coalesced, so that only
+    one of them calls the backend services: In each worker process, and across
+    workers if the ``redis`` cache backend is used.
     """
     if storage_prefix is None:
         storage_prefix = resource['lfs_prefix']
@@ -56,21 +127,48 @@ def get_lfs_download_spec(context,  # type: Dict[str, Any]
     if filename is None:
         filename = helpers.resource_filename(resource)
 
-    package = toolkit.get_action('package_show')(context, {'id': resource['package_id']})
-    authz_token = get_download_authz_token(
-        context,
-        package['organization']['name'],
-        package['name'],
-        resource['id'],
-        activity_id=activity_id)
-    client = context.get('download_lfs_client', LfsClient(helpers.server_url(), authz_token))
-
-    resources = [{"oid": sha256, "size": size, "x-filename": filename}]
-
-    if inline:
-        resources[0]["x-disposition"] = "inline"
-
-    object_spec = _get_resource_download_lfs_objects(client, storage_prefix, resources)[0]
+    key = (context.get('user'), bool(context.get('ignore_auth')), resource['id'], activity_id,
+           storage_prefix, sha256, size, filename, bool(inline), bool(allow_stale))
+    return cache.get_single_flight('download_specs').do(
+        key, _get_lfs_download_spec, context, resource, sha256, size, filename, storage_prefix, inline, activity_id,
+        allow_stale)
+
+
+def _get_lfs_download_spec(context, resource, sha256, size, filename, storage_prefix, inline, activity_id,
+                           allow_stale):
+    from . import lfs
+    with metrics.timer('download_spec_duration_seconds'):
+        authz_token = None
+        if activity_id is None and toolkit.asbool(toolkit.config.get(DATASET_READ_TOKENS_CONF_KEY, False)):
+            authz_token = get_dataset_download_authz_token(context, storage_prefix, resource['id'])
+
+        if not authz_token:
+            package = metrics.call_action('package_show', context, {'id': resource['package_id']})
+            profiling.annotate(dataset_size=len(package.get('resources', [])))
+            authz_token = get_download_authz_token(
+                context,
+                package['organization']['name'],
+                package['name'],
+                resource['id'],
+                activity_id=activity_id)
+        client = context.get('download_lfs_client', lfs.get_client(authz_token))
+
+        resources = [{"oid": sha256, "size": size, "x-filename": filename}]
+
+        if inline:
+            resources[0]["x-disposition"] = "inline"
+
+        spec_cache = cache.get_cache('download_specs')
+        cache_key = (storage_prefix, sha256, size, filename, bool(inline))
+        try:
+            object_spec = _get_resource_download_lfs_objects(client, storage_prefix, resources)[0]
+        except lfs.LfsUnavailable:
+            cached_spec = spec_cache.get(cache_key) if allow_stale else None
+            if cached_spec is None:
+                raise
+            log.warning("LFS server is unavailable, serving cached download spec for %s", sha256)
+            metrics.increment('stale_download_specs_total')
+            return cached_spec
 
     assert object_spec['oid'] == sha256
     assert object_spec['size'] == size
@@ -79,64 +177,574 @@ def get_lfs_download_spec(context,  # type: Dict[str, Any]
         raise toolkit.ObjectNotFound('Object error [{}]: {}'.format(object_spec['error'].get('message', '[no message]'),
                                                                     object_spec['error'].get('code', 'unknown')))
 
-    return object_spec['actions']['download']
+    download_spec = object_spec['actions']['download']
+    ttl = _download_spec_ttl(download_spec)
+    if ttl > 0:
+        spec_cache.set(cache_key, download_spec, ttl=ttl)
+    return download_spec
+
+
+def get_lfs_download_specs(context, package, resources):
+    # type: (Dict[str, Any], Dict[str, Any], List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]
+    """Get the LFS download specs of multiple resources of a dataset, in bulk
+
+    Access to each resource is checked first. If dataset wide read tokens are
+    enabled (``ckanext.blob_storage.dataset_read_tokens``) and one is granted,
+    objects in the same storage prefix are requested in a single LFS batch
+    request; Otherwise, a token and a request per resource are needed. Returns
+    download specs by resource ID. Resources whose object is not found are
+    left out.
+    """
+    from . import lfs
+
+    by_prefix = {}  # type: Dict[str, List[Dict[str, Any]]]
+    for resource in resources:
+        toolkit.check_access('resource_show', context, {'id': resource['id']})
+        by_prefix.setdefault(resource['lfs_prefix'], []).append(resource)
+
+    dataset_read_tokens = toolkit.asbool(toolkit.config.get(DATASET_READ_TOKENS_CONF_KEY, False))
+    specs = {}
+    with metrics.timer('download_spec_duration_seconds'):
+        for lfs_prefix, prefix_resources in by_prefix.items():
+            authz_token = None
+            if dataset_read_tokens:
+                authz_token = get_dataset_download_authz_token(context, lfs_prefix, prefix_resources[0]['id'])
+            if authz_token:
+                batches = [(authz_token, prefix_resources)]
+            else:
+                batches = [(get_download_authz_token(context, package['organization']['name'], package['name'],
+                                                     r['id']), [r]) for r in prefix_resources]
+
+            for token, batch_resources in batches:
+                objects = [{'oid': r['sha256'], 'size': r['size']} for r in batch_resources]
+                response_objects = _get_resource_download_lfs_objects(lfs.get_client(token), lfs_prefix, objects)
+                found = {(o['oid'], o['size']): o['actions']['download'] for o in response_objects
+                         if 'error' not in o and 'download' in o.get('actions', {})}
+                for r in batch_resources:
+                    if (r['sha256'], r['size']) in found:
+                        specs[r['id']] = found[(r['sha256'], r['size'])]
+                    else:
+                        log.warning("Object %s of resource %s was not found in storage", r['sha256'], r['id'])
+    return specs
+
+
+def _download_spec_ttl(spec):
+    # type: (Dict[str, Any]) -> float
+    """Get the number of seconds a download spec is still valid for, with a safety margin
+
+    >>> _download_spec_ttl({'href': 'https://example.com', 'expires_in': 900})
+    870
+    >>> _download_spec_ttl({'href': 'https://example.com'})
+    0
+    """
+    expires_in = spec.get('expires_in')
+    if expires_in is None and spec.get('expires_at'):
+        expires_at = _parse_expires_at(spec['expires_at'])
+        if expires_at is not None:
+            expires_in = expires_at - time.time()
+    if expires_in is None:
+        return 0
+    return max(expires_in - TOKEN_EXPIRY_MARGIN, 0)
+
+
+def _parse_expires_at(value):
+    # type: (str) -> Optional[float]
+    """Parse an LFS ``expires_at`` timestamp as a Unix timestamp
+
+    >>> _parse_expires_at('2020-01-01T00:00:00Z')
+    1577836800.0
+    >>> _parse_expires_at('not a date') is None
+    True
+    """
+    try:
+        parsed = datetime.datetime.strptime(value[0:19], '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    return calendar.timegm(parsed.timetuple()) + 0.0
+
+
+@toolkit.chained_action
+def authz_authorize(up_func, context, data_dict):
+    """Authorize scopes, loading everything referenced by ``obj`` scopes up front
+
+    This wraps ckanext-authz-service's ``authz_authorize``, so that requesting
+    a token for many object scopes at once does not look up each dataset,
+    organization and resource separately.
+    """
+    from . import authz
+    scopes = data_dict.get('scopes') or []
+    if isinstance(scopes, string_types):
+        scopes = scopes.split(' ')
+    with authz.object_scopes_snapshot(scopes):
+        return up_func(context, data_dict)
 
 
 @toolkit.side_effect_free
+@profiling.profiled('resource_schema_show')
 def resource_schema_show(context, data_dict):
     """Get a resource schema as a dictionary instead of string
     """
-    resource = _get_resource(context, data_dict)
-
-    if resource.get('schema', False):
-        try:
-            return ast.literal_eval(resource['schema'])
-        except ValueError:
-            return resource['schema']
-    return {}
+    resource, loaded = _get_resource(context, data_dict)
+    return _parse_resource_field(resource, 'schema', trusted=loaded)
 
 
 @toolkit.side_effect_free
+@profiling.profiled('resource_sample_show')
 def resource_sample_show(context, data_dict):
     """Get a resource sample as a list of dictionaries instead of string
+
+    Rows can be paginated using ``offset`` and ``limit``, and columns can be
+    selected by passing a list (or comma separated string) of ``fields``.
+    If ``format`` is ``columns``, the sample is returned in a compact form:
+    a dictionary with a list of ``fields``, a list of ``rows`` each being a
+    list of values in the same order, and the ``total`` number of rows.
+    Samples whose rows are not dictionaries can only be paginated.
+    """
+    resource, loaded = _get_resource(context, data_dict)
+    sample = _parse_resource_field(resource, 'sample', trusted=loaded)
+    sample_format = data_dict.get('format', 'records')
+    if sample_format not in ('records', 'columns'):
+        raise toolkit.ValidationError({'format': ['Must be one of: records, columns']})
+
+    if not isinstance(sample, list) or not any(k in data_dict for k in ('offset', 'limit', 'fields', 'format')):
+        return sample
+
+    offset = _get_non_negative_int(data_dict, 'offset', 0)
+    limit = _get_non_negative_int(data_dict, 'limit', None)
+    rows = sample[offset:offset + limit if limit is not None else None]
+
+    fields = data_dict.get('fields')
+    if isinstance(fields, string_types):
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+    elif fields is not None and not (isinstance(fields, list) and all(isinstance(f, string_types) for f in fields)):
+        raise toolkit.ValidationError({'fields': ['Must be a list of field names']})
+
+    if not all(isinstance(row, dict) for row in rows):
+        if fields or sample_format == 'columns':
+            raise toolkit.ValidationError({'fields' if fields else 'format': [
+                'Only samples whose rows are dictionaries support fields and the columns format']})
+        return rows
+
+    if sample_format == 'records':
+        if fields:
+            rows = [{f: row[f] for f in fields if f in row} for row in rows]
+        return rows
+
+    if not fields:
+        fields = _sample_fields(rows)
+    return {'fields': fields,
+            'rows': [[row.get(f) for f in fields] for row in rows],
+            'total': len(sample)}
+
+
+@profiling.profiled('blob_storage_register_resources')
+def blob_storage_register_resources(context, data_dict):
+    """Register multiple files already uploaded to blob storage as new resources of a dataset
+
+    Expects a ``package_id`` and a list of ``resources``, each with at least
+    ``name``, ``sha256`` and ``size``. ``lfs_prefix`` defaults to the
+    storage prefix used by the upload widget (``<storage namespace>/<package id>``)
+    and ``url`` defaults to ``name``; Any other resource fields (e.g. ``format``)
+    are passed through as is.
+
+    Unlike calling ``resource_create`` once per file, which validates and
+    re-indexes the entire dataset on each call, all resources are added in a
+    single ``package_update`` call. Note that as a result, ``IResourceController``
+    create hooks are not called for these resources. Schema and sample
+    inference jobs are still enqueued for them, if enabled.
+
+    Returns the created resources.
     """
-    resource = _get_resource(context, data_dict)
+    from . import inference
+    package_id = toolkit.get_or_bust(data_dict, 'package_id')
+    resources = data_dict.get('resources')
+    if not resources or not isinstance(resources, list):
+        raise toolkit.ValidationError({'resources': ['A non-empty list of resources is required']})
+
+    toolkit.check_access('package_update', context, {'id': package_id})
+    package = metrics.call_action('package_show', context, {'id': package_id})
+
+    default_prefix = helpers.resource_storage_prefix(package['id'])
+    errors = []
+    new_resources = []
+    for resource in resources:
+        resource_errors = _uploaded_resource_errors(resource)
+        errors.append(resource_errors)
+        if not resource_errors:
+            new_resource = dict(resource, url_type='upload')
+            new_resource.setdefault('url', resource['name'])
+            new_resource.setdefault('lfs_prefix', default_prefix)
+            new_resources.append(new_resource)
+
+    if any(errors):
+        raise toolkit.ValidationError({'resources': errors})
+
+    package['resources'] = package.get('resources', []) + new_resources
+    updated = toolkit.get_action('package_update')(dict(context, use_cache=False), package)
+
+    created = updated['resources'][-len(new_resources):]
+    for resource in created:
+        inference.enqueue(resource)
+    return created
+
+
+@profiling.profiled('blob_storage_upload_spec')
+def blob_storage_upload_spec(context, data_dict):
+    """Get upload actions for multiple files to be added to a dataset, in a single call
+
+    Expects a ``package_id`` and a list of ``objects``, each with ``sha256``,
+    ``size`` and optionally ``filename``. A single authorization token for
+    writing to the dataset's storage prefix is requested, and upload actions
+    for all objects are requested from the LFS server in a single batch call.
+
+    Returns the ``lfs_prefix`` and authorization ``token`` to use, and the
+    list of ``objects`` returned by the LFS server, each with ``exists`` set
+    to ``True`` if the object is already in storage and need not be uploaded.
+    """
+    from . import lfs
 
-    if resource.get('sample', False):
-        try:
-            return ast.literal_eval(resource['sample'])
-        except ValueError:
-            return resource['sample']
-    return {}
+    package_id = toolkit.get_or_bust(data_dict, 'package_id')
+    objects = data_dict.get('objects')
+    if not objects or not isinstance(objects, list):
+        raise toolkit.ValidationError({'objects': ['A non-empty list of objects is required']})
+
+    errors = [_upload_object_errors(obj) for obj in objects]
+    if any(errors):
+        raise toolkit.ValidationError({'objects': errors})
+
+    toolkit.check_access('package_update', context, {'id': package_id})
+    package = metrics.call_action('package_show', context, {'id': package_id})
+
+    lfs_prefix = helpers.resource_storage_prefix(package['id'])
+    token = get_upload_authz_token(context, package['id'])
+    client = context.get('upload_lfs_client', lfs.get_client(token))
+
+    lfs_objects = []
+    for obj in objects:
+        lfs_object = {'oid': obj['sha256'], 'size': int(obj['size'])}
+        if obj.get('filename'):
+            lfs_object['x-filename'] = obj['filename']
+        lfs_objects.append(lfs_object)
+
+    response_objects = _lfs_batch(client, lfs_prefix, 'upload', lfs_objects)['objects']
+    for obj in response_objects:
+        obj['exists'] = 'error' not in obj and 'upload' not in obj.get('actions', {})
+
+    return {'lfs_prefix': lfs_prefix,
+            'token': token,
+            'objects': response_objects}
+
+
+@toolkit.side_effect_free
+@profiling.profiled('blob_storage_objects_exist')
+def blob_storage_objects_exist(context, data_dict):
+    """Check if multiple objects exist in storage
+
+    Expects a list of ``objects``, each with ``lfs_prefix``, ``sha256`` and
+    ``size``. The user must be allowed to read from each storage prefix. All
+    objects in the same prefix are checked using a single LFS batch request.
+    Existing objects are cached for a short time
+    (``ckanext.blob_storage.objects_exist_cache_ttl`` seconds), so that they
+    are not checked again; Missing objects are not cached, as they may be
+    uploaded at any moment.
+
+    Returns the list of ``objects``, in the same order, each with ``exists``
+    set to ``True`` or ``False``.
+    """
+    from . import lfs
+
+    objects = data_dict.get('objects')
+    if not objects or not isinstance(objects, list):
+        raise toolkit.ValidationError({'objects': ['A non-empty list of objects is required']})
+
+    errors = []
+    for obj in objects:
+        obj_errors = _upload_object_errors(obj)
+        if not obj_errors and len(ensure_text(obj.get('lfs_prefix') or '').split('/')) != 2:
+            obj_errors['lfs_prefix'] = ['Must be a storage prefix of the form <organization>/<dataset>']
+        errors.append(obj_errors)
+    if any(errors):
+        raise toolkit.ValidationError({'objects': errors})
+
+    exists_cache = cache.get_cache('objects_exist', ttl=toolkit.asint(
+        toolkit.config.get(OBJECTS_EXIST_CACHE_TTL_CONF_KEY, DEFAULT_OBJECTS_EXIST_CACHE_TTL)))
+    results = [{'lfs_prefix': obj['lfs_prefix'], 'sha256': obj['sha256'], 'size': int(obj['size'])}
+               for obj in objects]
+
+    by_prefix = {}  # type: Dict[str, List[Dict[str, Any]]]
+    for result in results:
+        by_prefix.setdefault(result['lfs_prefix'], []).append(result)
+
+    for lfs_prefix, prefix_results in by_prefix.items():
+        org_name, package_name = lfs_prefix.split('/')
+        authz_result = _authorize_scope(context, helpers.resource_authz_scope(
+            package_name, org_name=org_name, actions='read'))
+        if not authz_result['granted_scopes']:
+            raise toolkit.NotAuthorized("You are not authorized to read from {}".format(lfs_prefix))
+
+        unknown = []
+        for result in prefix_results:
+            result['exists'] = exists_cache.get((lfs_prefix, result['sha256'], result['size']), False)
+            if not result['exists']:
+                unknown.append(result)
+        if not unknown:
+            continue
+
+        client = context.get('download_lfs_client',
+                             lfs.get_client(ensure_text(authz_result['token'])))
+        lfs_objects = [{'oid': r['sha256'], 'size': r['size']} for r in unknown]
+        response_objects = _lfs_batch(client, lfs_prefix, 'download', lfs_objects, transfers=['basic'])['objects']
+        found = {(o['oid'], o['size']) for o in response_objects if 'error' not in o}
+        for result in unknown:
+            result['exists'] = (result['sha256'], result['size']) in found
+            if result['exists']:
+                exists_cache.set((lfs_prefix, result['sha256'], result['size']), True)
+
+    return {'objects': results}
+
+
+@toolkit.side_effect_free
+def blob_storage_top_downloads(context, data_dict):
+    """Get the most downloaded resources, as counted by download tracking
+
+    Only available to sysadmins. Returns up to ``limit`` (default: 10)
+    resources, each with ``resource_id``, ``package_id``, download ``count``
+    and ``last_download`` time. Counts which were not yet written to the
+    database by worker processes are not included.
+    """
+    if not context.get('ignore_auth') and not authz.is_sysadmin(context.get('user')):
+        raise toolkit.NotAuthorized("Only sysadmins can view download counts")
+
+    limit = _get_non_negative_int(data_dict, 'limit', 10)
+    if limit > TOP_DOWNLOADS_MAX_LIMIT:
+        raise toolkit.ValidationError({'limit': ['Must not be greater than {}'.format(TOP_DOWNLOADS_MAX_LIMIT)]})
+
+    top = model.get_top_downloads(limit)
+    for row in top:
+        row['last_download'] = row['last_download'].isoformat()
+    return top
+
+
+@profiling.profiled('blob_storage_multipart_upload_start')
+def blob_storage_multipart_upload_start(context, data_dict):
+    """Start or resume a resumable, multipart upload of a large file to a dataset
+
+    Expects a ``package_id``, ``sha256``, ``size`` and optionally ``filename``.
+    Upload actions are requested from the LFS server using the
+    ``multipart-basic`` transfer, which allows uploading parts of the file
+    in parallel. Parts that were uploaded successfully should be reported
+    using ``blob_storage_multipart_upload_part_done``.
+
+    If an unfinished upload of the same file to the same dataset exists, it
+    is resumed: fresh upload actions are requested for it, and the positions
+    of parts already uploaded are returned in ``uploaded_parts`` so that they
+    can be skipped.
+
+    Returns the ``upload_id``, ``lfs_prefix``, authorization ``token``, the
+    ``transfer`` chosen by the LFS server and the LFS upload ``object``. If
+    the object already exists in storage, ``exists`` is ``True`` and no
+    upload is tracked.
+    """
+    from . import lfs
+
+    package_id = toolkit.get_or_bust(data_dict, 'package_id')
+    errors = _upload_object_errors(data_dict)
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    toolkit.check_access('package_update', context, {'id': package_id})
+    package = metrics.call_action('package_show', context, {'id': package_id})
+
+    sha256 = data_dict['sha256']
+    size = int(data_dict['size'])
+    lfs_prefix = helpers.resource_storage_prefix(package['id'])
+    token = get_upload_authz_token(context, package['id'])
+    client = context.get('upload_lfs_client', lfs.get_client(token))
+
+    lfs_object = {'oid': sha256, 'size': size}
+    if data_dict.get('filename'):
+        lfs_object['x-filename'] = data_dict['filename']
+    batch_response = _lfs_batch(client, lfs_prefix, 'upload', [lfs_object], transfers=['multipart-basic', 'basic'])
+    response_object = batch_response['objects'][0]
+    if 'error' in response_object:
+        raise toolkit.ValidationError({'sha256': ['Object error [{}]: {}'.format(
+            response_object['error'].get('code', 'unknown'), response_object['error'].get('message', '[no message]'))]})
+
+    result = {'lfs_prefix': lfs_prefix,
+              'token': token,
+              'transfer': batch_response.get('transfer', 'basic'),
+              'object': response_object,
+              'exists': not response_object.get('actions')}
+
+    upload = model.find_multipart_upload(package['id'], sha256, size)
+    if result['exists']:
+        if upload:
+            model.delete_multipart_upload(upload['id'])
+    else:
+        if not upload:
+            user = context.get('auth_user_obj')
+            upload = model.create_multipart_upload(package['id'], sha256, size, user_id=user.id if user else None)
+        result['upload_id'] = upload['id']
+        result['uploaded_parts'] = [p['pos'] for p in model.get_multipart_upload_parts(upload['id'])]
+
+    if not context.get('defer_commit'):
+        model.meta.Session.commit()
+    return result
+
+
+@profiling.profiled('blob_storage_multipart_upload_part_done')
+def blob_storage_multipart_upload_part_done(context, data_dict):
+    """Report that a part of a multipart upload was uploaded successfully
+
+    Expects the ``upload_id``, and the ``pos`` and ``size`` of the part, as
+    specified in the part's upload action. Parts may be reported in any
+    order, and more than once. Returns the upload's status, as returned by
+    ``blob_storage_multipart_upload_show``.
+    """
+    upload = _get_multipart_upload(context, data_dict)
+    errors = {}
+    try:
+        pos = int(data_dict.get('pos'))
+        if pos < 0:
+            raise ValueError('negative position')
+    except (TypeError, ValueError):
+        errors['pos'] = ['Must be a non-negative integer']
+    try:
+        part_size = int(data_dict.get('size'))
+        if part_size <= 0:
+            raise ValueError('non-positive size')
+    except (TypeError, ValueError):
+        errors['size'] = ['Must be a positive integer']
+    if not errors and pos + part_size > upload['size']:
+        errors['size'] = ['Part exceeds the object size']
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    model.add_multipart_upload_part(upload['id'], pos, part_size)
+    if not context.get('defer_commit'):
+        model.meta.Session.commit()
+    return _multipart_upload_status(upload)
+
+
+@toolkit.side_effect_free
+@profiling.profiled('blob_storage_multipart_upload_show')
+def blob_storage_multipart_upload_show(context, data_dict):
+    """Get the status of a multipart upload by ``upload_id``
+
+    Returns the upload's ``package_id``, ``sha256`` and ``size``, the list of
+    ``uploaded_parts`` positions and the total ``uploaded_size``.
+    """
+    return _multipart_upload_status(_get_multipart_upload(context, data_dict))
+
+
+@profiling.profiled('blob_storage_multipart_upload_delete')
+def blob_storage_multipart_upload_delete(context, data_dict):
+    """Stop tracking a multipart upload by ``upload_id``
+
+    This should be called once the upload has been committed and verified
+    with the LFS server, or when abandoning it.
+    """
+    upload = _get_multipart_upload(context, data_dict)
+    model.delete_multipart_upload(upload['id'])
+    if not context.get('defer_commit'):
+        model.meta.Session.commit()
+
+
+def _get_multipart_upload(context, data_dict):
+    # type: (Dict[str, Any], Dict[str, Any]) -> Dict[str, Any]
+    """Get a multipart upload by ID, checking that the user can update its dataset
+    """
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    upload = model.get_multipart_upload(upload_id)
+    if upload is None:
+        raise toolkit.ObjectNotFound('Multipart upload not found: {}'.format(upload_id))
+    toolkit.check_access('package_update', context, {'id': upload['package_id']})
+    return upload
+
+
+def _multipart_upload_status(upload):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    parts = model.get_multipart_upload_parts(upload['id'])
+    return {'upload_id': upload['id'],
+            'package_id': upload['package_id'],
+            'sha256': upload['sha256'],
+            'size': upload['size'],
+            'uploaded_parts': [p['pos'] for p in parts],
+            'uploaded_size': sum(p['size'] for p in parts)}
+
+
+def _upload_object_errors(obj):
+    # type: (Dict[str, Any]) -> Dict[str, List[str]]
+    """Check the fields of an object to upload
+    """
+    if not isinstance(obj, dict):
+        return {'__type': ['Object must be a dictionary']}
+    errors = {}
+    try:
+        validators.valid_sha256(obj.get('sha256') if isinstance(obj.get('sha256'), string_types) else '')
+    except toolkit.Invalid as e:
+        errors['sha256'] = [e.error]
+    try:
+        if int(obj.get('size')) < 0:
+            raise ValueError('negative size')
+    except (TypeError, ValueError):
+        errors['size'] = ['Must be a non-negative integer']
+    return errors
+
+
+def _uploaded_resource_errors(resource):
+    # type: (Dict[str, Any]) -> Dict[str, List[str]]
+    """Check the fields required to register an uploaded file, before running the full package validation
+    """
+    if not isinstance(resource, dict):
+        return {'__type': ['Resource must be a dictionary']}
+    errors = {}
+    for field in ('name', 'sha256', 'size'):
+        if not resource.get(field):
+            errors[field] = ['Missing value']
+    return errors
 
 
 def _get_resource_download_lfs_objects(client, lfs_prefix, resources):
     """Get LFS download operation response objects for a given resource list
     """
-    log.debug("Requesting download spec from LFS server for %s", resources)
-    try:
-        batch_response = client.batch(lfs_prefix, 'download', resources)
-    except LfsError as e:
-        if e.status_code == 404:
-            raise toolkit.ObjectNotFound("The requested resource does not exist")
-        elif e.status_code == 422:
-            raise toolkit.ObjectNotFound("Object parameters mismatch")
-        elif e.status_code == 403:
-            raise toolkit.ObjectNotFound("Request was denied by the LFS server")
-        else:
+    return _lfs_batch(client, lfs_prefix, 'download', resources)['objects']
+
+
+def _lfs_batch(client, lfs_prefix, operation, objects, transfers=None):
+    """Send an LFS batch request, and get the response
+
+    Raises :exc:`lfs.LfsUnavailable` if the LFS server is down or failing.
+    """
+    from giftless_client.exc import LfsError
+
+    from . import lfs
+    log.debug("Requesting %s spec from LFS server for %s", operation, objects)
+    with metrics.timer('lfs_batch_duration_seconds', operation=operation, status='error') as labels:
+        try:
+            batch_response = lfs.batch(client, lfs_prefix, operation, objects, transfers=transfers)
+            labels['status'] = '200'
+        except lfs.LfsUnavailable:
+            labels['status'] = 'unavailable'
             raise
+        except LfsError as e:
+            labels['status'] = str(e.status_code)
+            if e.status_code == 404:
+                raise toolkit.ObjectNotFound("The requested resource does not exist")
+            elif e.status_code == 422:
+                raise toolkit.ObjectNotFound("Object parameters mismatch")
+            elif e.status_code == 403:
+                raise toolkit.ObjectNotFound("Request was denied by the LFS server")
+            else:
+                raise
 
-    return batch_response['objects']
+    return batch_response
 
 
 def get_download_authz_token(context, org_name, package_name, resource_id, activity_id=None):
     # type: (Dict[str, Any], str, str, str, str) -> str
     """Get an authorization token for getting the download URL from LFS
     """
-    authorize = toolkit.get_action('authz_authorize')
-    if not authorize:
-        raise RuntimeError("Cannot find authz_authorize; Is ckanext-authz-service installed?")
-
     scope = helpers.resource_authz_scope(
         package_name,
         org_name=org_name,
@@ -144,11 +752,7 @@ def get_download_authz_token(context, org_name, package_name, resource_id, activ
         resource_id=resource_id,
         activity_id=activity_id
         )
-    log.debug("Requesting authorization token for scope: %s", scope)
-    authz_result = authorize(context, {"scopes": [scope]})
-    if not authz_result or not authz_result.get('token', False):
-        raise RuntimeError("Failed to get authorization token for LFS server")
-    log.debug("Granted scopes: %s", authz_result['granted_scopes'])
+    authz_result = _authorize_scope(context, scope)
 
     if len(authz_result['granted_scopes']) == 0:
         raise toolkit.NotAuthorized("You are not authorized to download this resource")
@@ -156,9 +760,261 @@ def get_download_authz_token(context, org_name, package_name, resource_id, activ
     return ensure_text(authz_result['token'])
 
 
+def get_dataset_download_authz_token(context, lfs_prefix, resource_id):
+    # type: (Dict[str, Any], str, str) -> Optional[str]
+    """Get a cached authorization token for downloading any object in a storage prefix
+
+    Tokens are cached per user and storage prefix until shortly before they
+    expire, or for ``ckanext.blob_storage.dataset_read_tokens.max_age``
+    seconds, whichever is sooner, so that downloading many resources of the
+    same dataset does not require a token per resource. Access to the
+    resource itself is still checked on every call.
+
+    Returns ``None`` if dataset-wide read access is not granted, in which case
+    a resource specific token should be requested.
+    """
+    toolkit.check_access('resource_show', context, {'id': resource_id})
+
+    max_age = toolkit.asint(toolkit.config.get(DATASET_READ_TOKENS_MAX_AGE_CONF_KEY,
+                                               DEFAULT_DATASET_READ_TOKENS_MAX_AGE))
+    token_cache = cache.get_cache('dataset_read_tokens')
+    key = (context.get('user') or '', lfs_prefix)
+    token = token_cache.get(key)
+    if token is not None:
+        return token or None
+
+    scope = 'obj:{}/*:read'.format(lfs_prefix)
+    authz_result = _authorize_scope(context, scope)
+    if authz_result['granted_scopes']:
+        token = ensure_text(authz_result['token'])
+        ttl = min(max_age, _token_expires_in(token) - TOKEN_EXPIRY_MARGIN)
+    else:
+        log.debug("Dataset wide read access to %s was not granted", lfs_prefix)
+        token = ''
+        ttl = max_age
+
+    if ttl > 0:
+        token_cache.set(key, token, ttl=ttl)
+    return token or None
+
+
+def _token_expires_in(token):
+    # type: (str) -> float
+    """Get the number of seconds until a JWT token expires, without verifying it
+
+    If the token has no expiry time or cannot be decoded, ``inf`` is returned.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(ensure_text(base64.urlsafe_b64decode(ensure_binary(payload))))['exp'] - time.time()
+    except (IndexError, KeyError, TypeError, ValueError):
+        return float('inf')
+
+
+def get_upload_authz_token(context, package_id):
+    # type: (Dict[str, Any], str) -> str
+    """Get an authorization token for uploading files to a dataset's storage prefix in LFS
+    """
+    scope = helpers.resource_authz_scope(package_id, actions='read,write')
+    authz_result = _authorize_scope(context, scope)
+
+    if not any('write' in granted.rsplit(':', 1)[-1].split(',') for granted in authz_result['granted_scopes']):
+        raise toolkit.NotAuthorized("You are not authorized to upload files to this dataset")
+
+    return ensure_text(authz_result['token'])
+
+
+def _authorize_scope(context, scope):
+    # type: (Dict[str, Any], str) -> Dict[str, Any]
+    """Request an authorization token for a scope from ckanext-authz-service
+    """
+    authorize = toolkit.get_action('authz_authorize')
+    if not authorize:
+        raise RuntimeError("Cannot find authz_authorize; Is ckanext-authz-service installed?")
+
+    log.debug("Requesting authorization token for scope: %s", scope)
+    with metrics.timer('action_duration_seconds', action='authz_authorize'):
+        authz_result = authorize(context, {"scopes": [scope]})
+    if not authz_result or not authz_result.get('token', False):
+        raise RuntimeError("Failed to get authorization token for LFS server")
+    log.debug("Granted scopes: %s", authz_result['granted_scopes'])
+    return authz_result
+
+
 def _get_resource(context, data_dict):
-    """Get resource by ID
+    # type: (Dict[str, Any], Dict[str, Any]) -> Tuple[Dict[str, Any], bool]
+    """Get resource by ID, or as passed by the caller in ``resource``
+
+    Also returns whether the resource was loaded using ``resource_show``;
+    Resources passed by API callers can not be trusted to match stored ones.
+    Python callers passing a resource they loaded can set
+    ``RESOURCE_LOADED_CONTEXT_KEY`` in the context.
     """
     if 'resource' in data_dict:
-        return data_dict['resource']
-    return toolkit.get_action('resource_show')(context, {'id': data_dict['id']})
+        return data_dict['resource'], bool(context.get(RESOURCE_LOADED_CONTEXT_KEY))
+    return metrics.call_action('resource_show', context, {'id': data_dict['id']}), True
+
+
+def _parse_resource_field(resource, field, trusted=True):
+    # type: (Dict[str, Any], str, bool) -> Any
+    """Parse a resource field stored as a string representation of a Python or JSON value
+
+    Values stored as side objects, referenced by a ``<field>_ref`` resource
+    field, are loaded from the database.
+
+    Parsed values are cached, keyed by side object reference, or resource ID
+    and ``metadata_modified`` (or a hash of the stored value if not available),
+    so they must not be modified by callers. If the value cannot be parsed, it
+    is returned as is.
+
+    If the resource is not ``trusted`` (it was passed by an API caller), its
+    value is parsed without using the cache, and side object references are
+    ignored.
+    """
+    value = resource.get(field)
+    ref = resource.get('{}_ref'.format(field)) if trusted else None
+    if not value and not ref:
+        return {}
+    if value and not isinstance(value, string_types):
+        return value
+    if not trusted:
+        return _parse_stored_value(value, field)
+
+    key = _resource_field_cache_key(resource, field)
+    parse_cache = cache.get_cache('parsed_resource_fields', maxsize=toolkit.asint(
+        toolkit.config.get(PARSE_CACHE_SIZE_CONF_KEY, DEFAULT_PARSE_CACHE_SIZE)))
+    parsed = parse_cache.get(key)
+    if parsed is None:
+        if not value:
+            value = model.get_resource_metadata(ref)
+            if value is None:
+                raise toolkit.ObjectNotFound('Resource {} not found: {}'.format(field, ref))
+        parsed = _parse_stored_value(value, field)
+        parse_cache.set(key, parsed)
+    return parsed
+
+
+def serialize_resource_field(resource, field):
+    # type: (Dict[str, Any], str) -> str
+    """Get a resource field parsed by :func:`_parse_resource_field`, serialized as JSON
+
+    Serialized values are cached with the same keys as parsed values, so that
+    views can return them as is, without serializing them on every request.
+    """
+    key = _resource_field_cache_key(resource, field)
+    if key is None:
+        return json.dumps(_parse_resource_field(resource, field), separators=(',', ':'))
+
+    serialized_cache = cache.get_cache('serialized_resource_fields', maxsize=toolkit.asint(
+        toolkit.config.get(PARSE_CACHE_SIZE_CONF_KEY, DEFAULT_PARSE_CACHE_SIZE)))
+    serialized = serialized_cache.get(key)
+    if serialized is None:
+        serialized = json.dumps(_parse_resource_field(resource, field), separators=(',', ':'))
+        serialized_cache.set(key, serialized)
+    return serialized
+
+
+def _resource_field_cache_key(resource, field):
+    # type: (Dict[str, Any], str) -> Optional[tuple]
+    """Get the cache key of a resource field stored as a string, or a side object reference
+
+    >>> _resource_field_cache_key({'id': 'r', 'schema': '{}', 'metadata_modified': '2021-01-01'}, 'schema')
+    ('r', 'schema', '2021-01-01')
+    >>> _resource_field_cache_key({'id': 'r', 'sample_ref': 'sha256:abc'}, 'sample')
+    ('sha256:abc', 'sample')
+    >>> _resource_field_cache_key({'id': 'r', 'schema': {}}, 'schema') is None
+    True
+    """
+    value = resource.get(field)
+    if value and isinstance(value, string_types):
+        version = resource.get('metadata_modified') or hashlib.sha1(ensure_binary(value)).hexdigest()
+        return (resource.get('id'), field, version)
+    ref = resource.get('{}_ref'.format(field))
+    if not value and ref:
+        return (ref, field)
+    return None
+
+
+def _parse_stored_value(value, field):
+    # type: (str, str) -> Any
+    """Parse a string representation of a Python or JSON value, enforcing size and depth limits
+
+    JSON is tried first, as it is much faster to parse than Python literals.
+
+    >>> _parse_stored_value('{"fields": [{"name": "id", "type": "integer"}]}', 'schema')
+    {'fields': [{'name': 'id', 'type': 'integer'}]}
+    >>> _parse_stored_value("[{'id': 1, 'valid': True}]", 'sample')
+    [{'id': 1, 'valid': True}]
+    >>> _parse_stored_value('not a literal', 'sample')
+    'not a literal'
+    """
+    max_size = toolkit.asint(toolkit.config.get(PARSE_MAX_SIZE_CONF_KEY, DEFAULT_PARSE_MAX_SIZE))
+    if len(value) > max_size:
+        raise toolkit.ValidationError({field: ['Value is too large to parse ({} characters, limit is {})'.format(
+            len(value), max_size)]})
+
+    max_depth = toolkit.asint(toolkit.config.get(PARSE_MAX_DEPTH_CONF_KEY, DEFAULT_PARSE_MAX_DEPTH))
+    if _nesting_depth(value) > max_depth:
+        raise toolkit.ValidationError({field: ['Value is nested too deeply to parse (limit is {})'.format(
+            max_depth)]})
+
+    if value.lstrip()[0:1] in ('{', '['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def _nesting_depth(value):
+    # type: (str) -> int
+    """Get the maximal bracket nesting depth of a Python or JSON literal, ignoring brackets in strings
+
+    >>> _nesting_depth('{"a": [1, [2, "]]]"]], "b": {}}')
+    3
+    >>> _nesting_depth('plain')
+    0
+    """
+    depth = max_depth = 0
+    for bracket in _BRACKET_RE.findall(_QUOTED_STRING_RE.sub('', value)):
+        if bracket in '[({':
+            depth += 1
+            max_depth = max(depth, max_depth)
+        else:
+            depth -= 1
+    return max_depth
+
+
+def _get_non_negative_int(data_dict, key, default):
+    # type: (Dict[str, Any], str, Optional[int]) -> Optional[int]
+    if data_dict.get(key) in (None, ''):
+        return default
+    try:
+        value = int(data_dict[key])
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise toolkit.ValidationError({key: ['Must be a non-negative integer']})
+    return value
+
+
+def _sample_fields(rows):
+    # type: (List[Dict[str, Any]]) -> List[str]
+    """Get the names of all fields in a list of sample rows, in order of first appearance
+
+    >>> _sample_fields([{'id': 1, 'name': 'a'}, {'id': 2, 'size': 3}])
+    ['id', 'name', 'size']
+    """
+    fields = []  # type: List[str]
+    seen = set()
+    for row in rows:
+        for field in row:
+            if field not in seen:
+                seen.add(field)
+                fields.append(field)
+    return fields
@@ -1,39 +1,164 @@
 """Authorization related helpers
 """
 import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Iterable, Optional, Tuple
 
+from ckan import model
 from ckan.plugins import toolkit
+from sqlalchemy import or_
 
 from ckanext.authz_service.authz_binding import resource as resource_authz
 from ckanext.authz_service.authz_binding.common import get_user_context
 from ckanext.authz_service.authzzie import Scope
 
-from . import helpers
+from . import cache, helpers, metrics
 
 log = logging.getLogger(__name__)
 
+_local = threading.local()
+
 
 def check_object_permissions(id, dataset_id=None, organization_id=None, context=None):
     """Check object (resource in storage) permissions
 
     This wrap's ckanext-authz-service's default logic for checking resource
     by checking for global-prefix/dataset-uuid/* style object scopes.
+
+    If called while an :func:`object_scopes_snapshot` is active, datasets,
+    organizations and resources are taken from the snapshot, instead of being
+    looked up for each scope.
     """
     if not context:
         context = get_user_context()
     # support for resource_id/activity_id
     id = id.split('/')[0]
-    if dataset_id and organization_id and organization_id == helpers.storage_namespace():
-        log.debug("Requesting authorization for object: %s/%s in namespace %s", dataset_id, id, organization_id)
-        dataset = toolkit.get_action('package_show')(context, {'id': dataset_id})
-        dataset_id = dataset['name']
-        try:
-            organization_id = dataset['organization']['name']
-        except (KeyError, TypeError):
-            organization_id = None  # Dataset has no organization
-        log.debug("Real resource path is res:%s/%s/%s", organization_id, dataset_id, id)
+    with metrics.timer('object_authz_duration_seconds'):
+        snapshot = getattr(_local, 'snapshot', None)
+        package = snapshot.get_package(dataset_id) if snapshot and dataset_id else None
+        if package is not None:
+            context = snapshot.authz_context(context, package, id)
+            if organization_id == helpers.storage_namespace():
+                dataset_id = package.name
+                organization_id = snapshot.get_organization_name(package)
+                log.debug("Real resource path is res:%s/%s/%s", organization_id, dataset_id, id)
+
+        elif dataset_id and organization_id and organization_id == helpers.storage_namespace():
+            log.debug("Requesting authorization for object: %s/%s in namespace %s", dataset_id, id, organization_id)
+            dataset = metrics.call_action('package_show', context, {'id': dataset_id})
+            dataset_id = dataset['name']
+            try:
+                organization_id = dataset['organization']['name']
+            except (KeyError, TypeError):
+                organization_id = None  # Dataset has no organization
+            log.debug("Real resource path is res:%s/%s/%s", organization_id, dataset_id, id)
+
+        return resource_authz.check_resource_permissions(id, dataset_id, organization_id, context=context)
+
+
+@contextmanager
+def object_scopes_snapshot(scopes):
+    # type: (Iterable[str]) -> Generator[ObjectScopesSnapshot, None, None]
+    """Load all datasets, organizations and resources referenced by ``obj`` scopes in bulk
+
+    While this context manager is active, object permission checks and scope
+    normalization in the current thread use the loaded snapshot, so that
+    authorizing many object scopes at once takes a constant number of queries.
+    """
+    previous = getattr(_local, 'snapshot', None)
+    _local.snapshot = ObjectScopesSnapshot(scopes)
+    try:
+        yield _local.snapshot
+    finally:
+        _local.snapshot = previous
+
+
+class ObjectScopesSnapshot(object):
+    """Datasets, organizations and resources referenced by a batch of ``obj`` scopes
+    """
 
-    return resource_authz.check_resource_permissions(id, dataset_id, organization_id, context=context)
+    def __init__(self, scopes):
+        # type: (Iterable[str]) -> None
+        refs = [ref for ref in (_parse_object_scope(scope) for scope in scopes) if ref]
+        dataset_keys = {ref[1] for ref in refs if ref[1] not in {'', '*'}}
+        resource_ids = {ref[2] for ref in refs if ref[2] not in {None, '', '*'}}
+
+        self._packages = {}  # type: Dict[str, model.Package]
+        self._organization_names = {}  # type: Dict[str, str]
+        self._resources = {}  # type: Dict[str, model.Resource]
+        if not dataset_keys:
+            return
+
+        query = model.Session.query(model.Package).filter(
+            or_(model.Package.id.in_(dataset_keys), model.Package.name.in_(dataset_keys)))
+        for package in query:
+            self._packages[package.id] = package
+            self._packages[package.name] = package
+
+        org_ids = {p.owner_org for p in self._packages.values() if p.owner_org}
+        if org_ids:
+            query = model.Session.query(model.Group.id, model.Group.name).filter(model.Group.id.in_(org_ids))
+            self._organization_names = dict(query)
+
+        if resource_ids:
+            query = model.Session.query(model.Resource).filter(model.Resource.id.in_(resource_ids),
+                                                               model.Resource.state == 'active')
+            self._resources = {r.id: r for r in query}
+
+    def get_package(self, dataset_id):
+        # type: (str) -> Optional[model.Package]
+        return self._packages.get(dataset_id)
+
+    def get_organization_name(self, package):
+        # type: (model.Package) -> Optional[str]
+        return self._organization_names.get(package.owner_org)
+
+    def get_resource(self, package, resource_id):
+        # type: (model.Package, str) -> Optional[model.Resource]
+        """Get a resource, if it belongs to the given dataset
+        """
+        resource = self._resources.get(resource_id)
+        if resource is not None and resource.package_id == package.id:
+            return resource
+        return None
+
+    def authz_context(self, context, package, resource_id):
+        # type: (Dict[str, Any], model.Package, str) -> Dict[str, Any]
+        """Get a context for CKAN auth functions, with the objects they check preloaded
+
+        Auth functions take the ``package`` and ``resource`` objects from the
+        context if set, instead of loading them. The package is only set if the
+        scope refers to the whole dataset or to a resource of that dataset, so
+        that a resource is never checked against another dataset's permissions.
+        """
+        if resource_id in {None, '', '*'}:
+            return dict(context, package=package)
+        resource = self.get_resource(package, resource_id)
+        if resource is not None:
+            return dict(context, package=package, resource=resource)
+        return context
+
+
+def _parse_object_scope(scope):
+    # type: (str) -> Optional[Tuple[str, str, Optional[str]]]
+    """Get the organization, dataset and resource IDs from an ``obj`` scope string
+
+    >>> _parse_object_scope('obj:myorg/mydataset/*:read')
+    ('myorg', 'mydataset', '*')
+    >>> _parse_object_scope('obj:myorg/mydataset/some-resource/some-activity:read,write')
+    ('myorg', 'mydataset', 'some-resource')
+    >>> _parse_object_scope('obj:myorg/mydataset')
+    ('myorg', 'mydataset', None)
+    >>> _parse_object_scope('res:myorg/mydataset/*:read')
+    """
+    parts = str(scope).split(':')
+    if len(parts) < 2 or parts[0] != 'obj':
+        return None
+    ref = parts[1].split('/')
+    if len(ref) < 2:
+        return None
+    return ref[0], ref[1], ref[2] if len(ref) > 2 else None
 
 
 def object_id_parser(*args, **kwargs):
@@ -84,14 +209,32 @@ def _get_resource_storage_id(organization_id, dataset_id, resource_id, activity_
     <org_id>/<dataset_id> that the dataset had *when it was originally uploaded*, and
     does not change over time.
     """
+    snapshot = getattr(_local, 'snapshot', None)
+    package = snapshot.get_package(dataset_id) if snapshot and not activity_id else None
+    resource = snapshot.get_resource(package, resource_id) if package is not None else None
+    if resource is not None:
+        if resource.extras.get('sha256') and resource.extras.get('lfs_prefix'):
+            return '{}/{}'.format(resource.extras['lfs_prefix'], resource.extras['sha256'])
+        return '{}/{}/{}'.format(organization_id, dataset_id, resource_id)
+
     context = get_user_context()
     if activity_id and toolkit.check_ckan_version(min_version='2.9'):
-        activity = toolkit.get_action(u'activity_show')(
-                    context, {u'id': activity_id, u'include_data': True})
-        dataset = activity['data']['package']
-    else:
-        dataset = toolkit.get_action('package_show')(context, {'id': dataset_id})
-
+        # Resources in an activity never change, so their storage ID can be cached
+        storage_ids = cache.get_cache('activity_storage_ids')
+        key = (organization_id, dataset_id, resource_id, activity_id)
+        storage_id = storage_ids.get(key)
+        if storage_id is None:
+            activity = metrics.call_action(u'activity_show', context, {u'id': activity_id, u'include_data': True})
+            storage_id = _storage_id(activity['data']['package'], organization_id, dataset_id, resource_id)
+            storage_ids.set(key, storage_id)
+        return storage_id
+
+    dataset = metrics.call_action('package_show', context, {'id': dataset_id})
+    return _storage_id(dataset, organization_id, dataset_id, resource_id)
+
+
+def _storage_id(dataset, organization_id, dataset_id, resource_id):
+    # type: (Dict[str, Any], str, str, str) -> str
     resource = None
     for res in dataset['resources']:
         if res['id'] == resource_id:
@@ -1,30 +1,54 @@
 """ckanext-blob-storage Flask blueprints
 """
+import os
+from collections import OrderedDict
+from typing import Set
+
 from ckan.plugins import toolkit
-from flask import Blueprint, request
+from flask import Blueprint, Response, request
+
+from . import helpers, metrics, profiling, tracking
+from .download_handler import (_content_disposition, _parse_timestamp, call_download_handlers,
+                               call_pre_download_handlers, get_context, head_response)
 
-from .download_handler import call_download_handlers, call_pre_download_handlers, get_context
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+ZIP_DOWNLOAD_WORKERS_CONF_KEY = 'ckanext.blob_storage.zip_download.workers'
+DEFAULT_ZIP_DOWNLOAD_WORKERS = 4
 
 blueprint = Blueprint(
     'blob_storage',
     __name__,
 )
 
+metrics_blueprint = Blueprint(
+    'blob_storage_metrics',
+    __name__,
+)
+
 
+@profiling.profiled('download')
 def download(id, resource_id, filename=None):
     """Download resource blueprint
 
     This calls all registered download handlers in order, until
-    a response is returned to the user
+    a response is returned to the user. ``HEAD`` requests for files in blob
+    storage are answered directly from the resource's metadata. If the LFS
+    server is unavailable, a ``503`` response with a ``Retry-After`` header
+    is returned.
     """
+    from . import lfs
+    from .actions import StorageUnavailable
+    metrics.start_request_timings()
     context = get_context()
     resource = None
 
     try:
-        resource = toolkit.get_action('resource_show')(context, {'id': resource_id})
+        resource = metrics.call_action('resource_show', context, {'id': resource_id})
         if id != resource['package_id']:
             return toolkit.abort(404, toolkit._('Resource not found belonging to package'))
-        package = toolkit.get_action('package_show')(context, {'id': id})
+        package = metrics.call_action('package_show', context, {'id': id})
+        profiling.annotate(dataset_size=len(package.get('resources', [])))
     except toolkit.ObjectNotFound:
         return toolkit.abort(404, toolkit._('Resource not found'))
     except toolkit.NotAuthorized:
@@ -34,28 +58,192 @@ def download(id, resource_id, filename=None):
     inline = toolkit.asbool(request.args.get('preview'))
 
     if activity_id and toolkit.check_ckan_version(min_version='2.9'):
-        try:
-            activity = toolkit.get_action(u'activity_show')(
-                context, {u'id': activity_id, u'include_data': True})
-            activity_dataset = activity['data']['package']
-            assert activity_dataset['id'] == id
-            activity_resources = activity_dataset['resources']
-            for r in activity_resources:
-                if r['id'] == resource_id:
-                    resource = r
-                    package = activity_dataset
-                    break
-        except toolkit.NotFound:
-            toolkit.abort(404, toolkit._(u'Activity not found'))
+        resource, package = _get_activity_resource(context, activity_id, id, resource, package)
 
     try:
         resource = call_pre_download_handlers(resource, package, activity_id=activity_id)
-        return call_download_handlers(resource, package, filename, inline, activity_id=activity_id)
+        return _download_response(resource, package, filename, inline, activity_id)
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Resource not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(401, toolkit._('Not authorized to read resource {0}'.format(resource_id)))
+    except (lfs.LfsUnavailable, StorageUnavailable) as e:
+        return Response(toolkit._('Storage is temporarily unavailable, please try again later'),
+                        status=503, headers={'Retry-After': str(e.retry_after)}, content_type='text/plain')
+
+
+def _get_activity_resource(context, activity_id, id, resource, package):
+    try:
+        activity = metrics.call_action(u'activity_show', context, {u'id': activity_id, u'include_data': True})
+        activity_dataset = activity['data']['package']
+        assert activity_dataset['id'] == id
+        for r in activity_dataset['resources']:
+            if r['id'] == resource['id']:
+                return r, activity_dataset
+    except toolkit.NotFound:
+        toolkit.abort(404, toolkit._(u'Activity not found'))
+    return resource, package
+
+
+def _download_response(resource, package, filename, inline, activity_id):
+    if request.method == 'HEAD':
+        response = head_response(resource, filename, inline)
+        if response is not None:
+            return response
+    return call_download_handlers(resource, package, filename, inline, activity_id=activity_id)
+
+
+@profiling.profiled('download_zip')
+def download_zip(id):
+    """Download the files of a dataset's resources in blob storage as a single ZIP archive
+
+    All resources are included, unless a subset is requested by ID, as one or
+    more comma separated ``resources`` query arguments. Download URLs for all
+    files are requested in bulk, and the archive is streamed while files are
+    downloaded from storage.
+    """
+    from . import lfs
+    context = get_context()
+    try:
+        package = metrics.call_action('package_show', context, {'id': id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(401, toolkit._('Not authorized to read dataset {0}'.format(id)))
+
+    resource_ids = [r_id for arg in request.args.getlist('resources') for r_id in arg.split(',') if r_id]
+    resources = _zip_resources(package, resource_ids)
+    if not resources:
+        return toolkit.abort(404, toolkit._('No files are available for download'))
+
+    try:
+        specs = _get_lfs_download_specs(context, package, resources)
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Resource not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(401, toolkit._('Not authorized to read dataset {0}'.format(id)))
+    except lfs.LfsUnavailable as e:
+        return Response(toolkit._('Storage is temporarily unavailable, please try again later'),
+                        status=503, headers={'Retry-After': str(e.retry_after)}, content_type='text/plain')
+
+    return _zip_response(package, [r for r in resources if r['id'] in specs], specs)
+
+
+def _zip_resources(package, resource_ids):
+    """Get the resources of a dataset to include in a ZIP archive, in order
+
+    If any of the requested resources is not in blob storage, ``404`` is returned.
+    """
+    resources = [r for r in package.get('resources', [])
+                 if helpers.is_blob_storage_resource(r) and r.get('sha256') and r.get('size')]
+    if not resource_ids:
+        return resources
+    by_id = {r['id']: r for r in resources}
+    missing = [r_id for r_id in resource_ids if r_id not in by_id]
+    if missing:
+        return toolkit.abort(404, toolkit._('Resource not found: {0}'.format(', '.join(missing))))
+    return [by_id[r_id] for r_id in OrderedDict.fromkeys(resource_ids)]
+
+
+def _get_lfs_download_specs(context, package, resources):
+    from .actions import get_lfs_download_specs
+    return get_lfs_download_specs(context, package, resources)
+
+
+def _zip_response(package, resources, specs):
+    from . import zipstream
+    files = []
+    names = set()  # type: Set[str]
+    for resource in resources:
+        files.append({'name': _zip_member_name(resource, names),
+                      'size': resource['size'],
+                      'sha256': resource['sha256'],
+                      'action': specs[resource['id']],
+                      'date_time': _parse_timestamp(resource.get('last_modified') or resource.get('created'))})
+        tracking.record_download(resource['id'], package['id'])
+    metrics.increment('downloads_total', outcome='zip')
+
+    def fetch(f):
+        return zipstream.download_chunks(f['action'], f['sha256'], f['size'])
+
+    workers = toolkit.asint(toolkit.config.get(ZIP_DOWNLOAD_WORKERS_CONF_KEY, DEFAULT_ZIP_DOWNLOAD_WORKERS))
+    response = Response(zipstream.stream_zip(files, fetch, workers=workers), content_type='application/zip',
+                        direct_passthrough=True)
+    response.headers['Content-Length'] = str(zipstream.archive_size((f['name'], f['size']) for f in files))
+    response.headers['Content-Disposition'] = _content_disposition('{}.zip'.format(package['name']))
+    return response
+
+
+def _zip_member_name(resource, names):
+    """Get a unique file name for a resource in a ZIP archive, and add it to ``names``
+
+    >>> names = set()
+    >>> _zip_member_name({'id': '1', 'url': 'https://example.com/data/data.csv'}, names)
+    'data.csv'
+    >>> _zip_member_name({'id': '2', 'url': 'data.csv'}, names)
+    'data (2).csv'
+    >>> _zip_member_name({'id': '3', 'url': '../'}, names)
+    '3'
+    """
+    name = helpers.resource_filename(resource).replace('\\', '/').rsplit('/', 1)[-1].strip()
+    if name in {'', '.', '..'}:
+        name = resource['id']
+    base, ext = os.path.splitext(name)
+    unique_name = name
+    i = 2
+    while unique_name in names:
+        unique_name = '{} ({}){}'.format(base, i, ext)
+        i += 1
+    names.add(unique_name)
+    return unique_name
+
+
+def resource_field_json(id, resource_id, field):
+    """Get a resource's schema or sample as JSON
+
+    This returns the same values as the ``resource_schema_show`` and
+    ``resource_sample_show`` actions (without pagination), but serialized
+    only once, and cached.
+    """
+    from .actions import serialize_resource_field
+    context = get_context()
+    try:
+        resource = metrics.call_action('resource_show', context, {'id': resource_id})
+        if id != resource['package_id']:
+            return toolkit.abort(404, toolkit._('Resource not found belonging to package'))
+        body = serialize_resource_field(resource, field)
     except toolkit.ObjectNotFound:
         return toolkit.abort(404, toolkit._('Resource not found'))
     except toolkit.NotAuthorized:
         return toolkit.abort(401, toolkit._('Not authorized to read resource {0}'.format(resource_id)))
+    except toolkit.ValidationError as e:
+        return toolkit.abort(400, u' '.join(u' '.join(errors) for errors in e.error_dict.values()))
+    return Response(body, content_type='application/json')
+
+
+@blueprint.after_app_request
+def add_server_timing_header(response):
+    """Add a Server-Timing header to responses for which timings were recorded
+    """
+    timings = metrics.request_timings()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing_header()
+    return response
 
 
 blueprint.add_url_rule(u'/dataset/<id>/resource/<resource_id>/download', view_func=download)
 blueprint.add_url_rule(u'/dataset/<id>/resource/<resource_id>/download/<filename>', view_func=download)
+blueprint.add_url_rule(u'/dataset/<id>/download.zip', view_func=download_zip)
+blueprint.add_url_rule(u'/dataset/<id>/resource/<resource_id>/schema.json', endpoint='resource_schema_json',
+                       view_func=resource_field_json, defaults={'field': 'schema'})
+blueprint.add_url_rule(u'/dataset/<id>/resource/<resource_id>/sample.json', endpoint='resource_sample_json',
+                       view_func=resource_field_json, defaults={'field': 'sample'})
+
+
+def prometheus_metrics():
+    """Expose collected blob storage metrics in the Prometheus text format
+    """
+    return Response(metrics.prometheus_registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+metrics_blueprint.add_url_rule(u'/blob-storage/metrics', view_func=prometheus_metrics)
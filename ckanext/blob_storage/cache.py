@@ -0,0 +1,423 @@
+"""Caching utilities for ckanext-blob-storage
+
+Caches are kept in memory by each worker process by default. Set
+``ckanext.blob_storage.cache.backend = redis`` to share them between all
+workers and nodes using Redis (``ckanext.blob_storage.cache.redis_url``, or
+CKAN's own ``ckan.redis.url`` if not set).
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Optional, Union
+
+from ckan.plugins import toolkit
+from six import ensure_binary, ensure_text
+
+from . import metrics
+
+# redis is only imported when the redis backend is used
+if TYPE_CHECKING:
+    import redis  # noqa: F401
+
+CACHE_BACKEND_CONF_KEY = 'ckanext.blob_storage.cache.backend'
+CACHE_NAMESPACE_CONF_KEY = 'ckanext.blob_storage.cache.namespace'
+CACHE_REDIS_URL_CONF_KEY = 'ckanext.blob_storage.cache.redis_url'
+CACHE_DEFAULT_TTL_CONF_KEY = 'ckanext.blob_storage.cache.default_ttl'
+SINGLE_FLIGHT_TIMEOUT_CONF_KEY = 'ckanext.blob_storage.cache.single_flight_timeout'
+
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_SINGLE_FLIGHT_TIMEOUT = 10
+
+# Interval, in seconds, at which workers waiting for a call in another worker check for its result
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+
+# Serialized values longer than this many bytes are compressed
+COMPRESS_MIN_SIZE = 512
+
+# Serialized keys longer than this many characters are hashed
+MAX_KEY_LENGTH = 200
+
+log = logging.getLogger(__name__)
+
+_caches = {}  # type: Dict[str, Union[LRUCache, RedisCache]]
+_caches_lock = threading.Lock()
+
+_single_flights = {}  # type: Dict[str, Union[SingleFlight, RedisSingleFlight]]
+
+
+class LRUCache(object):
+    """A thread safe, in-process, least-recently-used cache with optional per-entry TTL
+
+    Cache hits and misses are reported as the ``cache_requests_total``
+    metric, labeled with the cache name.
+
+    Note that cached values are not copied; Callers must treat values they
+    get from the cache as read only.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=None):
+        # type: (str, int, Optional[float]) -> None
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # type: OrderedDict
+
+    def get(self, key, default=None):
+        # type: (Hashable, Any) -> Any
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                self._entries[key] = entry
+            else:
+                entry = None
+
+        metrics.increment('cache_requests_total', cache=self.name, result='miss' if entry is None else 'hit')
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        # type: (Hashable, Any, Optional[float]) -> None
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        # type: (Hashable) -> None
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(object):
+    """A cache shared by all workers, stored in Redis
+
+    This has the same interface as :class:`LRUCache`. Keys and values must
+    be JSON serializable; Values which are not are not cached. Tuples are
+    returned as lists. Entries without a TTL expire after
+    ``ckanext.blob_storage.cache.default_ttl`` seconds, and the cache size is
+    only limited by Redis' own eviction policy.
+
+    Redis errors are logged and treated as cache misses, so that Redis being
+    down does not break anything but performance.
+    """
+
+    def __init__(self, name, client, namespace, ttl=None, default_ttl=DEFAULT_CACHE_TTL):
+        # type: (str, redis.StrictRedis, str, Optional[float], Optional[float]) -> None
+        from redis import RedisError
+        self.name = name
+        self.ttl = ttl
+        self.default_ttl = default_ttl
+        self._client = client
+        self._prefix = '{}:{}:'.format(namespace, name)
+        self._redis_error = RedisError
+
+    def get(self, key, default=None):
+        # type: (Hashable, Any) -> Any
+        try:
+            data = self._client.get(self._key(key))
+            result = 'miss' if data is None else 'hit'
+        except self._redis_error as e:
+            log.warning("Failed getting %s from cache: %s", self.name, e)
+            data = None
+            result = 'error'
+
+        metrics.increment('cache_requests_total', cache=self.name, result=result)
+        return default if data is None else loads(data)
+
+    def set(self, key, value, ttl=None):
+        # type: (Hashable, Any, Optional[float]) -> None
+        ttl = ttl or self.ttl or self.default_ttl
+        try:
+            data = dumps(value)
+        except (TypeError, ValueError):
+            log.debug("Not caching %s value which is not JSON serializable", self.name)
+            return
+        try:
+            self._client.set(self._key(key), data, px=int(ttl * 1000) if ttl else None)
+        except self._redis_error as e:
+            log.warning("Failed setting %s in cache: %s", self.name, e)
+
+    def delete(self, key):
+        # type: (Hashable) -> None
+        try:
+            self._client.delete(self._key(key))
+        except self._redis_error as e:
+            log.warning("Failed deleting %s from cache: %s", self.name, e)
+
+    def clear(self):
+        # type: () -> None
+        keys = list(self._client.scan_iter(match='{}*'.format(self._prefix)))
+        if keys:
+            self._client.delete(*keys)
+
+    def __len__(self):
+        return sum(1 for _ in self._client.scan_iter(match='{}*'.format(self._prefix)))
+
+    def _key(self, key):
+        # type: (Hashable) -> str
+        return self._prefix + serialize_key(key)
+
+
+def serialize_key(key):
+    # type: (Hashable) -> str
+    """Get a compact string representation of a cache key
+
+    >>> serialize_key(('jane', 'ckan/dataset', None, 10, True))
+    '["jane","ckan/dataset",null,10,true]'
+    >>> len(serialize_key('x' * 1000))
+    40
+    """
+    serialized = json.dumps(key, separators=(',', ':'), sort_keys=True)
+    if len(serialized) > MAX_KEY_LENGTH:
+        return hashlib.sha1(ensure_binary(serialized)).hexdigest()
+    return serialized
+
+
+def dumps(value):
+    # type: (Any) -> bytes
+    """Serialize a value to be cached, compressing it if it is large
+
+    >>> loads(dumps({'fields': [{'name': 'id'}]}))
+    {'fields': [{'name': 'id'}]}
+    >>> loads(dumps(['x' * 1000])) == ['x' * 1000]
+    True
+    """
+    data = ensure_binary(json.dumps(value, separators=(',', ':')))
+    if len(data) > COMPRESS_MIN_SIZE:
+        return b'z' + zlib.compress(data)
+    return b'j' + data
+
+
+def loads(data):
+    # type: (bytes) -> Any
+    """Deserialize a value serialized by :func:`dumps`
+    """
+    if data[0:1] == b'z':
+        return json.loads(ensure_text(zlib.decompress(data[1:])))
+    return json.loads(ensure_text(data[1:]))
+
+
+def get_cache(name, maxsize=1024, ttl=None):
+    # type: (str, int, Optional[float]) -> Union[LRUCache, RedisCache]
+    """Get a named cache, creating it on first use with the configured backend
+
+    ``maxsize`` and ``ttl`` only take effect when the cache is created;
+    ``maxsize`` is ignored by the ``redis`` backend.
+    """
+    cache = _caches.get(name)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(name)
+            if cache is None:
+                cache = _caches[name] = _create_cache(name, maxsize, ttl)
+    return cache
+
+
+def _create_cache(name, maxsize, ttl):
+    # type: (str, int, Optional[float]) -> Union[LRUCache, RedisCache]
+    backend = _backend()
+    if backend == 'memory':
+        return LRUCache(name, maxsize=maxsize, ttl=ttl)
+    default_ttl = toolkit.asint(toolkit.config.get(CACHE_DEFAULT_TTL_CONF_KEY, DEFAULT_CACHE_TTL))
+    return RedisCache(name, _get_redis_client(), _namespace(), ttl=ttl, default_ttl=default_ttl)
+
+
+def _backend():
+    # type: () -> str
+    backend = toolkit.config.get(CACHE_BACKEND_CONF_KEY, 'memory')
+    if backend not in ('memory', 'redis'):
+        raise ValueError('Unknown cache backend: {}'.format(backend))
+    return backend
+
+
+def _namespace():
+    # type: () -> str
+    return toolkit.config.get(CACHE_NAMESPACE_CONF_KEY) or \
+        'blob_storage:{}'.format(toolkit.config.get('ckan.site_id', 'default'))
+
+
+def _get_redis_client():
+    # type: () -> redis.StrictRedis
+    url = toolkit.config.get(CACHE_REDIS_URL_CONF_KEY)
+    if url:
+        import redis
+        return redis.StrictRedis.from_url(url)
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+class SingleFlight(object):
+    """Coalesce concurrent identical calls in a process into one
+
+    While a call for a key is in progress, other threads calling :meth:`do`
+    with the same key wait for it to finish and get its result, or its
+    exception, instead of making the same call. Calls are reported as the
+    ``single_flight_calls_total`` metric, labeled with ``result=executed`` or
+    ``result=shared``.
+
+    As with :class:`LRUCache`, shared results must be treated as read only.
+    See :class:`RedisSingleFlight` for coalescing calls across processes.
+    """
+
+    def __init__(self, name):
+        # type: (str) -> None
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}  # type: Dict[Hashable, _Call]
+
+    def do(self, key, func, *args, **kwargs):
+        # type: (Hashable, Callable, Any, Any) -> Any
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.increment('single_flight_calls_total', call=self.name, result='shared')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._execute(key, func, *args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _execute(self, key, func, *args, **kwargs):
+        # type: (Hashable, Callable, Any, Any) -> Any
+        metrics.increment('single_flight_calls_total', call=self.name, result='executed')
+        return func(*args, **kwargs)
+
+
+class RedisSingleFlight(SingleFlight):
+    """Coalesce concurrent identical calls in all processes sharing a Redis server into one
+
+    Calls are first coalesced in each process, as by :class:`SingleFlight`.
+    Then, the process making the call takes a lock on the key in Redis
+    (``SET NX``), and stores the result once done. Processes which find the
+    key locked wait for the result instead of making the call, for up to
+    ``timeout`` seconds. If the call fails, or the result is not JSON
+    serializable, waiting processes make the call themselves once the lock is
+    released. Results are shared in the same form as by :class:`RedisCache`.
+
+    If Redis is unavailable, calls are only coalesced within each process.
+    """
+
+    def __init__(self, name, client, namespace, timeout=DEFAULT_SINGLE_FLIGHT_TIMEOUT):
+        # type: (str, redis.StrictRedis, str, float) -> None
+        from redis import RedisError
+        super(RedisSingleFlight, self).__init__(name)
+        self.timeout = timeout
+        self._client = client
+        self._prefix = '{}:single_flight:{}:'.format(namespace, name)
+        self._redis_error = RedisError
+
+    def _execute(self, key, func, *args, **kwargs):
+        # type: (Hashable, Callable, Any, Any) -> Any
+        lock_key = '{}lock:{}'.format(self._prefix, serialize_key(key))
+        result_key = '{}result:{}'.format(self._prefix, serialize_key(key))
+        token = ensure_binary(uuid.uuid4().hex)
+        deadline = time.time() + self.timeout
+        waited = False
+        try:
+            while True:
+                if waited:
+                    # Results are stored before the lock is released
+                    data = self._client.get(result_key)
+                    if data is not None:
+                        metrics.increment('single_flight_calls_total', call=self.name, result='shared')
+                        return loads(data)
+                if self._client.set(lock_key, token, nx=True, px=int(self.timeout * 1000)):
+                    break
+                if time.time() >= deadline:
+                    log.debug("Timed out waiting for %s call in another process", self.name)
+                    return super(RedisSingleFlight, self)._execute(key, func, *args, **kwargs)
+                waited = True
+                time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        except self._redis_error as e:
+            log.warning("Failed coalescing %s call using Redis: %s", self.name, e)
+            return super(RedisSingleFlight, self)._execute(key, func, *args, **kwargs)
+
+        try:
+            result = super(RedisSingleFlight, self)._execute(key, func, *args, **kwargs)
+            self._store_result(result_key, result)
+            return result
+        finally:
+            self._release(lock_key, token)
+
+    def _store_result(self, result_key, result):
+        # type: (str, Any) -> None
+        try:
+            data = dumps(result)
+        except (TypeError, ValueError):
+            log.debug("Not sharing %s result which is not JSON serializable", self.name)
+            return
+        try:
+            # Results only need to be kept for processes already waiting for them
+            self._client.set(result_key, data, px=int(self.timeout * 1000))
+        except self._redis_error as e:
+            log.warning("Failed sharing %s result: %s", self.name, e)
+
+    def _release(self, lock_key, token):
+        # type: (str, bytes) -> None
+        try:
+            if self._client.get(lock_key) == token:
+                self._client.delete(lock_key)
+        except self._redis_error as e:
+            log.warning("Failed releasing %s lock: %s", self.name, e)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None  # type: Any
+        self.error = None  # type: Optional[Exception]
+
+
+def get_single_flight(name):
+    # type: (str) -> Union[SingleFlight, RedisSingleFlight]
+    """Get a named :class:`SingleFlight`, creating it on first use
+
+    With the ``redis`` cache backend, a :class:`RedisSingleFlight` is used to
+    coalesce calls across all workers.
+    """
+    single_flight = _single_flights.get(name)
+    if single_flight is None:
+        with _caches_lock:
+            single_flight = _single_flights.get(name)
+            if single_flight is None:
+                single_flight = _single_flights[name] = _create_single_flight(name)
+    return single_flight
+
+
+def _create_single_flight(name):
+    # type: (str) -> Union[SingleFlight, RedisSingleFlight]
+    if _backend() == 'memory':
+        return SingleFlight(name)
+    timeout = float(toolkit.config.get(SINGLE_FLIGHT_TIMEOUT_CONF_KEY, DEFAULT_SINGLE_FLIGHT_TIMEOUT))
+    return RedisSingleFlight(name, _get_redis_client(), _namespace(), timeout=timeout)
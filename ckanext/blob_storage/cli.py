@@ -1,35 +1,135 @@
 import errno
+import hashlib
 import logging
 import os
 import shutil
+import sys
 import tempfile
 import time
+from collections import deque
 from contextlib import contextmanager
-from typing import Any, Dict, Generator, Tuple
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Dict, Generator, Iterable, Optional, Set, Tuple
 
-import requests
 from ckan.lib.cli import CkanCommand
-from ckan.lib.helpers import _get_auto_flask_context  # noqa  we need this for Flask request context
-from ckan.model import Resource, Session, User
 from ckan.plugins import toolkit
-from flask import Response
-from giftless_client import LfsClient
-from giftless_client.types import ObjectAttributes
 from six import binary_type, string_types
-from sqlalchemy.orm import load_only
-from sqlalchemy.orm.attributes import flag_modified
-from werkzeug.wsgi import FileWrapper
+from six.moves.urllib.parse import urljoin, urlparse
 
 from ckanext.blob_storage import helpers
-from ckanext.blob_storage.download_handler import call_download_handlers
+
+# Heavy dependencies are imported where they are used, to keep loading
+# this module (e.g. when paster lists available commands) fast
+if TYPE_CHECKING:
+    from ckan.model import Resource  # noqa: F401
+    from flask import Response  # noqa: F401
+    from giftless_client.types import ObjectAttributes  # noqa: F401
 
 
 def _log():
     return logging.getLogger(__name__)
 
 
+DEFAULT_LINKED_MAX_SIZE_MB = 100
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_REINDEX_EVERY = 1000
+LINKED_RESOURCES_PAGE_SIZE = 1000
+
+# Connect and read timeouts, in seconds, for fetching linked resources
+LINKED_FETCH_TIMEOUT = (10, 60)
+LINKED_FETCH_MAX_REDIRECTS = 5
+
+
+class DeferredReindex(object):
+    """Datasets to reindex in bulk once changes to their resources are committed
+
+    Each dataset is reindexed once, no matter how many of its resources
+    changed, once changes to ``every`` resources have been committed, and
+    when :meth:`flush` is called.
+    """
+
+    def __init__(self, every):
+        # type: (int) -> None
+        self.every = every
+        self._pending = set()  # type: Set[str]
+        self._committed = set()  # type: Set[str]
+        self._committed_count = 0
+        self._pending_count = 0
+
+    def add(self, dataset_id):
+        # type: (str) -> None
+        """Add the dataset of a changed, not yet committed resource
+        """
+        self._pending.add(dataset_id)
+        self._pending_count += 1
+
+    def committed(self):
+        # type: () -> None
+        """Mark changes added so far as committed, and reindex datasets if enough were
+        """
+        self._committed.update(self._pending)
+        self._committed_count += self._pending_count
+        self._pending = set()
+        self._pending_count = 0
+        if self._committed_count >= self.every:
+            self.flush()
+
+    def flush(self):
+        # type: () -> None
+        """Reindex the datasets of all committed changes
+        """
+        if not self._committed:
+            return
+        from ckan.lib import search
+        dataset_ids = sorted(self._committed)
+        _log().info("Reindexing %d datasets", len(dataset_ids))
+        search.rebuild(package_ids=dataset_ids, force=True, defer_commit=True)
+        search.commit()
+        self._committed = set()
+        self._committed_count = 0
+
+
+class LinkedResourceError(Exception):
+    """A linked resource cannot be ingested
+    """
+
+
+class BlobStorageCommand(CkanCommand):
+    """Manage the ckanext-blob-storage database tables
+
+    Usage: blob-storage initdb
+
+    initdb - create the database tables used by this extension, if they do
+             not exist yet
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 1
+    max_args = 1
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0]
+        if cmd == 'initdb':
+            from ckanext.blob_storage import model
+            model.create_tables()
+            _log().info("Blob storage tables are initialized")
+        else:
+            self.parser.error('Unknown command: {}'.format(cmd))
+
+
 class MigrateResourcesCommand(CkanCommand):
     """Migrate all non-migrated resources to external blob storage
+
+    With --include-linked, resources linking to files on one of the domains
+    given with --linked-domain (or their subdomains) are also ingested: The
+    files are fetched, up to --linked-max-size MB, by --workers parallel
+    workers, and uploaded to blob storage. Their original URL is kept.
+
+    With --relink, resources whose file is already in storage under another
+    prefix (e.g. after the storage namespace was changed, or the resource was
+    moved to another dataset) are not uploaded again: Their file is kept where
+    it is, and they are only marked as migrated.
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -39,38 +139,85 @@ class MigrateResourcesCommand(CkanCommand):
     _max_failures = 3
     _retry_delay = 3
 
+    def __init__(self, name):
+        super(MigrateResourcesCommand, self).__init__(name)
+        _add_option(self.parser, '--include-linked', dest='include_linked', action='store_true', default=False,
+                    help='Also ingest linked resources from allowed domains')
+        _add_option(self.parser, '--linked-domain', dest='linked_domains', action='append', default=[],
+                    help='Domain to ingest linked resources from; Can be used more than once')
+        _add_option(self.parser, '--linked-max-size', dest='linked_max_size', type='int',
+                    default=DEFAULT_LINKED_MAX_SIZE_MB,
+                    help='Maximal size of ingested linked resources, in MB')
+        _add_option(self.parser, '--workers', dest='workers', type='int', default=DEFAULT_WORKERS,
+                    help='Number of files to transfer in parallel')
+        _add_option(self.parser, '--relink', dest='relink', action='store_true', default=False,
+                    help='Keep files already in storage under another prefix where they are')
+        _add_option(self.parser, '--batch-size', dest='batch_size', type='int', default=DEFAULT_BATCH_SIZE,
+                    help='Number of migrated resources to commit together')
+        _add_option(self.parser, '--reindex-every', dest='reindex_every', type='int', default=DEFAULT_REINDEX_EVERY,
+                    help='Reindex datasets once this many resources have been migrated')
+
     def command(self):
+        from ckan.model import User
         self._load_config()
+        if self.options.include_linked and not self.options.linked_domains:
+            self.parser.error('--include-linked requires at least one --linked-domain')
+
         self._user = User.get(self.site_user['name'])
         with app_context() as context:
             context.g.user = self.site_user['name']
             context.g.userobj = self._user
-            self.migrate_all_resources()
-
-    def migrate_all_resources(self):
+            self.migrate_all_resources(relink=self.options.relink,
+                                       batch_size=self.options.batch_size,
+                                       reindex_every=self.options.reindex_every)
+            if self.options.include_linked:
+                self.ingest_linked_resources(self.options.linked_domains,
+                                             self.options.linked_max_size * 1024 * 1024,
+                                             self.options.workers,
+                                             reindex_every=self.options.reindex_every)
+
+    def migrate_all_resources(self, relink=False, batch_size=DEFAULT_BATCH_SIZE, reindex_every=DEFAULT_REINDEX_EVERY):
+        # type: (bool, int, int) -> None
         """Do the actual migration
+
+        Changes to up to ``batch_size`` resources are committed together. The
+        datasets of migrated resources are reindexed in bulk once
+        ``reindex_every`` resources have been committed, and at the end.
         """
+        from ckanext.blob_storage import metrics
         migrated = 0
-        for resource_obj in get_unmigrated_resources():
+        reindex = DeferredReindex(reindex_every)
+        for resource_obj in get_unmigrated_resources(batch_size=batch_size, on_commit=reindex.committed):
             _log().info("Starting to migrate resource %s [%s]", resource_obj.id, resource_obj.name)
             failed = 0
             while failed < self._max_failures:
                 try:
-                    self.migrate_resource(resource_obj)
+                    with metrics.timer('migrate_resource_duration_seconds'):
+                        result = self.migrate_resource(resource_obj, relink=relink)
                     _log().info("Finished migrating resource %s", resource_obj.id)
+                    metrics.increment('migrated_resources_total', result=result)
+                    reindex.add(resource_obj.package_id)
                     migrated += 1
                     break
                 except Exception:
                     _log().exception("Failed to migrate resource %s, retrying...", resource_obj.id)
+                    metrics.increment('migrated_resources_total', result='retry')
                     failed += 1
                     time.sleep(self._retry_delay)
             else:
                 _log().error("Skipping resource %s [%s] after %d failures", resource_obj.id, resource_obj.name, failed)
+                metrics.increment('migrated_resources_total', result='skipped')
 
+        reindex.flush()
         _log().info("Finished migrating %d resources", migrated)
 
-    def migrate_resource(self, resource_obj):
-        # type: (Resource) -> None
+    def migrate_resource(self, resource_obj, relink=False):
+        # type: (Resource, bool) -> str
+        """Migrate a resource, returning ``success``, or ``relinked`` if its file was not moved
+        """
+        if relink and self.relink_resource(resource_obj):
+            return 'relinked'
+
         dataset, resource_dict = get_resource_dataset(resource_obj)
         resource_name = helpers.resource_filename(resource_dict)
 
@@ -83,11 +230,113 @@ class MigrateResourcesCommand(CkanCommand):
             _log().debug("Upload complete; sha256=%s, size=%d", props['sha256'], props['size'])
 
         update_storage_props(resource_obj, props)
+        return 'success'
+
+    def relink_resource(self, resource_obj):
+        # type: (Resource) -> bool
+        """Mark a resource as migrated without moving its file, if it is in storage under its current prefix
+
+        Returns ``False`` if the resource's file is not in storage, or cannot be
+        read, in which case it should be migrated as usual. If the LFS server
+        is unavailable, :exc:`LfsUnavailable` is raised, so that migrating the
+        resource is retried, instead of uploading its file again.
+        """
+        from giftless_client import exc
+        from sqlalchemy.orm.attributes import flag_modified
+
+        from ckanext.blob_storage import lfs
+        lfs_prefix = resource_obj.extras.get('lfs_prefix')
+        sha256 = resource_obj.extras.get('sha256')
+        if not (lfs_prefix and sha256 and resource_obj.size):
+            return False
+
+        try:
+            token = get_authz_token(self._user, 'obj:{}/*:read'.format(lfs_prefix))
+            response = lfs.batch(lfs.get_client(token), lfs_prefix, 'download',
+                                 [{'oid': sha256, 'size': resource_obj.size}], transfers=['basic'])
+        except toolkit.NotAuthorized:
+            _log().info("Cannot read files under %s; Migrating resource %s", lfs_prefix, resource_obj.id)
+            return False
+        except exc.LfsError as e:
+            _log().info("Cannot read files under %s (%s); Migrating resource %s", lfs_prefix, e, resource_obj.id)
+            return False
+
+        object_spec = response['objects'][0]
+        if 'error' in object_spec or 'download' not in object_spec.get('actions', {}):
+            _log().info("File of resource %s is not in storage under %s", resource_obj.id, lfs_prefix)
+            return False
+
+        resource_obj.extras['lfs_relinked_prefix'] = _expected_prefix(resource_obj.package_id)
+        flag_modified(resource_obj, 'extras')
+        _log().info("File of resource %s is kept under %s", resource_obj.id, lfs_prefix)
+        return True
+
+    def ingest_linked_resources(self, allowed_domains, max_size, workers, reindex_every=DEFAULT_REINDEX_EVERY):
+        # type: (Iterable[str], int, int, int) -> None
+        """Fetch linked resources from allowed domains in parallel, and upload them to blob storage
+
+        Fetching, hashing and uploading is done by a pool of worker threads,
+        while authorization and database updates are done in this thread.
+        Datasets are reindexed once ``reindex_every`` resources have been
+        ingested, and at the end.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        allowed_domains = {d.lower() for d in allowed_domains}
+        lfs_namespace = helpers.storage_namespace()
+        pool = ThreadPool(workers)
+        pending = deque()  # type: deque
+        ingested = 0
+        reindex = DeferredReindex(reindex_every)
+        try:
+            for resource in get_linked_resources(allowed_domains):
+                lfs_prefix = '{}/{}'.format(lfs_namespace, resource['package_id'])
+                token = self.get_upload_authz_token(resource['package_id'])
+                result = pool.apply_async(ingest_linked_resource,
+                                          (resource['url'], lfs_prefix, token, allowed_domains, max_size))
+                pending.append((resource, lfs_prefix, result))
+                # Limit the number of queued resources, so that tokens do not expire while waiting
+                while len(pending) >= workers * 2:
+                    ingested += self._record_ingested(reindex, *pending.popleft())
+            while pending:
+                ingested += self._record_ingested(reindex, *pending.popleft())
+        finally:
+            pool.terminate()
+            reindex.flush()
+
+        _log().info("Finished ingesting %d linked resources", ingested)
+
+    def _record_ingested(self, reindex, resource, lfs_prefix, result):
+        # type: (DeferredReindex, Dict[str, Any], str, Any) -> int
+        from ckanext.blob_storage import metrics
+        try:
+            props = result.get()
+        except LinkedResourceError as e:
+            _log().warning("Skipping linked resource %s: %s", resource['id'], e)
+            metrics.increment('ingested_resources_total', result='skipped')
+            return 0
+        except Exception:
+            _log().exception("Failed to ingest linked resource %s from %s", resource['id'], resource['url'])
+            metrics.increment('ingested_resources_total', result='failed')
+            return 0
+
+        props['lfs_prefix'] = lfs_prefix
+        if not update_linked_resource_storage_props(resource['id'], resource['url'], props):
+            _log().info("Linked resource %s was modified while being ingested, skipping", resource['id'])
+            metrics.increment('ingested_resources_total', result='skipped')
+            return 0
+
+        reindex.add(resource['package_id'])
+        reindex.committed()
+        _log().info("Ingested linked resource %s; sha256=%s, size=%d", resource['id'], props['sha256'], props['size'])
+        metrics.increment('ingested_resources_total', result='success')
+        return 1
 
     def upload_resource(self, resource_file, dataset_id, lfs_namespace, filename):
         # type: (str, str, str, str) -> ObjectAttributes
         """Upload a resource file to new storage using LFS server
         """
+        from giftless_client import LfsClient
         token = self.get_upload_authz_token(dataset_id)
         lfs_client = LfsClient(helpers.server_url(), token)
         with open(resource_file, 'rb') as f:
@@ -100,33 +349,357 @@ class MigrateResourcesCommand(CkanCommand):
         # type: (str) -> str
         """Get an authorization token to upload the file to LFS
         """
-        authorize = toolkit.get_action('authz_authorize')
-        if not authorize:
-            raise RuntimeError("Cannot find authz_authorize; Is ckanext-authz-service installed?")
-
-        context = {'ignore_auth': True, 'auth_user_obj': self._user}
         scope = helpers.resource_authz_scope(dataset_id, actions='write')
-        authz_result = authorize(context, {"scopes": [scope]})
+        return get_authz_token(self._user, scope)
+
+
+class ExportResourcesCommand(CkanCommand):
+    """Export the files of resources in blob storage, e.g. for backups or offline mirrors
+
+    Usage: export-resources [DATASET ...] [--organization=ORG ...] --output=PATH
+
+    Exports the files of the given datasets, and of all active datasets of the
+    given organizations. Files are written to a content addressed layout, along
+    with a manifest.jsonl file listing the metadata of exported resources.
+
+    With --format=dir (the default), files are written to the PATH directory;
+    Files already in it are skipped. With --format=tar, a tar stream is written
+    to the PATH file, or to standard output if PATH is "-"; Files listed in a
+    previous export's manifest, given with --skip-manifest, are skipped.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 0
+
+    _user = None
+
+    def __init__(self, name):
+        super(ExportResourcesCommand, self).__init__(name)
+        _add_option(self.parser, '--organization', dest='organizations', action='append', default=[],
+                    help='Export all datasets of an organization; Can be used more than once')
+        _add_option(self.parser, '--output', dest='output', help='Output directory or file, or "-" for stdout')
+        _add_option(self.parser, '--format', dest='format', type='choice', choices=['dir', 'tar'], default='dir',
+                    help='Output format: "dir" or "tar"')
+        _add_option(self.parser, '--skip-manifest', dest='skip_manifest',
+                    help='Skip files listed in the manifest of a previous export')
+        _add_option(self.parser, '--workers', dest='workers', type='int', default=DEFAULT_WORKERS,
+                    help='Number of files to transfer in parallel')
+
+    def command(self):
+        from ckan.model import User
+
+        from ckanext.blob_storage import export
+        self._load_config()
+        if not self.args and not self.options.organizations:
+            self.parser.error('No datasets or organizations to export')
+        if not self.options.output:
+            self.parser.error('--output is required')
+
+        self._user = User.get(self.site_user['name'])
+        with app_context() as context:
+            context.g.user = self.site_user['name']
+            context.g.userobj = self._user
+            with self._writer() as writer:
+                totals = export.export_resources(self._datasets(), writer, self.get_read_authz_token,
+                                                 workers=self.options.workers)
+
+        _log().info("Finished exporting resources: %d exported, %d already present, %d failed",
+                    totals['exported'], totals['present'], totals['failed'])
+
+    @contextmanager
+    def _writer(self):
+        from ckanext.blob_storage import export
+        if self.options.format == 'dir':
+            writer = export.DirectoryWriter(self.options.output)
+            try:
+                yield writer
+            finally:
+                writer.close()
+            return
+
+        skip = export.read_manifest_digests(self.options.skip_manifest) if self.options.skip_manifest else None
+        if self.options.output == '-':
+            output = getattr(sys.stdout, 'buffer', sys.stdout)
+        else:
+            output = open(self.options.output, 'wb')
+        try:
+            writer = export.TarWriter(output, skip=skip)
+            yield writer
+            writer.close()
+        finally:
+            if self.options.output != '-':
+                output.close()
+
+    def _datasets(self):
+        # type: () -> Generator[Dict[str, Any], None, None]
+        from ckan.model import Package, Session
+        context = {'ignore_auth': True, 'use_cache': False}
+        package_show = toolkit.get_action('package_show')
+        for dataset_id in self.args:
+            yield package_show(dict(context), {'id': dataset_id})
+
+        for org_id in self.options.organizations:
+            org = toolkit.get_action('organization_show')(dict(context), {'id': org_id, 'include_datasets': False})
+            dataset_ids = [row.id for row in Session.query(Package.id).filter(
+                Package.owner_org == org['id'],
+                Package.state == 'active',
+            ).order_by(Package.name)]
+            _log().info("Exporting %d datasets of organization %s", len(dataset_ids), org['name'])
+            for dataset_id in dataset_ids:
+                yield package_show(dict(context), {'id': dataset_id})
+
+    def get_read_authz_token(self, lfs_prefix):
+        # type: (str) -> str
+        """Get an authorization token to read all files with a storage prefix
+        """
+        return get_authz_token(self._user, 'obj:{}/*:read'.format(lfs_prefix))
+
 
-        if not authz_result or not authz_result.get('token', False):
-            raise RuntimeError("Failed to get authorization token for LFS server")
+class InferResourceMetadataCommand(CkanCommand):
+    """Infer the schema and sample of resources in blob storage which are missing them
 
-        if len(authz_result['granted_scopes']) == 0:
-            raise toolkit.NotAuthorized("You are not authorized to upload resources")
+    Usage: infer-resource-metadata [DATASET ...] [--force] [--workers=N]
 
-        return authz_result['token']
+    Resources of the given datasets, or of all active datasets, are processed.
+    Only the beginning of each CSV, TSV or JSON lines file, and the footer of
+    each Parquet file, is fetched from storage, by --workers parallel workers.
+    With --force, existing schemas and samples are replaced.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 0
+
+    def __init__(self, name):
+        super(InferResourceMetadataCommand, self).__init__(name)
+        _add_option(self.parser, '--force', dest='force', action='store_true', default=False,
+                    help='Replace existing schemas and samples')
+        _add_option(self.parser, '--workers', dest='workers', type='int', default=DEFAULT_WORKERS,
+                    help='Number of files to fetch in parallel')
+
+    def command(self):
+        from ckan.model import User
+        self._load_config()
+        with app_context() as context:
+            context.g.user = self.site_user['name']
+            context.g.userobj = User.get(self.site_user['name'])
+            self.infer_all(self._resources(), force=self.options.force, workers=self.options.workers)
+
+    def infer_all(self, resources, force=False, workers=DEFAULT_WORKERS):
+        # type: (Iterable[Dict[str, Any]], bool, int) -> Dict[str, int]
+        """Infer the schema and sample of resources, fetching files in parallel
+
+        Download URLs are requested and inferred values are saved in this
+        thread, while files are fetched by a pool of worker threads.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        from ckanext.blob_storage import inference
+        from ckanext.blob_storage.actions import get_lfs_download_spec
+
+        context = {'user': self.site_user['name'], 'ignore_auth': True}
+        totals = {'success': 0, 'skipped': 0, 'failed': 0}
+        pool = ThreadPool(workers)
+        pending = deque()  # type: deque
+        try:
+            for resource in resources:
+                try:
+                    action = get_lfs_download_spec(dict(context), resource)
+                except Exception:
+                    _log().exception("Failed getting download URL of resource %s", resource['id'])
+                    totals[_record_inference(resource, 'failed')] += 1
+                    continue
+                pending.append((resource, pool.apply_async(inference.infer_resource, (resource, action))))
+                # Limit the number of queued resources, so that download URLs do not expire while waiting
+                while len(pending) >= workers * 2:
+                    totals[self._save_inferred(context, force, *pending.popleft())] += 1
+            while pending:
+                totals[self._save_inferred(context, force, *pending.popleft())] += 1
+        finally:
+            pool.terminate()
+
+        _log().info("Finished inferring schemas and samples: %d updated, %d skipped, %d failed",
+                    totals['success'], totals['skipped'], totals['failed'])
+        return totals
+
+    def _save_inferred(self, context, force, resource, result):
+        # type: (Dict[str, Any], bool, Dict[str, Any], Any) -> str
+        from ckanext.blob_storage import inference
+        try:
+            values = inference.save_inferred(context, resource, result.get(), force=force)
+        except inference.InferenceError as e:
+            _log().info("Could not infer schema and sample of resource %s: %s", resource['id'], e)
+            return _record_inference(resource, 'skipped')
+        except Exception:
+            _log().exception("Failed inferring schema and sample of resource %s", resource['id'])
+            return _record_inference(resource, 'failed')
+        _log().debug("Inferred %s of resource %s", ', '.join(sorted(values)) or 'nothing', resource['id'])
+        return 'success' if values else 'skipped'
+
+    def _resources(self):
+        # type: () -> Generator[Dict[str, Any], None, None]
+        from ckan.model import Package, Session
+
+        from ckanext.blob_storage import inference
+        context = {'ignore_auth': True, 'use_cache': False}
+        package_show = toolkit.get_action('package_show')
+        dataset_ids = self.args or [row.id for row in Session.query(Package.id).filter(
+            Package.state == 'active',
+        ).order_by(Package.name)]
+        for dataset_id in dataset_ids:
+            for resource in package_show(dict(context), {'id': dataset_id}).get('resources', []):
+                if inference.needs_inference(resource) or (self.options.force and inference.can_infer(resource)):
+                    yield resource
+
+
+def _record_inference(resource, result):
+    # type: (Dict[str, Any], str) -> str
+    from ckanext.blob_storage import inference, metrics
+    metrics.increment('inferred_resources_total', format=inference.detect_format(resource), result=result)
+    return result
+
+
+def get_authz_token(user, scope):
+    # type: (Any, str) -> str
+    """Get an authorization token for the LFS server, for a scope which must be granted
+    """
+    authorize = toolkit.get_action('authz_authorize')
+    if not authorize:
+        raise RuntimeError("Cannot find authz_authorize; Is ckanext-authz-service installed?")
+
+    context = {'ignore_auth': True, 'auth_user_obj': user}
+    authz_result = authorize(context, {"scopes": [scope]})
+
+    if not authz_result or not authz_result.get('token', False):
+        raise RuntimeError("Failed to get authorization token for LFS server")
+
+    if len(authz_result['granted_scopes']) == 0:
+        raise toolkit.NotAuthorized("You are not authorized to access {}".format(scope))
+
+    return authz_result['token']
+
+
+def _add_option(parser, *args, **kwargs):
+    """Add an option to a command's parser, unless it was already added
+
+    Paster command parsers are shared by all instances of a command, and by
+    all commands.
+    """
+    if not parser.has_option(args[0]):
+        parser.add_option(*args, **kwargs)
 
 
 def update_storage_props(resource, lfs_props):
     # type: (Resource, Dict[str, Any]) -> None
     """Update the resource with new storage properties
     """
+    from sqlalchemy.orm.attributes import flag_modified
     resource.extras['lfs_prefix'] = lfs_props['lfs_prefix']
     resource.extras['sha256'] = lfs_props['sha256']
     resource.size = lfs_props['size']
     flag_modified(resource, 'extras')
 
 
+def update_linked_resource_storage_props(resource_id, url, lfs_props):
+    # type: (str, str, Dict[str, Any]) -> bool
+    """Update the storage properties of an ingested linked resource
+
+    The original URL is kept, and also saved as ``lfs_source_url``, so that
+    the stored file is only used as long as the URL does not change. Returns
+    ``False`` if the resource was modified, deleted or locked since it was
+    fetched.
+    """
+    from ckan.model import Resource, Session
+    session = Session()
+    with db_transaction(session):
+        resource = session.query(Resource).filter(Resource.id == resource_id).\
+            with_for_update(skip_locked=True).one_or_none()
+        if resource is None or resource.state == 'deleted' or resource.url != url:
+            return False
+        resource.extras['lfs_source_url'] = url
+        update_storage_props(resource, lfs_props)
+    return True
+
+
+def ingest_linked_resource(url, lfs_prefix, token, allowed_domains, max_size):
+    # type: (str, str, str, Iterable[str], int) -> Dict[str, Any]
+    """Fetch a linked resource and upload it to blob storage, returning its storage properties
+
+    The file is hashed while it is being fetched to a temporary file, so it
+    is only read once more, when uploading it.
+    """
+    from ckanext.blob_storage import lfs, metrics
+    with tempfile.TemporaryFile(prefix='ckan-blob-ingest-') as f:
+        with metrics.timer('ingest_fetch_duration_seconds'):
+            sha256, size = fetch_linked_resource(url, f, allowed_domains, max_size)
+        if size == 0:
+            raise LinkedResourceError("File is empty")
+
+        f.seek(0)
+        object_attrs = {'oid': sha256, 'size': size}
+        filename = os.path.basename(urlparse(url).path)
+        if filename:
+            object_attrs['x-filename'] = filename
+        with metrics.timer('ingest_upload_duration_seconds'):
+            lfs.upload(lfs.get_client(token), f, lfs_prefix, object_attrs)
+
+    return {'sha256': sha256, 'size': size}
+
+
+def fetch_linked_resource(url, file_obj, allowed_domains, max_size):
+    # type: (str, BinaryIO, Iterable[str], int) -> Tuple[str, int]
+    """Fetch a linked resource to a file, and return its sha256 and size
+
+    Redirects are only followed to allowed domains.
+    """
+    import requests
+    for _ in range(LINKED_FETCH_MAX_REDIRECTS + 1):
+        if not is_allowed_url(url, allowed_domains):
+            raise LinkedResourceError("URL is not on an allowed domain: {}".format(url))
+        response = requests.get(url, stream=True, timeout=LINKED_FETCH_TIMEOUT, allow_redirects=False)
+        if not response.is_redirect:
+            break
+        url = urljoin(url, response.headers['Location'])
+        response.close()
+    else:
+        raise LinkedResourceError("Too many redirects")
+
+    with response:
+        if response.status_code != 200:
+            raise LinkedResourceError("Unexpected response status code: {}".format(response.status_code))
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > max_size:
+            raise LinkedResourceError("File is larger than {} bytes".format(max_size))
+
+        sha256 = hashlib.sha256()
+        size = 0
+        for chunk in response.iter_content(chunk_size=1024 * 64):
+            size += len(chunk)
+            if size > max_size:
+                raise LinkedResourceError("File is larger than {} bytes".format(max_size))
+            sha256.update(chunk)
+            file_obj.write(chunk)
+
+    return sha256.hexdigest(), size
+
+
+def is_allowed_url(url, allowed_domains):
+    # type: (str, Iterable[str]) -> bool
+    """Check if a URL is an HTTP(S) URL on one of the allowed domains, or a subdomain of one
+
+    >>> is_allowed_url('https://data.example.com/file.csv', ['example.com'])
+    True
+    >>> is_allowed_url('https://badexample.com/file.csv', ['example.com'])
+    False
+    >>> is_allowed_url('ftp://example.com/file.csv', ['example.com'])
+    False
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in {'http', 'https'} or not parsed.hostname:
+        return False
+    host = parsed.hostname.lower()
+    return any(host == domain or host.endswith('.' + domain) for domain in allowed_domains)
+
+
 @contextmanager
 def download_resource(resource, dataset):
     # type: (Dict[str, Any], Dict[str, Any]) -> str
@@ -134,9 +707,10 @@ def download_resource(resource, dataset):
 
     This is a context manager that will delete the local file once context is closed
     """
+    from ckanext.blob_storage.download_handler import call_download_handlers
     resource_file = tempfile.mktemp(prefix='ckan-blob-migration-')
     try:
-        response = call_download_handlers(resource, dataset)
+        response = call_download_handlers(resource, dataset, track=False)
         if response.status_code == 200:
             _save_downloaded_response_data(response, resource_file)
         elif response.status_code in {301, 302}:
@@ -157,6 +731,7 @@ def _save_downloaded_response_data(response, file_name):
     """Get an HTTP response object with open file containing a resource and save the data locally
     to a temporary file
     """
+    from werkzeug.wsgi import FileWrapper
     with open(file_name, 'wb') as f:
         if isinstance(response.response, (string_types, binary_type)):
             _log().debug("Response contains inline string data, saving to %s", file_name)
@@ -178,6 +753,7 @@ def _save_redirected_response_data(response, file_name):
 
     Return the local file name
     """
+    import requests
     resource_url = response.headers['Location']
     _log().debug("Resource is at %s, downloading ...", resource_url)
     with requests.get(resource_url, stream=True) as source, open(file_name, 'wb') as dest:
@@ -201,8 +777,8 @@ def get_resource_dataset(resource_obj):
     return dataset, resource
 
 
-def get_unmigrated_resources():
-    # type: () -> Generator[Resource, None, None]
+def get_unmigrated_resources(batch_size=1, on_commit=None):
+    # type: (int, Optional[Callable[[], None]]) -> Generator[Resource, None, None]
     """Generator of un-migrated resource
 
     This works by fetching one resource at a time using SELECT FOR UPDATE SKIP LOCKED.
@@ -212,7 +788,14 @@ def get_unmigrated_resources():
 
     While a specific resource is being migrated, it will be locked for modification
     on the DB level. Users can still read the resource without any effect.
+
+    Up to ``batch_size`` resources are locked and updated in each transaction,
+    and are unlocked together when it is committed. ``on_commit`` is called
+    after each commit. If an exception is raised, all changes made since the
+    last commit are rolled back.
     """
+    from ckan.model import Resource, Session
+    from sqlalchemy.orm import load_only
     session = Session()
     session.revisioning_disabled = True
 
@@ -224,12 +807,13 @@ def get_unmigrated_resources():
         Resource.created
     ).options(load_only("id", "extras", "package_id"))
 
-    for resource in all_resources:
-        if not _needs_migration(resource):
-            _log().debug("Skipping resource %s as it was already migrated", resource.id)
-            continue
+    locked = 0
+    try:
+        for resource in all_resources:
+            if not _needs_migration(resource):
+                _log().debug("Skipping resource %s as it was already migrated", resource.id)
+                continue
 
-        with db_transaction(session):
             locked_resource = session.query(Resource).filter(Resource.id == resource.id).\
                 with_for_update(skip_locked=True).one_or_none()
 
@@ -243,16 +827,97 @@ def get_unmigrated_resources():
 
             yield locked_resource
 
+            locked += 1
+            if locked >= batch_size:
+                _commit(session, locked, on_commit)
+                locked = 0
+
+        _commit(session, locked, on_commit)
+    except Exception:
+        session.rollback()
+        raise
+
+
+def _commit(session, count, on_commit):
+    # type: (Any, int, Optional[Callable[[], None]]) -> None
+    session.commit()
+    _log().debug("Committed changes to %d resources", count)
+    if on_commit is not None:
+        on_commit()
+
+
+def get_linked_resources(allowed_domains, page_size=LINKED_RESOURCES_PAGE_SIZE):
+    # type: (Iterable[str], int) -> Generator[Dict[str, Any], None, None]
+    """Generator of linked resources on allowed domains which were not ingested yet
+
+    Resources are not locked here, as fetching them may take a while; They
+    are locked when they are updated, after their file has been uploaded.
+
+    Resources are fetched in pages of ``page_size``, ordered by ID, so that
+    pages are not shifted by resources updated or deleted while iterating.
+    """
+    from ckan.model import Resource, Session
+    from sqlalchemy import or_
+    session = Session()
+
+    # Plain rows are fetched, which are not expired when resources are updated while iterating
+    query = session.query(Resource.id, Resource.package_id, Resource.url, Resource.extras).filter(
+        or_(Resource.url_type.is_(None), Resource.url_type == ''),
+        Resource.state != 'deleted',
+    )
+
+    last_id = None
+    while True:
+        page = query
+        if last_id is not None:
+            page = page.filter(Resource.id > last_id)
+        rows = page.order_by(Resource.id).limit(page_size).all()
+
+        for row in rows:
+            if row.url and is_allowed_url(row.url, allowed_domains) and _needs_ingestion(row):
+                yield {'id': row.id, 'package_id': row.package_id, 'url': row.url}
+
+        if len(rows) < page_size:
+            break
+        last_id = rows[-1].id
+
+
+def _needs_ingestion(resource):
+    # type: (Any) -> bool
+    """Check the attributes of a linked resource to see if its current URL was ingested
+    """
+    extras = resource.extras or {}
+    return extras.get('lfs_source_url') != resource.url or not _is_migrated(extras, resource.package_id)
+
 
 def _needs_migration(resource):
     # type: (Resource) -> bool
     """Check the attributes of a resource to see if it was migrated
     """
-    if not (resource.extras.get('lfs_prefix') and resource.extras.get('sha256')):
-        return True
+    return not _is_migrated(resource.extras, resource.package_id)
+
+
+def _is_migrated(extras, package_id):
+    # type: (Dict[str, Any], str) -> bool
+    """Check if a resource's file is in storage under the expected prefix, or was relinked
+
+    >>> _is_migrated({'lfs_prefix': 'ckan/dataset-id', 'sha256': 'abc'}, 'dataset-id')
+    True
+    >>> _is_migrated({'lfs_prefix': 'old-ns/dataset-id', 'sha256': 'abc'}, 'dataset-id')
+    False
+    >>> _is_migrated({'lfs_prefix': 'old-ns/dataset-id', 'sha256': 'abc',
+    ...               'lfs_relinked_prefix': 'ckan/dataset-id'}, 'dataset-id')
+    True
+    """
+    if not (extras.get('lfs_prefix') and extras.get('sha256')):
+        return False
+    expected_prefix = _expected_prefix(package_id)
+    return expected_prefix in {extras.get('lfs_prefix'), extras.get('lfs_relinked_prefix')}
+
 
-    expected_prefix = '/'.join([helpers.storage_namespace(), resource.package_id])
-    return resource.extras.get('lfs_prefix') != expected_prefix
+def _expected_prefix(package_id):
+    # type: (str) -> str
+    return '/'.join([helpers.storage_namespace(), package_id])
 
 
 @contextmanager
@@ -268,6 +933,7 @@ def db_transaction(session):
 
 @contextmanager
 def app_context():
+    from ckan.lib.helpers import _get_auto_flask_context  # noqa  we need this for Flask request context
     context = _get_auto_flask_context()
     try:
         context.push()
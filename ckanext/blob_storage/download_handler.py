@@ -1,13 +1,22 @@
+import datetime
 import inspect
+import mimetypes
 import os
 
 from ckan import model, plugins
 from ckan.lib import uploader
 from ckan.plugins import toolkit as tk
-from flask import send_file
+from flask import Response, request, send_file
+from six.moves.urllib.parse import quote
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date
 
+from . import helpers, metrics, tracking
 from .interfaces import IResourceDownloadHandler
 
+# Outcomes of download requests which are counted as downloads
+DOWNLOAD_OUTCOMES = {'redirect', 'handler', 'fallback'}
+
 
 def get_context():
     """Get a default context dict
@@ -32,8 +41,32 @@ def call_pre_download_handlers(resource, package, activity_id=None):
     return resource
 
 
-def call_download_handlers(resource, package, filename=None, inline=False, activity_id=None):
+def call_download_handlers(resource, package, filename=None, inline=False, activity_id=None, track=True):
     """Call all registered plugins download handlers
+
+    Successful downloads are counted (see :mod:`tracking`), unless ``track``
+    is ``False``, such as for downloads which are not made by users.
+    """
+    labels = {'outcome': 'error'}
+    try:
+        with metrics.timer('download_duration_seconds'):
+            response, labels['outcome'] = _call_download_handlers(resource, package, filename, inline, activity_id)
+        return response
+    except tk.ObjectNotFound:
+        labels['outcome'] = 'not_found'
+        raise
+    except HTTPException as e:
+        if e.code == 404:
+            labels['outcome'] = 'not_found'
+        raise
+    finally:
+        metrics.increment('downloads_total', **labels)
+        if track and labels['outcome'] in DOWNLOAD_OUTCOMES:
+            tracking.record_download(resource['id'], package['id'])
+
+
+def _call_download_handlers(resource, package, filename, inline, activity_id):
+    """Call download handlers, returning the response and the download outcome for metrics
     """
     for plugin in plugins.PluginImplementations(IResourceDownloadHandler):
         if not hasattr(plugin, 'resource_download'):
@@ -45,17 +78,30 @@ def call_download_handlers(resource, package, filename=None, inline=False, activ
             response = plugin.resource_download(resource, package, filename)
 
         if response:
-            return response
+            return response, _response_outcome(response, 'handler')
 
-    return fallback_download_method(resource)
+    return fallback_download_method(resource), 'fallback'
+
+
+def _response_outcome(response, default):
+    """Classify a download response as a redirect, a 404 or the given default outcome
+    """
+    status_code = getattr(response, 'status_code', None)
+    if status_code in {301, 302, 303, 307, 308}:
+        return 'redirect'
+    elif status_code == 404:
+        return 'not_found'
+    return default
 
 
 def download_handler(resource, _, filename=None, inline=False, activity_id=None):
     """Get the download URL from LFS server and redirect the user there
     """
-    if resource.get('url_type') != 'upload' or not resource.get('lfs_prefix'):
+    from .actions import RESOURCE_LOADED_CONTEXT_KEY
+    if not helpers.is_blob_storage_resource(resource):
         return None
     context = get_context()
+    context[RESOURCE_LOADED_CONTEXT_KEY] = True
     data_dict = {'resource': resource,
                  'filename': filename,
                  'inline': inline,
@@ -70,6 +116,72 @@ def download_handler(resource, _, filename=None, inline=False, activity_id=None)
         return tk.abort(404, tk._('No download is available'))
 
 
+def head_response(resource, filename=None, inline=False):
+    """Respond to a HEAD download request for a file in blob storage, without contacting the LFS server
+
+    Response headers are based on the resource's stored ``size`` and
+    ``sha256``. Returns ``None`` if the resource's file is not in blob storage.
+    """
+    if not helpers.is_blob_storage_resource(resource) \
+            or not resource.get('sha256') or not resource.get('size'):
+        return None
+
+    if request.if_none_match.contains_weak(resource['sha256']):
+        response = Response(status=304)
+    else:
+        response = Response(status=200)
+        response.headers['Content-Length'] = str(resource['size'])
+
+    if filename is None:
+        filename = helpers.resource_filename(resource)
+    response.headers['ETag'] = '"{}"'.format(resource['sha256'])
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Type'] = resource.get('mimetype') or mimetypes.guess_type(filename)[0] \
+        or 'application/octet-stream'
+    response.headers['Content-Disposition'] = _content_disposition(filename, inline)
+    last_modified = _parse_timestamp(resource.get('last_modified') or resource.get('created'))
+    if last_modified:
+        response.headers['Last-Modified'] = http_date(last_modified)
+
+    metrics.increment('downloads_total', outcome='head')
+    return response
+
+
+def _content_disposition(filename, inline=False):
+    """Get a Content-Disposition header value, with a non-ASCII file name encoded as per RFC 6266
+
+    >>> _content_disposition('data.csv')
+    'attachment; filename="data.csv"'
+    >>> _content_disposition(u'd\xe9j\xe0 vu.csv', inline=True)
+    'inline; filename="dj vu.csv"; filename*=UTF-8\\'\\'d%C3%A9j%C3%A0%20vu.csv'
+    """
+    disposition = 'inline' if inline else 'attachment'
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '').replace('\\', '')
+    value = '{}; filename="{}"'.format(disposition, ascii_name)
+    if ascii_name != filename:
+        value += "; filename*=UTF-8''{}".format(quote(filename.encode('utf-8'), safe=''))
+    return value
+
+
+def _parse_timestamp(value):
+    """Parse a CKAN ISO timestamp
+
+    >>> _parse_timestamp('2021-01-15T10:20:30.123456')
+    datetime.datetime(2021, 1, 15, 10, 20, 30, 123456)
+    >>> _parse_timestamp('2021-01-15T10:20:30')
+    datetime.datetime(2021, 1, 15, 10, 20, 30)
+    >>> _parse_timestamp('yesterday')
+    """
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
 def fallback_download_method(resource):
     """Fall back to the built in CKAN download method
     """
@@ -0,0 +1,326 @@
+"""Export files in blob storage, e.g. for backups or offline mirrors
+
+Files are written to a content addressed layout, as
+``objects/<sha256[0:2]>/<sha256[2:4]>/<sha256>``, either in a directory or
+in a tar stream. A JSON lines manifest (``manifest.jsonl``), listing the
+metadata of each exported resource and the path of its file, is written
+along with them.
+
+Files are streamed from storage to their destination, and are never loaded
+into memory as a whole.
+"""
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import time
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Set
+
+from . import helpers, metrics
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+# Maximal number of objects in each LFS batch request
+BATCH_SIZE = 100
+
+CHUNK_SIZE = 1024 * 64
+
+# Connect and read timeouts, in seconds, for downloading objects
+DOWNLOAD_TIMEOUT = (10, 60)
+
+log = logging.getLogger(__name__)
+
+
+class ExportError(Exception):
+    """An object could not be exported
+    """
+
+
+def object_path(sha256):
+    # type: (str) -> str
+    """Get the path of an object in the export layout
+
+    >>> object_path('cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919')
+    'objects/cc/71/cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    """
+    return '/'.join(['objects', sha256[0:2], sha256[2:4], sha256])
+
+
+class DirectoryWriter(object):
+    """Write exported objects to a directory tree
+
+    Objects already present in the directory are not exported again.
+    Downloaded objects are moved in place only once complete, so interrupted
+    exports can be resumed. Manifest entries are appended to the manifest of
+    previous exports, so that it still lists their objects; The last entry of
+    a resource is its current one.
+    """
+
+    def __init__(self, root):
+        # type: (str) -> None
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        manifest_path = os.path.join(root, MANIFEST_NAME)
+        self._manifest = open(manifest_path, 'a')
+        # An interrupted export may have left an incomplete last line
+        if os.path.getsize(manifest_path) > 0:
+            with open(manifest_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._manifest.write('\n')
+
+    def has_object(self, sha256, size):
+        # type: (str, int) -> bool
+        path = self._path(sha256)
+        return os.path.isfile(path) and os.path.getsize(path) == size
+
+    def object_file(self, sha256):
+        # type: (str) -> BinaryIO
+        path = self._path(sha256)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        return tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.{}-'.format(sha256), delete=False)
+
+    def add_object(self, sha256, size, file_obj):
+        # type: (str, int, Any) -> None
+        file_obj.close()
+        os.rename(file_obj.name, self._path(sha256))
+
+    def discard_object(self, sha256, file_obj):
+        # type: (str, Any) -> None
+        file_obj.close()
+        os.unlink(file_obj.name)
+
+    def add_manifest_entry(self, entry):
+        # type: (Dict[str, Any]) -> None
+        self._manifest.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def close(self):
+        # type: () -> None
+        self._manifest.close()
+
+    def _path(self, sha256):
+        # type: (str) -> str
+        return os.path.join(self.root, *object_path(sha256).split('/'))
+
+
+class TarWriter(object):
+    """Write exported objects to a tar stream, which does not need to be seekable
+
+    Objects are downloaded to temporary files, and added to the stream one at
+    a time. ``skip`` is a set of SHA256 digests of objects which should not
+    be exported, for example because they were included in a previous export.
+    The manifest is added last.
+    """
+
+    def __init__(self, file_obj, skip=None):
+        # type: (BinaryIO, Optional[Set[str]]) -> None
+        self._tar = tarfile.open(fileobj=file_obj, mode='w|', format=tarfile.PAX_FORMAT)
+        self._skip = set(skip or ())
+        self._manifest = tempfile.TemporaryFile(mode='w+b')
+
+    def has_object(self, sha256, size):
+        # type: (str, int) -> bool
+        return sha256 in self._skip
+
+    def object_file(self, sha256):
+        # type: (str) -> BinaryIO
+        return tempfile.TemporaryFile()
+
+    def add_object(self, sha256, size, file_obj):
+        # type: (str, int, BinaryIO) -> None
+        file_obj.seek(0)
+        self._add_member(object_path(sha256), size, file_obj)
+        file_obj.close()
+        self._skip.add(sha256)
+
+    def discard_object(self, sha256, file_obj):
+        # type: (str, BinaryIO) -> None
+        file_obj.close()
+
+    def add_manifest_entry(self, entry):
+        # type: (Dict[str, Any]) -> None
+        self._manifest.write((json.dumps(entry, sort_keys=True) + '\n').encode('utf-8'))
+
+    def close(self):
+        # type: () -> None
+        size = self._manifest.tell()
+        self._manifest.seek(0)
+        self._add_member(MANIFEST_NAME, size, self._manifest)
+        self._manifest.close()
+        self._tar.close()
+
+    def _add_member(self, name, size, file_obj):
+        # type: (str, int, BinaryIO) -> None
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._tar.addfile(info, file_obj)
+
+
+def read_manifest_digests(path):
+    # type: (str) -> Set[str]
+    """Get the SHA256 digests of objects exported according to a manifest
+    """
+    digests = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log.warning("Skipping invalid manifest entry: %s", line.strip())
+                continue
+            if entry.get('status') in {'exported', 'present'}:
+                digests.add(entry['resource']['sha256'])
+    return digests
+
+
+def export_resources(datasets, writer, get_token, workers=4):
+    # type: (Iterable[Dict[str, Any]], Any, Callable[[str], str], int) -> Dict[str, int]
+    """Export the files of all resources in blob storage of datasets
+
+    Download specs are requested in batches, per storage prefix, using
+    tokens provided by ``get_token(lfs_prefix)``. Objects are downloaded by
+    a pool of ``workers`` threads, and added to ``writer`` in this thread.
+    At most ``2 * workers`` downloads are in progress or queued at a time,
+    and download specs are only requested once few of them are left, so
+    that download URLs do not expire while waiting.
+    Returns the number of resources by status (``exported``, ``present``
+    or ``failed``).
+    """
+    pool = ThreadPool(workers)
+    totals = {'exported': 0, 'present': 0, 'failed': 0}
+    try:
+        for dataset in datasets:
+            for entry in _export_dataset(dataset, writer, get_token, pool, workers):
+                writer.add_manifest_entry(entry)
+                totals[entry['status']] += 1
+                metrics.increment('exported_resources_total', result=entry['status'])
+    finally:
+        pool.terminate()
+    return totals
+
+
+def _export_dataset(dataset, writer, get_token, pool, workers):
+    # type: (Dict[str, Any], Any, Callable[[str], str], ThreadPool, int) -> List[Dict[str, Any]]
+    entries = []
+    to_export = OrderedDict()  # type: OrderedDict
+    for resource in dataset.get('resources', []):
+        if not (helpers.is_blob_storage_resource(resource) and resource.get('sha256') and resource.get('size')):
+            continue
+        entry = {'dataset': {'id': dataset['id'],
+                             'name': dataset['name'],
+                             'organization': (dataset.get('organization') or {}).get('name')},
+                 'resource': resource,
+                 'path': object_path(resource['sha256'])}
+        entries.append(entry)
+        if writer.has_object(resource['sha256'], resource['size']):
+            entry['status'] = 'present'
+        else:
+            to_export.setdefault((resource['lfs_prefix'], resource['sha256'], resource['size']), []).append(entry)
+
+    keys = list(to_export.keys())
+    for lfs_prefix in OrderedDict.fromkeys(k[0] for k in keys):
+        prefix_keys = [k for k in keys if k[0] == lfs_prefix]
+        errors = _export_objects(lfs_prefix, prefix_keys, writer, get_token, pool, workers)
+        for key in prefix_keys:
+            for entry in to_export[key]:
+                if key in errors:
+                    entry['status'] = 'failed'
+                    entry['error'] = errors[key]
+                else:
+                    entry['status'] = 'exported'
+    return entries
+
+
+def _export_objects(lfs_prefix, keys, writer, get_token, pool, workers):
+    # type: (str, List[tuple], Any, Callable[[str], str], ThreadPool, int) -> Dict[tuple, str]
+    """Export objects with the same prefix, and return errors by object
+
+    Download specs are requested for ``workers`` objects at a time, once
+    fewer than ``workers`` downloads are left in progress.
+    """
+    errors = {}  # type: Dict[tuple, str]
+    pending = deque()  # type: deque
+    batch_size = max(min(workers, BATCH_SIZE), 1)
+    for i in range(0, len(keys), batch_size):
+        while len(pending) >= workers:
+            _finish_download(lfs_prefix, writer, errors, *pending.popleft())
+        errors.update(_start_downloads(lfs_prefix, keys[i:i + batch_size], writer, get_token, pool, pending))
+    while pending:
+        _finish_download(lfs_prefix, writer, errors, *pending.popleft())
+    return errors
+
+
+def _start_downloads(lfs_prefix, keys, writer, get_token, pool, pending):
+    # type: (str, List[tuple], Any, Callable[[str], str], ThreadPool, deque) -> Dict[tuple, str]
+    """Request download specs for a batch of objects, and add their downloads to ``pending``
+
+    Returns errors by object.
+    """
+    from . import lfs
+    errors = {}
+    try:
+        objects = [{'oid': sha256, 'size': size} for _, sha256, size in keys]
+        response = lfs.batch(lfs.get_client(get_token(lfs_prefix)), lfs_prefix, 'download', objects)
+        specs = {(o['oid'], o['size']): o for o in response['objects']}
+    except Exception as e:
+        log.exception("Failed getting download specs for %d objects from %s", len(keys), lfs_prefix)
+        return {key: str(e) for key in keys}
+
+    for key in keys:
+        if writer.has_object(key[1], key[2]):
+            continue
+        spec = specs.get((key[1], key[2]), {})
+        if 'error' in spec or 'download' not in spec.get('actions', {}):
+            errors[key] = spec.get('error', {}).get('message', 'No download action')
+            continue
+        file_obj = writer.object_file(key[1])
+        pending.append((key, file_obj, pool.apply_async(download_object,
+                                                        (spec['actions']['download'], key[1], key[2], file_obj))))
+    return errors
+
+
+def _finish_download(lfs_prefix, writer, errors, key, file_obj, result):
+    # type: (str, Any, Dict[tuple, str], tuple, Any, Any) -> None
+    try:
+        result.get()
+    except Exception as e:
+        log.warning("Failed exporting %s from %s: %s", key[1], lfs_prefix, e)
+        writer.discard_object(key[1], file_obj)
+        errors[key] = str(e)
+    else:
+        writer.add_object(key[1], key[2], file_obj)
+
+
+def download_object(action, sha256, size, file_obj):
+    # type: (Dict[str, Any], str, int, BinaryIO) -> None
+    """Download an object to a file, checking its size and SHA256 digest
+    """
+    import requests
+    digest = hashlib.sha256()
+    written = 0
+    with metrics.timer('export_download_duration_seconds'):
+        with requests.get(action['href'], headers=action.get('header', {}), stream=True,
+                          timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                written += len(chunk)
+                if written > size:
+                    raise ExportError("Object is larger than expected")
+                digest.update(chunk)
+                file_obj.write(chunk)
+
+    if written != size or digest.hexdigest() != sha256:
+        raise ExportError("Downloaded object does not match its size or SHA256 digest")
+    file_obj.flush()
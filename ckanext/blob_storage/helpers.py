@@ -77,6 +77,29 @@ def organization_name_for_package(package):
     return None
 
 
+def is_blob_storage_resource(resource):
+    # type: (Dict[str, Any]) -> bool
+    """Check if a resource's file is in blob storage
+
+    This is the case for uploaded resources, and for linked resources ingested
+    by the ``migrate-resources`` command, as long as their URL did not change.
+
+    >>> is_blob_storage_resource({'url_type': 'upload', 'lfs_prefix': 'ckan/dataset'})
+    True
+    >>> is_blob_storage_resource({'url': 'https://example.com/data.csv', 'lfs_prefix': 'ckan/dataset',
+    ...                           'lfs_source_url': 'https://example.com/data.csv'})
+    True
+    >>> is_blob_storage_resource({'url': 'https://example.com/new.csv', 'lfs_prefix': 'ckan/dataset',
+    ...                           'lfs_source_url': 'https://example.com/data.csv'})
+    False
+    """
+    if not resource.get('lfs_prefix'):
+        return False
+    if resource.get('url_type') == 'upload':
+        return True
+    return bool(resource.get('lfs_source_url')) and resource.get('lfs_source_url') == resource.get('url')
+
+
 def resource_filename(resource):
     """Get original file name from resource
     """
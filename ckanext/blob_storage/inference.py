@@ -0,0 +1,541 @@
+"""Schema and sample inference for files in blob storage
+
+When ``ckanext.blob_storage.inference`` is enabled, a background job infers
+the ``schema`` (as a Table Schema) and ``sample`` of new and updated resources
+which are missing them. Only the beginning of each file is fetched from storage,
+using an HTTP ``Range`` request on its download URL: up to
+``ckanext.blob_storage.inference.max_bytes`` bytes. For Parquet files, only the
+footer, which holds the schema, is fetched; They do not get a sample.
+
+CSV, TSV, JSON lines and Parquet files are supported, based on the resource
+``format`` or the file extension.
+"""
+import csv
+import io
+import json
+import logging
+import re
+import struct
+from typing import Any, Dict, List, Optional
+
+import six
+from ckan.plugins import toolkit
+from six import ensure_text
+
+from . import helpers, metrics
+
+INFERENCE_CONF_KEY = 'ckanext.blob_storage.inference'
+MAX_BYTES_CONF_KEY = 'ckanext.blob_storage.inference.max_bytes'
+SAMPLE_ROWS_CONF_KEY = 'ckanext.blob_storage.inference.sample_rows'
+
+DEFAULT_MAX_BYTES = 64 * 1024
+DEFAULT_SAMPLE_ROWS = 20
+
+# Connect and read timeouts, in seconds, for fetching files
+FETCH_TIMEOUT = (10, 60)
+
+CHUNK_SIZE = 1024 * 64
+
+FORMATS = {
+    'csv': 'csv',
+    'tsv': 'tsv',
+    'tab': 'tsv',
+    'jsonl': 'jsonl',
+    'ndjson': 'jsonl',
+    'json lines': 'jsonl',
+    'parquet': 'parquet',
+}
+
+# Context flag set when saving inferred values, so that saving them does not trigger inference again
+CONTEXT_FLAG = 'blob_storage_inference'
+
+_PARQUET_MAGIC = b'PAR1'
+_PARQUET_TYPES = {0: 'boolean', 1: 'integer', 2: 'integer', 3: 'datetime', 4: 'number', 5: 'number',
+                  6: 'string', 7: 'string'}
+_PARQUET_CONVERTED_TYPES = {0: 'string', 1: 'object', 2: 'object', 3: 'array', 4: 'string', 5: 'number',
+                            6: 'date', 7: 'time', 8: 'time', 9: 'datetime', 10: 'datetime', 11: 'integer',
+                            12: 'integer', 13: 'integer', 14: 'integer', 15: 'integer', 16: 'integer',
+                            17: 'integer', 18: 'integer', 19: 'object', 21: 'duration'}
+_PARQUET_LOGICAL_TYPES = {1: 'string', 2: 'object', 3: 'array', 4: 'string', 5: 'number', 6: 'date',
+                          7: 'time', 8: 'datetime', 10: 'integer', 12: 'object', 14: 'string'}
+
+_STRING_TYPES = [
+    ('integer', re.compile(r'^[+-]?\d+$')),
+    ('number', re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')),
+    ('boolean', re.compile(r'^(true|false)$', re.IGNORECASE)),
+    ('date', re.compile(r'^\d{4}-\d{2}-\d{2}$')),
+    ('datetime', re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?$')),
+]
+
+log = logging.getLogger(__name__)
+
+
+class InferenceError(Exception):
+    """A schema or sample could not be inferred from a file
+    """
+
+
+def detect_format(resource):
+    # type: (Dict[str, Any]) -> Optional[str]
+    """Get the inference format of a resource, from its ``format`` or file extension
+
+    >>> detect_format({'format': 'CSV', 'url': 'data'})
+    'csv'
+    >>> detect_format({'format': '', 'url': 'https://example.com/data.ndjson'})
+    'jsonl'
+    >>> detect_format({'url': 'report.pdf'}) is None
+    True
+    """
+    fmt = (resource.get('format') or '').strip().lower()
+    if fmt in FORMATS:
+        return FORMATS[fmt]
+    extension = helpers.resource_filename(resource).rsplit('.', 1)[-1].lower() if 'url' in resource else ''
+    return FORMATS.get(extension)
+
+
+def can_infer(resource):
+    # type: (Dict[str, Any]) -> bool
+    """Check if the schema and sample of a resource can be inferred from its file in blob storage
+    """
+    return bool(helpers.is_blob_storage_resource(resource) and resource.get('sha256') and resource.get('size')
+                and detect_format(resource))
+
+
+def needs_inference(resource):
+    # type: (Dict[str, Any]) -> bool
+    """Check if a resource in blob storage is missing a schema or sample which can be inferred
+    """
+    if not can_infer(resource):
+        return False
+    return not _has_value(resource, 'schema') or \
+        (detect_format(resource) != 'parquet' and not _has_value(resource, 'sample'))
+
+
+def _has_value(resource, field):
+    # type: (Dict[str, Any], str) -> bool
+    return bool(resource.get(field) or resource.get('{}_ref'.format(field)))
+
+
+def infer_resource_metadata(context, resource, force=False):
+    # type: (Dict[str, Any], Dict[str, Any], bool) -> Dict[str, Any]
+    """Infer the schema and sample of a resource in blob storage, and save missing ones
+
+    Existing values are only replaced if ``force`` is set. Returns the saved
+    values, which may be empty.
+    """
+    from .actions import get_lfs_download_spec
+    if not (can_infer(resource) and (force or needs_inference(resource))):
+        return {}
+    try:
+        inferred = infer_resource(resource, get_lfs_download_spec(dict(context), resource))
+    except InferenceError:
+        metrics.increment('inferred_resources_total', format=detect_format(resource), result='skipped')
+        raise
+    except Exception:
+        metrics.increment('inferred_resources_total', format=detect_format(resource), result='failed')
+        raise
+    return save_inferred(context, resource, inferred, force=force)
+
+
+def infer_resource(resource, action):
+    # type: (Dict[str, Any], Dict[str, Any]) -> Dict[str, Any]
+    """Infer the schema and sample of a resource from its file, given by its download action
+    """
+    fmt = detect_format(resource)
+    if fmt is None:
+        raise InferenceError("Unsupported format")
+    with metrics.timer('inference_duration_seconds', format=fmt):
+        return infer(action, fmt, int(resource['size']),
+                     toolkit.asint(toolkit.config.get(MAX_BYTES_CONF_KEY, DEFAULT_MAX_BYTES)),
+                     toolkit.asint(toolkit.config.get(SAMPLE_ROWS_CONF_KEY, DEFAULT_SAMPLE_ROWS)))
+
+
+def save_inferred(context, resource, inferred, force=False):
+    # type: (Dict[str, Any], Dict[str, Any], Dict[str, Any], bool) -> Dict[str, Any]
+    """Save inferred values a resource does not have yet, or all of them if ``force`` is set
+    """
+    values = {field: json.dumps(value) for field, value in inferred.items()
+              if force or not _has_value(resource, field)}
+    if values:
+        toolkit.get_action('resource_patch')(dict(context, **{CONTEXT_FLAG: True}),
+                                             dict(values, id=resource['id']))
+    metrics.increment('inferred_resources_total', format=detect_format(resource),
+                      result='success' if values else 'skipped')
+    return values
+
+
+def infer(action, fmt, size, max_bytes=DEFAULT_MAX_BYTES, sample_rows=DEFAULT_SAMPLE_ROWS):
+    # type: (Dict[str, Any], str, int, int, int) -> Dict[str, Any]
+    """Infer a schema, and for row based formats a sample, from a file given by its download action
+    """
+    if fmt == 'parquet':
+        return {'schema': infer_parquet_schema(fetch_parquet_metadata(action, size, max_bytes))}
+
+    data = fetch_range(action, 0, min(size, max_bytes))
+    truncated = len(data) < size
+    if fmt == 'jsonl':
+        return infer_jsonl(data, truncated, sample_rows)
+    return infer_csv(data, truncated, sample_rows, delimiter='\t' if fmt == 'tsv' else None)
+
+
+def fetch_range(action, start, length):
+    # type: (Dict[str, Any], int, int) -> bytes
+    """Fetch ``length`` bytes of a file from ``start``, using an HTTP Range request
+
+    If the storage server ignores the range, and sends the whole file, only
+    the beginning of it is read.
+    """
+    import requests
+    headers = dict(action.get('header') or {})
+    headers['Range'] = 'bytes={}-{}'.format(start, start + length - 1)
+    data = bytearray()
+    with requests.get(action['href'], headers=headers, stream=True, timeout=FETCH_TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code != 206 and start > 0:
+            raise InferenceError("Storage server does not support range requests")
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            data += chunk
+            if len(data) >= length:
+                break
+    metrics.increment('inference_fetched_bytes_total', value=min(len(data), length))
+    return bytes(data[:length])
+
+
+def fetch_parquet_metadata(action, size, max_bytes):
+    # type: (Dict[str, Any], int, int) -> bytes
+    """Fetch the beginning of a Parquet file's metadata, which is at the end of the file
+
+    At most ``max_bytes`` bytes are fetched from the end of the file, and if
+    they do not include the start of the metadata, ``max_bytes`` more from it.
+    """
+    tail = fetch_range(action, max(size - max_bytes, 0), min(size, max_bytes))
+    if len(tail) < 8 or tail[-4:] != _PARQUET_MAGIC:
+        raise InferenceError("Not a Parquet file")
+
+    metadata_size = struct.unpack('<I', tail[-8:-4])[0]
+    if metadata_size + 12 > size:
+        raise InferenceError("Invalid Parquet metadata size")
+    if metadata_size + 8 <= len(tail):
+        return tail[len(tail) - 8 - metadata_size:-8]
+    return fetch_range(action, size - 8 - metadata_size, min(metadata_size, max_bytes))
+
+
+def infer_csv(data, truncated, sample_rows, delimiter=None):
+    # type: (bytes, bool, int, Optional[str]) -> Dict[str, Any]
+    """Infer the schema and sample of a CSV file from its first bytes
+
+    >>> infer_csv(b'id,name,joined\\n1,foo,2021-01-15\\n2,bar,\\n3,b', True, 10)['schema']['fields']
+    [{'name': 'id', 'type': 'integer'}, {'name': 'name', 'type': 'string'}, {'name': 'joined', 'type': 'date'}]
+    """
+    text = _decode(_complete_lines(data, truncated))
+    if delimiter is None:
+        try:
+            delimiter = csv.Sniffer().sniff(text[0:4096], delimiters=',;\t|').delimiter
+        except csv.Error:
+            delimiter = ','
+
+    rows = _csv_rows(text, delimiter)
+    if truncated and text.count('"') % 2:
+        # The file was cut in the middle of a quoted multi-line value
+        rows = rows[:-1]
+    if not rows:
+        raise InferenceError("No header row found")
+
+    names = _field_names(rows[0])
+    records = [dict(zip(names, row)) for row in rows[1:]]
+    fields = [{'name': name, 'type': _infer_string_type([r.get(name) for r in records])} for name in names]
+    return {'schema': {'fields': fields}, 'sample': records[0:sample_rows]}
+
+
+def infer_jsonl(data, truncated, sample_rows):
+    # type: (bytes, bool, int) -> Dict[str, Any]
+    """Infer the schema and sample of a JSON lines file from its first bytes
+
+    >>> infer_jsonl(b'{"id": 1, "tags": ["a"]}\\n{"id": 2.5, "ok": true}\\n{"id": 3', True, 10)['schema']['fields']
+    [{'name': 'id', 'type': 'number'}, {'name': 'tags', 'type': 'array'}, {'name': 'ok', 'type': 'boolean'}]
+    """
+    records = []
+    for line in _decode(_complete_lines(data, truncated)).splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise InferenceError("Invalid JSON line")
+        if not isinstance(record, dict):
+            raise InferenceError("JSON lines must be objects")
+        records.append(record)
+    if not records:
+        raise InferenceError("No complete JSON lines found")
+
+    names = []  # type: List[str]
+    for record in records:
+        names.extend(k for k in record if k not in names)
+    fields = [{'name': name, 'type': _infer_json_type([r.get(name) for r in records])} for name in names]
+    return {'schema': {'fields': fields}, 'sample': records[0:sample_rows]}
+
+
+def infer_parquet_schema(metadata):
+    # type: (bytes) -> Dict[str, Any]
+    """Get a Table Schema from (the beginning of) a Parquet file's Thrift encoded metadata
+
+    Only top level columns are included; Nested groups are objects or arrays.
+    """
+    elements = _ThriftCompactReader(metadata).read_struct(until=2).get(2)
+    if not elements:
+        raise InferenceError("No schema found in Parquet metadata")
+
+    fields = []
+    i = 1
+    for _ in range(elements[0].get(5, 0)):
+        if i >= len(elements):
+            raise InferenceError("Invalid Parquet schema")
+        element = elements[i]
+        field = {'name': ensure_text(element.get(4, b''), errors='replace'), 'type': _parquet_type(element)}
+        if element.get(3) == 0:
+            field['constraints'] = {'required': True}
+        fields.append(field)
+
+        # Skip the column's children, if any
+        remaining = 1
+        while remaining:
+            if i >= len(elements):
+                raise InferenceError("Invalid Parquet schema")
+            remaining += elements[i].get(5, 0) - 1
+            i += 1
+    return {'fields': fields}
+
+
+def _parquet_type(element):
+    # type: (Dict[int, Any]) -> str
+    if element.get(3) == 2:
+        return 'array'
+    logical_type = element.get(10)
+    if logical_type:
+        for type_id in logical_type:
+            if type_id in _PARQUET_LOGICAL_TYPES:
+                return _PARQUET_LOGICAL_TYPES[type_id]
+    if element.get(6) in _PARQUET_CONVERTED_TYPES:
+        return _PARQUET_CONVERTED_TYPES[element[6]]
+    if 1 not in element:
+        return 'object'
+    return _PARQUET_TYPES.get(element[1], 'any')
+
+
+class _ThriftCompactReader(object):
+    """Minimal reader of Thrift compact protocol structs, as used in Parquet metadata
+
+    Structs are read as dictionaries by field ID.
+    """
+
+    MAX_DEPTH = 32
+
+    def __init__(self, data):
+        # type: (bytes) -> None
+        self._data = bytearray(data)
+        self._pos = 0
+
+    def read_struct(self, until=None, depth=0):
+        # type: (Optional[int], int) -> Dict[int, Any]
+        """Read a struct, stopping early once field ``until`` has been read
+        """
+        if depth > self.MAX_DEPTH:
+            raise InferenceError("Parquet metadata is nested too deeply")
+        result = {}
+        field_id = 0
+        while True:
+            header = self._byte()
+            if header == 0:
+                return result
+            delta, field_type = header >> 4, header & 0x0F
+            field_id = field_id + delta if delta else self._zigzag()
+            if field_type in (1, 2):
+                result[field_id] = field_type == 1
+            else:
+                result[field_id] = self._value(field_type, depth)
+            if field_id == until:
+                return result
+
+    def _value(self, value_type, depth):
+        if value_type in (1, 2):
+            return self._byte() == 1
+        elif value_type == 3:
+            return struct.unpack('<b', struct.pack('<B', self._byte()))[0]
+        elif value_type in (4, 5, 6):
+            return self._zigzag()
+        elif value_type == 7:
+            return struct.unpack('<d', self._read(8))[0]
+        elif value_type == 8:
+            return bytes(self._read(self._varint()))
+        elif value_type in (9, 10):
+            header = self._byte()
+            size = header >> 4
+            if size == 15:
+                size = self._varint()
+            return [self._value(header & 0x0F, depth + 1) for _ in range(size)]
+        elif value_type == 11:
+            size = self._varint()
+            types = self._byte() if size else 0
+            return dict((self._value(types >> 4, depth + 1), self._value(types & 0x0F, depth + 1))
+                        for _ in range(size))
+        elif value_type == 12:
+            return self.read_struct(depth=depth + 1)
+        raise InferenceError("Invalid Parquet metadata")
+
+    def _byte(self):
+        # type: () -> int
+        return self._read(1)[0]
+
+    def _read(self, size):
+        # type: (int) -> bytearray
+        if self._pos + size > len(self._data):
+            raise InferenceError("Parquet metadata is truncated")
+        data = self._data[self._pos:self._pos + size]
+        self._pos += size
+        return data
+
+    def _varint(self):
+        # type: () -> int
+        result = shift = 0
+        while True:
+            b = self._byte()
+            result |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return result
+            shift += 7
+
+    def _zigzag(self):
+        # type: () -> int
+        n = self._varint()
+        return (n >> 1) ^ -(n & 1)
+
+
+def _complete_lines(data, truncated):
+    # type: (bytes, bool) -> bytes
+    """Drop the incomplete last line of a truncated file
+    """
+    if not truncated:
+        return data
+    end = data.rfind(b'\n')
+    return data[:end + 1] if end >= 0 else b''
+
+
+def _decode(data):
+    # type: (bytes) -> str
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def _csv_rows(text, delimiter):
+    # type: (str, str) -> List[List[str]]
+    try:
+        if six.PY2:
+            rows = csv.reader(io.BytesIO(text.encode('utf-8')), delimiter=str(delimiter))
+            return [[ensure_text(value) for value in row] for row in rows if row]
+        return [row for row in csv.reader(io.StringIO(text, newline=''), delimiter=delimiter) if row]
+    except csv.Error as e:
+        raise InferenceError("Invalid CSV: {}".format(e))
+
+
+def _field_names(header):
+    # type: (List[str]) -> List[str]
+    """Get unique field names from a header row
+
+    >>> _field_names(['id', '', 'id'])
+    ['id', 'field_2', 'field_3']
+    """
+    names = []  # type: List[str]
+    for i, name in enumerate(header):
+        name = name.strip()
+        names.append(name if name and name not in names else 'field_{}'.format(i + 1))
+    return names
+
+
+def _infer_string_type(values):
+    # type: (List[Optional[str]]) -> str
+    """Get the most specific Table Schema type matching all non-empty string values
+
+    >>> _infer_string_type(['1', '2.5', ''])
+    'number'
+    >>> _infer_string_type(['TRUE', 'false'])
+    'boolean'
+    >>> _infer_string_type(['', None])
+    'string'
+    """
+    values = [v.strip() for v in values if v and v.strip()]
+    if not values:
+        return 'string'
+    for type_name, pattern in _STRING_TYPES:
+        if all(pattern.match(v) for v in values):
+            return type_name
+    return 'string'
+
+
+def _infer_json_type(values):
+    # type: (List[Any]) -> str
+    """Get the Table Schema type matching all non-null JSON values
+
+    >>> _infer_json_type([1, 2.5, None])
+    'number'
+    >>> _infer_json_type(['2021-01-15', '2021-01-16'])
+    'date'
+    >>> _infer_json_type([1, 'a'])
+    'any'
+    """
+    types = set()
+    for value in values:
+        if value is None:
+            continue
+        elif isinstance(value, bool):
+            types.add('boolean')
+        elif isinstance(value, six.integer_types):
+            types.add('integer')
+        elif isinstance(value, float):
+            types.add('number')
+        elif isinstance(value, six.string_types):
+            types.add('string')
+        elif isinstance(value, dict):
+            types.add('object')
+        else:
+            types.add('array')
+
+    if not types:
+        return 'string'
+    elif types == {'integer', 'number'}:
+        return 'number'
+    elif types == {'string'}:
+        string_type = _infer_string_type(values)
+        return string_type if string_type in ('date', 'datetime') else 'string'
+    elif len(types) == 1:
+        return types.pop()
+    return 'any'
+
+
+def enqueue(resource):
+    # type: (Dict[str, Any]) -> None
+    """Enqueue a background job to infer the schema and sample of a resource, if enabled and needed
+    """
+    if not toolkit.asbool(toolkit.config.get(INFERENCE_CONF_KEY, False)) or not needs_inference(resource):
+        return
+    toolkit.enqueue_job(infer_resource_metadata_job, [resource['id']],
+                        title='Infer schema and sample of resource {}'.format(resource['id']))
+
+
+def infer_resource_metadata_job(resource_id):
+    # type: (str) -> None
+    """Background job inferring the schema and sample of a resource
+    """
+    context = _site_user_context()
+    resource = toolkit.get_action('resource_show')(dict(context), {'id': resource_id})
+    try:
+        infer_resource_metadata(context, resource)
+    except InferenceError as e:
+        log.info("Could not infer schema and sample of resource %s: %s", resource_id, e)
+
+
+def _site_user_context():
+    # type: () -> Dict[str, Any]
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {'user': site_user['name'], 'ignore_auth': True}
@@ -59,3 +59,29 @@ class IResourceDownloadHandler(Interface):
         download behavior will be executed.
         """
         pass
+
+
+class IBlobStorageMetrics(Interface):
+    """A CKAN plugin interface for collecting blob storage performance metrics
+
+    Plugins implementing this interface are notified of timings and counts
+    measured in hot code paths, such as LFS batch requests, authorization
+    checks and download handlers, and can forward them to a monitoring system.
+
+    Metric names are short, unprefixed strings such as
+    ``lfs_batch_duration_seconds``; ``labels`` is a dictionary of string
+    label names to string values. Implementations should be fast and must
+    not raise exceptions, as they are called in the request path.
+    """
+
+    def increment(self, name, value=1, labels=None):
+        # type: (str, float, Optional[Dict[str, str]]) -> None
+        """Increment a counter metric by ``value``
+        """
+        pass
+
+    def observe(self, name, value, labels=None):
+        # type: (str, float, Optional[Dict[str, str]]) -> None
+        """Record an observation, typically a duration in seconds, of a histogram metric
+        """
+        pass
@@ -0,0 +1,216 @@
+"""Git LFS server client, with timeouts and failure isolation
+
+Requests to the LFS server are made with connect and read timeouts
+(``ckanext.blob_storage.lfs.connect_timeout`` and
+``ckanext.blob_storage.lfs.read_timeout``, in seconds).
+
+Batch requests are also guarded by a per-process circuit breaker: once
+``ckanext.blob_storage.lfs.failure_threshold`` consecutive requests have failed
+because of a request error (such as a timeout) or a server error, requests fail
+immediately with :exc:`LfsUnavailable` for ``ckanext.blob_storage.lfs.retry_after``
+seconds. After that, a single trial request is let through; If it succeeds,
+requests are allowed again. Uploads made by :func:`upload` are not guarded.
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import requests
+from ckan.plugins import toolkit
+from giftless_client import LfsClient, exc
+
+from . import helpers, metrics
+
+CONNECT_TIMEOUT_CONF_KEY = 'ckanext.blob_storage.lfs.connect_timeout'
+READ_TIMEOUT_CONF_KEY = 'ckanext.blob_storage.lfs.read_timeout'
+FAILURE_THRESHOLD_CONF_KEY = 'ckanext.blob_storage.lfs.failure_threshold'
+RETRY_AFTER_CONF_KEY = 'ckanext.blob_storage.lfs.retry_after'
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RETRY_AFTER = 30
+
+log = logging.getLogger(__name__)
+
+
+class LfsUnavailable(Exception):
+    """The LFS server is not available, and should not be retried for ``retry_after`` seconds
+    """
+
+    def __init__(self, message, retry_after):
+        # type: (str, int) -> None
+        super(LfsUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class TimeoutLfsClient(LfsClient):
+    """LFS client sending batch requests with connect and read timeouts
+    """
+
+    def __init__(self, lfs_server_url, auth_token=None, timeout=None, **kwargs):
+        super(TimeoutLfsClient, self).__init__(lfs_server_url, auth_token, **kwargs)
+        self._timeout = timeout
+
+    def batch(self, prefix, operation, objects, ref=None, transfers=None):
+        # type: (str, str, List[Dict[str, Any]], Optional[str], Optional[List[str]]) -> Dict[str, Any]
+        url = self._url_for(prefix, 'objects', 'batch')
+        if transfers is None:
+            transfers = self._transfer_adapters
+
+        payload = {'transfers': transfers,
+                   'operation': operation,
+                   'objects': objects}
+        if ref:
+            payload['ref'] = ref
+
+        headers = {'Content-type': self.LFS_MIME_TYPE,
+                   'Accept': self.LFS_MIME_TYPE}
+        if self._auth_token:
+            headers['Authorization'] = 'Bearer {}'.format(self._auth_token)
+
+        response = requests.post(url, json=payload, headers=headers, timeout=self._timeout)
+        if response.status_code != 200:
+            raise exc.LfsError("Unexpected response from LFS server: {}".format(response.status_code),
+                               status_code=response.status_code)
+        return response.json()
+
+
+class CircuitBreaker(object):
+    """A simple, thread safe circuit breaker
+
+    Call :meth:`before_call` before each guarded call, and then either
+    :meth:`record_success` or :meth:`record_failure`.
+    """
+
+    def __init__(self, failure_threshold, retry_after):
+        # type: (int, int) -> None
+        self.failure_threshold = failure_threshold
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None  # type: Optional[float]
+        self._trial_in_progress = False
+
+    @property
+    def is_open(self):
+        # type: () -> bool
+        return self._opened_at is not None
+
+    def before_call(self):
+        # type: () -> None
+        """Check that a call is allowed, raising :exc:`LfsUnavailable` if not
+        """
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.retry_after - time.time()
+            if remaining <= 0 and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return
+        raise LfsUnavailable("LFS server is unavailable", retry_after=max(int(remaining + 0.5), 1))
+
+    def record_success(self):
+        # type: () -> None
+        with self._lock:
+            if self._opened_at is not None:
+                log.info("LFS server is available again, closing circuit breaker")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        # type: () -> None
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            self._trial_in_progress = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    log.warning("LFS server failed %d consecutive requests, opening circuit breaker", self._failures)
+                    metrics.increment('lfs_circuit_breaker_opened_total')
+                self._opened_at = time.time()
+
+
+_breaker = None  # type: Optional[CircuitBreaker]
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    # type: () -> CircuitBreaker
+    """Get this process's LFS server circuit breaker
+    """
+    global _breaker
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    failure_threshold=toolkit.asint(toolkit.config.get(FAILURE_THRESHOLD_CONF_KEY,
+                                                                       DEFAULT_FAILURE_THRESHOLD)),
+                    retry_after=toolkit.asint(toolkit.config.get(RETRY_AFTER_CONF_KEY, DEFAULT_RETRY_AFTER)))
+    return _breaker
+
+
+def get_client(auth_token=None):
+    # type: (Optional[str]) -> TimeoutLfsClient
+    """Get an LFS client for the configured LFS server
+    """
+    timeout = (float(toolkit.config.get(CONNECT_TIMEOUT_CONF_KEY, DEFAULT_CONNECT_TIMEOUT)),
+               float(toolkit.config.get(READ_TIMEOUT_CONF_KEY, DEFAULT_READ_TIMEOUT)))
+    return TimeoutLfsClient(helpers.server_url(), auth_token, timeout=timeout)
+
+
+def batch(client, lfs_prefix, operation, objects, transfers=None):
+    # type: (LfsClient, str, str, List[Dict[str, Any]], Optional[List[str]]) -> Dict[str, Any]
+    """Send a batch request through the circuit breaker
+
+    Request errors (such as timeouts and connection errors) and server errors
+    count as failures, and are raised as :exc:`LfsUnavailable`. Any other
+    unexpected error, such as an invalid response body, also counts as a
+    failure, but is raised as is. Client errors are raised as is.
+    """
+    breaker = get_circuit_breaker()
+    breaker.before_call()
+    try:
+        response = client.batch(lfs_prefix, operation, objects, transfers=transfers)
+    except requests.RequestException as e:
+        breaker.record_failure()
+        raise LfsUnavailable("LFS server request failed: {}".format(e), retry_after=breaker.retry_after)
+    except exc.LfsError as e:
+        if e.status_code is not None and e.status_code >= 500:
+            breaker.record_failure()
+            raise LfsUnavailable("LFS server request failed: {}".format(e), retry_after=breaker.retry_after)
+        breaker.record_success()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    return response
+
+
+def upload(client, file_obj, lfs_prefix, object_attrs):
+    # type: (LfsClient, Any, str, Dict[str, Any]) -> None
+    """Upload a file whose ``oid`` (sha256) and ``size`` are already known
+
+    Unlike :meth:`LfsClient.upload`, this does not read the file to hash it
+    before uploading. Nothing is uploaded if the object is already stored.
+
+    This deliberately bypasses the circuit breaker, which protects web
+    requests: It is used by long running commands, which retry failed
+    uploads themselves, and should not skip files because of a short outage.
+    """
+    response = client.batch(lfs_prefix, 'upload', [object_attrs])
+    object_spec = response['objects'][0]
+    if 'error' in object_spec:
+        raise exc.LfsError("LFS server refused upload: {}".format(object_spec['error'].get('message')),
+                           status_code=object_spec['error'].get('code'))
+    try:
+        adapter = client.TRANSFER_ADAPTERS[response.get('transfer', 'basic')]()
+    except KeyError:
+        raise ValueError("Unsupported transfer adapter: {}".format(response['transfer']))
+    adapter.upload(file_obj, object_spec)
@@ -0,0 +1,264 @@
+"""Performance metrics for ckanext-blob-storage
+
+Hot code paths report timings and counts using the functions in this module,
+which dispatch them to all plugins implementing
+:class:`~ckanext.blob_storage.interfaces.IBlobStorageMetrics`.
+
+If enabled in configuration, timings are also collected per request and
+sent to clients in a ``Server-Timing`` response header; see
+:class:`RequestTimings`.
+
+This module also provides :class:`PrometheusRegistry`, a simple in-process
+metrics store used by the ``blob_storage_prometheus`` plugin to expose
+metrics in the Prometheus text exposition format.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Optional, Tuple
+
+from ckan import plugins
+from ckan.plugins import toolkit
+from flask import g, has_request_context
+
+from .interfaces import IBlobStorageMetrics
+
+SERVER_TIMING_CONF_KEY = 'ckanext.blob_storage.server_timing'
+
+METRIC_NAME_PREFIX = 'blob_storage_'
+
+DURATION_SUFFIX = '_duration_seconds'
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+log = logging.getLogger(__name__)
+
+
+def increment(name, value=1, **labels):
+    # type: (str, float, str) -> None
+    """Increment a counter metric in all metrics plugins
+    """
+    for plugin in plugins.PluginImplementations(IBlobStorageMetrics):
+        try:
+            plugin.increment(name, value, labels)
+        except Exception:
+            log.exception("Metrics plugin %s failed to increment %s", plugin, name)
+
+
+def observe(name, value, **labels):
+    # type: (str, float, str) -> None
+    """Record a histogram observation in all metrics plugins
+
+    Durations are also added to the current request's timings, if recorded
+    """
+    timings = request_timings()
+    if timings is not None and name.endswith(DURATION_SUFFIX):
+        timings.add(labels.get('action', name[0:-len(DURATION_SUFFIX)]), value)
+
+    for plugin in plugins.PluginImplementations(IBlobStorageMetrics):
+        try:
+            plugin.observe(name, value, labels)
+        except Exception:
+            log.exception("Metrics plugin %s failed to observe %s", plugin, name)
+
+
+@contextmanager
+def timer(name, **labels):
+    # type: (str, str) -> Generator[Dict[str, str], None, None]
+    """Measure the time it takes to run a block of code, in seconds
+
+    This is a context manager yielding the ``labels`` dictionary, which can be
+    modified inside the block to set labels that are only known once the
+    timed operation is done, for example a response status code. The duration
+    is reported even if the block raises an exception.
+    """
+    start = time.time()
+    try:
+        yield labels
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def call_action(name, context, data_dict):
+    # type: (str, Dict[str, Any], Dict[str, Any]) -> Any
+    """Call a CKAN action, measuring its duration as ``action_duration_seconds``
+    """
+    with timer('action_duration_seconds', action=name):
+        return toolkit.get_action(name)(context, data_dict)
+
+
+class RequestTimings(object):
+    """Total duration and number of calls of each timed operation in a single request
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()  # type: Dict[str, list]
+
+    def add(self, name, duration):
+        # type: (str, float) -> None
+        entry = self._entries.setdefault(name, [0.0, 0])
+        entry[0] += duration
+        entry[1] += 1
+
+    def as_dict(self):
+        # type: () -> Dict[str, Dict[str, Any]]
+        return OrderedDict((name, {'duration_ms': round(duration * 1000, 3), 'calls': calls})
+                           for name, (duration, calls) in self._entries.items())
+
+    def server_timing_header(self):
+        # type: () -> str
+        """Format timings as a ``Server-Timing`` header value
+
+        >>> timings = RequestTimings()
+        >>> timings.add('package_show', 0.0125)
+        >>> timings.add('package_show', 0.0075)
+        >>> timings.add('lfs_batch', 0.1)
+        >>> timings.server_timing_header()
+        'package_show;dur=20.0;desc="2 calls", lfs_batch;dur=100.0;desc="1 calls"'
+        """
+        return ', '.join('{};dur={};desc="{} calls"'.format(name, t['duration_ms'], t['calls'])
+                         for name, t in self.as_dict().items())
+
+
+def start_request_timings():
+    # type: () -> Optional[RequestTimings]
+    """Start recording timings for the current request, if enabled in configuration
+
+    Returns the request's :class:`RequestTimings` object, or ``None`` if not
+    enabled or not in a request context. Calling this more than once during
+    a request will return the same object.
+    """
+    if not has_request_context() or not toolkit.asbool(toolkit.config.get(SERVER_TIMING_CONF_KEY, False)):
+        return None
+    timings = request_timings()
+    if timings is None:
+        timings = g.blob_storage_request_timings = RequestTimings()
+    return timings
+
+
+def request_timings():
+    # type: () -> Optional[RequestTimings]
+    """Get the current request's recorded timings, if timings are being recorded
+    """
+    if not has_request_context():
+        return None
+    return getattr(g, 'blob_storage_request_timings', None)
+
+
+class PrometheusRegistry(object):
+    """In-process store of counters and histograms, renderable in Prometheus text format
+
+    Note that each CKAN worker process has its own registry, so when running
+    multiple worker processes each scrape will only reflect the metrics of
+    the worker that happened to handle it.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix=METRIC_NAME_PREFIX):
+        self._buckets = tuple(sorted(buckets))
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}  # type: Dict[str, Dict[Tuple, float]]
+        self._histograms = {}  # type: Dict[str, Dict[Tuple, list]]
+
+    def increment(self, name, value=1, labels=None):
+        # type: (str, float, Optional[Dict[str, str]]) -> None
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        # type: (str, float, Optional[Dict[str, str]]) -> None
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # Bucket counts are stored non-cumulatively, followed by sum and count
+            state = series.setdefault(key, [0] * len(self._buckets) + [0.0, 0])
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        # type: () -> str
+        """Render all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                full_name = self._prefix + name
+                lines.append('# TYPE {} counter'.format(full_name))
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append('{}{} {}'.format(full_name, _format_labels(key), _format_value(value)))
+
+            for name in sorted(self._histograms):
+                full_name = self._prefix + name
+                lines.append('# TYPE {} histogram'.format(full_name))
+                for key, state in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(self._buckets, state):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(
+                            full_name, _format_labels(key, le=_format_value(bound)), cumulative))
+                    lines.append('{}_bucket{} {}'.format(full_name, _format_labels(key, le='+Inf'), state[-1]))
+                    lines.append('{}_sum{} {}'.format(full_name, _format_labels(key), _format_value(state[-2])))
+                    lines.append('{}_count{} {}'.format(full_name, _format_labels(key), state[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels_key(labels):
+    # type: (Optional[Dict[str, str]]) -> Tuple
+    if not labels:
+        return ()
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, **extra):
+    # type: (Tuple, str) -> str
+    """Format a label set for the Prometheus text format
+
+    >>> _format_labels((('status', '200'), ('operation', 'download')))
+    '{status="200",operation="download"}'
+    >>> _format_labels((), le='0.5')
+    '{le="0.5"}'
+    >>> _format_labels(())
+    ''
+    >>> _format_labels((('message', 'say "hi"'),))
+    '{message="say \\\\"hi\\\\""}'
+    """
+    pairs = list(key) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape_label_value(v)) for k, v in pairs) + '}'
+
+
+def _escape_label_value(value):
+    # type: (str) -> str
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    # type: (float) -> str
+    """Format a numeric value for the Prometheus text format
+
+    >>> _format_value(3)
+    '3'
+    >>> _format_value(0.25)
+    '0.25'
+    >>> _format_value(10.0)
+    '10.0'
+    """
+    return repr(value)
+
+
+prometheus_registry = PrometheusRegistry()
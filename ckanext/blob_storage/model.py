@@ -0,0 +1,181 @@
+"""Database tables used by ckanext-blob-storage
+"""
+import datetime
+import hashlib
+import uuid
+from typing import Any, Dict, List, Optional
+
+from ckan.model import meta
+from six import ensure_binary
+from sqlalchemy import Column, ForeignKey, Table, and_, func, select, types
+from sqlalchemy.dialects.postgresql import insert
+
+resource_metadata_table = Table(
+    'blob_storage_resource_metadata', meta.metadata,
+    Column('ref', types.UnicodeText, primary_key=True),
+    Column('content', types.UnicodeText, nullable=False),
+    Column('created', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+multipart_upload_table = Table(
+    'blob_storage_multipart_upload', meta.metadata,
+    Column('id', types.UnicodeText, primary_key=True),
+    Column('package_id', types.UnicodeText, nullable=False, index=True),
+    Column('sha256', types.UnicodeText, nullable=False),
+    Column('size', types.BigInteger, nullable=False),
+    Column('user_id', types.UnicodeText),
+    Column('created', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+multipart_upload_part_table = Table(
+    'blob_storage_multipart_upload_part', meta.metadata,
+    Column('upload_id', types.UnicodeText,
+           ForeignKey('blob_storage_multipart_upload.id', ondelete='CASCADE'), primary_key=True),
+    Column('pos', types.BigInteger, primary_key=True, autoincrement=False),
+    Column('size', types.BigInteger, nullable=False),
+)
+
+download_count_table = Table(
+    'blob_storage_download_count', meta.metadata,
+    Column('resource_id', types.UnicodeText, primary_key=True),
+    Column('package_id', types.UnicodeText, nullable=False),
+    Column('count', types.BigInteger, nullable=False, index=True),
+    Column('last_download', types.DateTime, nullable=False),
+)
+
+TABLES = [resource_metadata_table, multipart_upload_table, multipart_upload_part_table, download_count_table]
+
+
+def create_tables():
+    # type: () -> None
+    """Create tables used by this extension, if they do not exist yet
+    """
+    meta.metadata.create_all(bind=meta.engine, tables=TABLES, checkfirst=True)
+
+
+def resource_metadata_ref(content):
+    # type: (str) -> str
+    """Get the content address of a resource metadata value
+
+    >>> resource_metadata_ref('{}')
+    'sha256:44136fa355b3678a1146ad16f7e8649e94fb4fc21fe77e8310c060f61caaff8a'
+    """
+    return 'sha256:{}'.format(hashlib.sha256(ensure_binary(content)).hexdigest())
+
+
+def save_resource_metadata(content):
+    # type: (str) -> str
+    """Store a resource metadata value (e.g. a large schema or sample) and return its reference
+
+    Values are content addressed, so storing the same value more than once
+    is a no-op. Values are never deleted, as they may still be referenced
+    by old versions of resources in the activity stream.
+
+    The value is inserted in the current database session, and will be
+    committed or rolled back with it.
+    """
+    ref = resource_metadata_ref(content)
+    stmt = insert(resource_metadata_table).values(ref=ref, content=content).on_conflict_do_nothing()
+    meta.Session.execute(stmt)
+    return ref
+
+
+def get_resource_metadata(ref):
+    # type: (str) -> Optional[str]
+    """Get a stored resource metadata value by reference
+    """
+    stmt = select([resource_metadata_table.c.content]).where(resource_metadata_table.c.ref == ref)
+    return meta.Session.execute(stmt).scalar()
+
+
+def find_multipart_upload(package_id, sha256, size):
+    # type: (str, str, int) -> Optional[Dict[str, Any]]
+    """Find an unfinished multipart upload of an object to a dataset
+    """
+    t = multipart_upload_table
+    stmt = select([t]).where(and_(t.c.package_id == package_id, t.c.sha256 == sha256, t.c.size == size))\
+        .order_by(t.c.created.desc()).limit(1)
+    row = meta.Session.execute(stmt).first()
+    return dict(row) if row else None
+
+
+def get_multipart_upload(upload_id):
+    # type: (str) -> Optional[Dict[str, Any]]
+    """Get a multipart upload by ID
+    """
+    row = meta.Session.execute(select([multipart_upload_table])
+                               .where(multipart_upload_table.c.id == upload_id)).first()
+    return dict(row) if row else None
+
+
+def create_multipart_upload(package_id, sha256, size, user_id=None):
+    # type: (str, str, int, Optional[str]) -> Dict[str, Any]
+    """Start tracking a multipart upload
+    """
+    upload = {'id': str(uuid.uuid4()),
+              'package_id': package_id,
+              'sha256': sha256,
+              'size': size,
+              'user_id': user_id,
+              'created': datetime.datetime.utcnow()}
+    meta.Session.execute(multipart_upload_table.insert().values(**upload))
+    return upload
+
+
+def delete_multipart_upload(upload_id):
+    # type: (str) -> None
+    """Stop tracking a multipart upload, and forget about its uploaded parts
+    """
+    meta.Session.execute(multipart_upload_part_table.delete()
+                         .where(multipart_upload_part_table.c.upload_id == upload_id))
+    meta.Session.execute(multipart_upload_table.delete().where(multipart_upload_table.c.id == upload_id))
+
+
+def add_multipart_upload_part(upload_id, pos, size):
+    # type: (str, int, int) -> None
+    """Mark a part of a multipart upload as uploaded
+
+    Parts can be reported concurrently and more than once.
+    """
+    stmt = insert(multipart_upload_part_table).values(upload_id=upload_id, pos=pos, size=size)\
+        .on_conflict_do_nothing()
+    meta.Session.execute(stmt)
+
+
+def get_multipart_upload_parts(upload_id):
+    # type: (str) -> List[Dict[str, int]]
+    """Get the uploaded parts of a multipart upload, ordered by position
+    """
+    t = multipart_upload_part_table
+    stmt = select([t.c.pos, t.c.size]).where(t.c.upload_id == upload_id).order_by(t.c.pos)
+    return [{'pos': row.pos, 'size': row.size} for row in meta.Session.execute(stmt)]
+
+
+def add_download_counts(counts):
+    # type: (List[Dict[str, Any]]) -> None
+    """Add to the download counts of multiple resources, in a single statement
+
+    Each item should have ``resource_id``, ``package_id``, ``count`` and
+    ``last_download``. This runs in its own transaction, and not in the
+    current database session, so it is safe to call from any thread.
+    """
+    if not counts:
+        return
+    t = download_count_table
+    stmt = insert(t).values(counts)
+    stmt = stmt.on_conflict_do_update(index_elements=[t.c.resource_id], set_={
+        'package_id': stmt.excluded.package_id,
+        'count': t.c.count + stmt.excluded.count,
+        'last_download': func.greatest(t.c.last_download, stmt.excluded.last_download),
+    })
+    with meta.engine.begin() as connection:
+        connection.execute(stmt)
+
+
+def get_top_downloads(limit):
+    # type: (int) -> List[Dict[str, Any]]
+    """Get the download counts of the most downloaded resources
+    """
+    t = download_count_table
+    stmt = select([t]).order_by(t.c.count.desc(), t.c.resource_id).limit(limit)
+    return [dict(row) for row in meta.Session.execute(stmt)]
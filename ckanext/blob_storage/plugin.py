@@ -1,13 +1,17 @@
+from typing import TYPE_CHECKING
+
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.authz_service.authzzie import Authzzie
 from ckanext.authz_service.interfaces import IAuthorizationBindings
 
-from . import actions, authz, helpers, validators
-from .blueprints import blueprint
-from .download_handler import download_handler
-from .interfaces import IResourceDownloadHandler
+from . import helpers, metrics, validators
+from .interfaces import IBlobStorageMetrics, IResourceDownloadHandler
+
+# Modules with heavy dependencies (such as giftless_client) are imported on
+# first use, to keep plugin loading and worker startup fast
+if TYPE_CHECKING:
+    from ckanext.authz_service.authzzie import Authzzie  # noqa: F401
 
 
 class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
@@ -19,6 +23,7 @@ class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(IResourceDownloadHandler, inherit=True)
     plugins.implements(plugins.IValidators)
     plugins.implements(plugins.IDatasetForm)
+    plugins.implements(plugins.IResourceController, inherit=True)
 
     # IDatasetForm
     def create_package_schema(self):
@@ -45,6 +50,7 @@ class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
                 toolkit.get_validator('valid_lfs_prefix'),
             ]
         })
+        schema['resources'].update(self._external_metadata_schema())
 
         return schema
 
@@ -71,9 +77,21 @@ class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
                 toolkit.get_validator('valid_lfs_prefix'),
             ]
         })
+        schema['resources'].update(self._external_metadata_schema())
 
         return schema
 
+    def _external_metadata_schema(self):
+        if not toolkit.asbool(toolkit.config.get(validators.EXTERNAL_METADATA_CONF_KEY, False)):
+            return {}
+        schema = {}
+        for field in ('schema', 'sample'):
+            # Run for missing values too, as references passed by clients are replaced with stored ones
+            schema[field] = [toolkit.get_validator('store_large_value_externally'),
+                             toolkit.get_validator('ignore_missing')]
+            schema['{}_ref'.format(field)] = [toolkit.get_validator('ignore_missing')]
+        return schema
+
     def is_fallback(self):
         # Return True to register this plugin as the default handler for
         # package types not handled by any other IDatasetForm plugin.
@@ -93,6 +111,7 @@ class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             u'upload_has_lfs_prefix': validators.upload_has_lfs_prefix,
             u'valid_sha256': validators.valid_sha256,
             u'valid_lfs_prefix': validators.valid_lfs_prefix,
+            u'store_large_value_externally': validators.store_large_value_externally,
         }
 
     # IConfigurer
@@ -111,17 +130,41 @@ class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     # IBlueprint
 
     def get_blueprint(self):
+        from .blueprints import blueprint
         return blueprint
 
     # IActions
 
     def get_actions(self):
+        from . import actions
         return {
             'get_resource_download_spec': actions.get_resource_download_spec,
+            'authz_authorize': actions.authz_authorize,
             'resource_schema_show': actions.resource_schema_show,
-            'resource_sample_show': actions.resource_sample_show
+            'resource_sample_show': actions.resource_sample_show,
+            'blob_storage_register_resources': actions.blob_storage_register_resources,
+            'blob_storage_upload_spec': actions.blob_storage_upload_spec,
+            'blob_storage_objects_exist': actions.blob_storage_objects_exist,
+            'blob_storage_top_downloads': actions.blob_storage_top_downloads,
+            'blob_storage_multipart_upload_start': actions.blob_storage_multipart_upload_start,
+            'blob_storage_multipart_upload_part_done': actions.blob_storage_multipart_upload_part_done,
+            'blob_storage_multipart_upload_show': actions.blob_storage_multipart_upload_show,
+            'blob_storage_multipart_upload_delete': actions.blob_storage_multipart_upload_delete,
         }
 
+    # IResourceController
+
+    def after_create(self, context, resource):
+        self._enqueue_inference(context, resource)
+
+    def after_update(self, context, resource):
+        self._enqueue_inference(context, resource)
+
+    def _enqueue_inference(self, context, resource):
+        from . import inference
+        if not context.get(inference.CONTEXT_FLAG):
+            inference.enqueue(resource)
+
     # IAuthorizationBindings
 
     def register_authz_bindings(self, authorizer):
@@ -131,6 +174,8 @@ class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
         This aliases CKANs Resource entity and actions to scopes understood by
         Giftless' JWT authorization scheme
         """
+        from . import authz
+
         # Register object authorization bindings
         authorizer.register_entity_ref_parser('obj', authz.object_id_parser)
         authorizer.register_authorizer('obj', authz.check_object_permissions,
@@ -142,4 +187,29 @@ class BlobStoragePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     # IResourceDownloadHandler
 
     def resource_download(self, resource, package, filename=None, inline=False, activity_id=None):
+        from .download_handler import download_handler
         return download_handler(resource, package, filename, inline, activity_id)
+
+
+class BlobStoragePrometheusPlugin(plugins.SingletonPlugin):
+    """Collect blob storage metrics and expose them in the Prometheus text format
+
+    Metrics are kept in memory, per worker process, and are served at
+    ``/blob-storage/metrics``.
+    """
+    plugins.implements(IBlobStorageMetrics)
+    plugins.implements(plugins.IBlueprint)
+
+    # IBlobStorageMetrics
+
+    def increment(self, name, value=1, labels=None):
+        metrics.prometheus_registry.increment(name, value, labels)
+
+    def observe(self, name, value, labels=None):
+        metrics.prometheus_registry.observe(name, value, labels)
+
+    # IBlueprint
+
+    def get_blueprint(self):
+        from .blueprints import metrics_blueprint
+        return metrics_blueprint
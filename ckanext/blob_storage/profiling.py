@@ -0,0 +1,286 @@
+"""Sampling profiler for blob storage views and actions
+
+When ``ckanext.blob_storage.profiler.dir`` is set, functions decorated with
+:func:`profiled` may be profiled, and their profiles saved to that directory:
+
+* Every Nth call (``ckanext.blob_storage.profiler.every_n_requests``) is
+  profiled using :mod:`cProfile`, and saved as a ``.prof`` file which can be
+  loaded with :mod:`pstats` or tools such as ``snakeviz``.
+* If ``ckanext.blob_storage.profiler.slow_request_ms`` is set, all other calls
+  are sampled by a low overhead statistical profiler, and calls taking longer
+  than the threshold are saved in the "folded stacks" format used by
+  ``flamegraph.pl`` and ``speedscope``, as a ``.folded`` file.
+
+File names include the route, resource ID and the number of resources in the
+dataset, if known. Once the total size of profiles in the directory exceeds
+``ckanext.blob_storage.profiler.max_disk_mb``, the oldest files are deleted.
+
+Note that the statistical profiler samples OS threads, and will not produce
+useful results when running under an asynchronous worker such as gevent.
+"""
+import cProfile
+import functools
+import itertools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Optional
+
+from ckan.plugins import toolkit
+
+PROFILER_DIR_CONF_KEY = 'ckanext.blob_storage.profiler.dir'
+PROFILER_EVERY_N_CONF_KEY = 'ckanext.blob_storage.profiler.every_n_requests'
+PROFILER_SLOW_MS_CONF_KEY = 'ckanext.blob_storage.profiler.slow_request_ms'
+PROFILER_MAX_DISK_CONF_KEY = 'ckanext.blob_storage.profiler.max_disk_mb'
+PROFILER_INTERVAL_CONF_KEY = 'ckanext.blob_storage.profiler.sample_interval_ms'
+
+DEFAULT_MAX_DISK_MB = 100
+DEFAULT_SAMPLE_INTERVAL_MS = 5
+
+PROFILE_FILE_EXTENSIONS = ('.prof', '.folded')
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_call_counter = itertools.count(1)
+_call_counter_lock = threading.Lock()
+
+
+def profiled(route):
+    # type: (str) -> Callable
+    """Decorator for view and action functions that should be profiled according to configuration
+
+    Calls made while another profiled call is in progress in the same thread,
+    for example an action called by a view, are not profiled separately.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile_dir = toolkit.config.get(PROFILER_DIR_CONF_KEY)
+            if not profile_dir or getattr(_local, 'annotations', None) is not None:
+                return func(*args, **kwargs)
+
+            _local.annotations = {'resource_id': _get_resource_id(args, kwargs)}
+            try:
+                if _is_nth_call():
+                    return _run_with_cprofile(profile_dir, route, func, *args, **kwargs)
+                slow_ms = toolkit.asint(toolkit.config.get(PROFILER_SLOW_MS_CONF_KEY, 0))
+                if slow_ms > 0:
+                    return _run_with_sampler(profile_dir, route, slow_ms, func, *args, **kwargs)
+                return func(*args, **kwargs)
+            finally:
+                _local.annotations = None
+
+        return wrapper
+    return decorator
+
+
+def annotate(**annotations):
+    # type: (Any) -> None
+    """Add information about the current call, used in profile file names
+
+    Supported annotations are ``resource_id`` and ``dataset_size``. This does
+    nothing if the current call is not being profiled.
+    """
+    current = getattr(_local, 'annotations', None)
+    if current is not None:
+        current.update(annotations)
+
+
+def _is_nth_call():
+    # type: () -> bool
+    every_n = toolkit.asint(toolkit.config.get(PROFILER_EVERY_N_CONF_KEY, 0))
+    if every_n <= 0:
+        return False
+    with _call_counter_lock:
+        return next(_call_counter) % every_n == 0
+
+
+def _run_with_cprofile(profile_dir, route, func, *args, **kwargs):
+    profile = cProfile.Profile()
+    start = time.time()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        _save_profile(profile_dir, route, time.time() - start, '.prof', profile.dump_stats)
+
+
+def _run_with_sampler(profile_dir, route, slow_ms, func, *args, **kwargs):
+    thread_id = threading.current_thread().ident
+    samples = _get_sampler().register(thread_id)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        duration = time.time() - start
+        _get_sampler().unregister(thread_id)
+        if duration * 1000 >= slow_ms and samples:
+            _save_profile(profile_dir, route, duration, '.folded', functools.partial(_write_folded, samples))
+
+
+def _write_folded(samples, path):
+    # type: (Counter, str) -> None
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write('{} {}\n'.format(stack, count))
+
+
+def _save_profile(profile_dir, route, duration, extension, write):
+    # type: (str, str, float, str, Callable[[str], None]) -> None
+    """Save a profile using ``write(path)``, and enforce the disk quota
+
+    Errors are only logged, so that profiling never changes the outcome of a call.
+    """
+    try:
+        path = _profile_file_path(profile_dir, route, duration, extension)
+        write(path)
+    except (IOError, OSError) as e:
+        log.warning("Failed saving profile to %s: %s", profile_dir, e)
+        return
+    _enforce_disk_quota(profile_dir, path)
+
+
+class _StackSampler(object):
+    """Background thread periodically sampling the call stacks of registered threads
+    """
+
+    def __init__(self, interval):
+        # type: (float) -> None
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._threads = {}  # type: Dict[int, Counter]
+        self._wakeup = threading.Event()
+        thread = threading.Thread(target=self._run, name='blob-storage-profiler')
+        thread.daemon = True
+        thread.start()
+
+    def register(self, thread_id):
+        # type: (int) -> Counter
+        samples = Counter()
+        with self._lock:
+            self._threads[thread_id] = samples
+        self._wakeup.set()
+        return samples
+
+    def unregister(self, thread_id):
+        # type: (int) -> None
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            # Sampling is done while holding the lock, so that samples are not
+            # modified once their thread has been unregistered
+            with self._lock:
+                if self._threads:
+                    frames = sys._current_frames()
+                    for thread_id, samples in self._threads.items():
+                        frame = frames.get(thread_id)
+                        if frame is not None:
+                            samples[_folded_stack(frame)] += 1
+                    del frames
+                else:
+                    self._wakeup.clear()
+
+            if self._wakeup.is_set():
+                time.sleep(self._interval)
+            else:
+                self._wakeup.wait()
+
+
+def _folded_stack(frame):
+    # type: (Any) -> str
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+_sampler = None  # type: Optional[_StackSampler]
+_sampler_lock = threading.Lock()
+
+
+def _get_sampler():
+    # type: () -> _StackSampler
+    global _sampler
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                interval = toolkit.asint(toolkit.config.get(PROFILER_INTERVAL_CONF_KEY, DEFAULT_SAMPLE_INTERVAL_MS))
+                _sampler = _StackSampler(interval / 1000.0)
+    return _sampler
+
+
+def _get_resource_id(args, kwargs):
+    # type: (tuple, Dict[str, Any]) -> Optional[str]
+    """Get the resource ID from view function keyword arguments or action ``data_dict``
+    """
+    if kwargs.get('resource_id'):
+        return kwargs['resource_id']
+    if len(args) > 1 and isinstance(args[1], dict):
+        data_dict = args[1]
+        if isinstance(data_dict.get('resource'), dict):
+            return data_dict['resource'].get('id')
+        return data_dict.get('id')
+    return None
+
+
+def _profile_file_path(profile_dir, route, duration, extension):
+    # type: (str, str, float, str) -> str
+    """Get a unique file name for a profile, based on the call's route and annotations
+    """
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    annotations = getattr(_local, 'annotations', None) or {}
+    dataset_size = annotations.get('dataset_size')
+    name = '{time}-{route}-{resource}-{size}-{duration}ms-{pid}-{thread}{ext}'.format(
+        time=time.strftime('%Y%m%dT%H%M%S'),
+        route=_safe_name(route),
+        resource=_safe_name(annotations.get('resource_id') or 'none'),
+        size='{}res'.format(dataset_size) if dataset_size is not None else 'nores',
+        duration=int(duration * 1000),
+        pid=os.getpid(),
+        thread=threading.current_thread().ident,
+        ext=extension)
+    return os.path.join(profile_dir, name)
+
+
+def _safe_name(value):
+    # type: (str) -> str
+    """Make a string safe for use in a file name
+
+    >>> _safe_name('get_resource_download_spec')
+    'get_resource_download_spec'
+    >>> _safe_name('../../etc/passwd')
+    '.._.._etc_passwd'
+    """
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', value)[0:64]
+
+
+def _enforce_disk_quota(profile_dir, new_file):
+    # type: (str, str) -> None
+    """Delete the oldest profile files until the directory is within the configured quota
+    """
+    max_bytes = toolkit.asint(toolkit.config.get(PROFILER_MAX_DISK_CONF_KEY, DEFAULT_MAX_DISK_MB)) * 1024 * 1024
+    try:
+        files = []
+        for name in os.listdir(profile_dir):
+            if os.path.splitext(name)[1] in PROFILE_FILE_EXTENSIONS:
+                stat = os.stat(os.path.join(profile_dir, name))
+                files.append((stat.st_mtime, stat.st_size, os.path.join(profile_dir, name)))
+
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files, key=lambda f: (f[2] == new_file, f[0])):
+            if total <= max_bytes:
+                break
+            os.unlink(path)
+            total -= size
+            log.debug("Deleted profile %s to stay within disk quota", path)
+    except OSError:
+        log.exception("Failed enforcing disk quota for profiles in %s", profile_dir)
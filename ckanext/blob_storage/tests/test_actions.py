@@ -1,6 +1,14 @@
+import base64
+import datetime
+import json
+import time
+
 import ckan.plugins.toolkit as toolkit
+import mock
 import pytest
-from ckan.tests import factories
+from ckan.tests import factories, helpers
+
+from ckanext.blob_storage import actions, cache, model
 
 
 @pytest.mark.usefixtures("clean_db")
@@ -133,3 +141,476 @@ def test_validation_error_if_empty_lfs_prefix():
                 }
             ]
         )
+
+
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_namespace', 'some-namespace')
+def test_register_resources():
+    dataset = factories.Dataset(resources=[{'url': 'https://www.example.com', 'url_type': ''}])
+
+    created = helpers.call_action(
+        'blob_storage_register_resources',
+        package_id=dataset['name'],
+        resources=[
+            {
+                'name': 'file-{}.csv'.format(i),
+                'sha256': 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd091{}'.format(i),
+                'size': 1000 + i,
+                'format': 'CSV',
+            } for i in range(3)
+        ]
+    )
+
+    assert 3 == len(created)
+    dataset = helpers.call_action('package_show', id=dataset['id'])
+    assert 4 == len(dataset['resources'])
+    for i, resource in enumerate(dataset['resources'][1:]):
+        assert created[i]['id'] == resource['id']
+        assert 'file-{}.csv'.format(i) == resource['name']
+        assert 'upload' == resource['url_type']
+        assert 1000 + i == resource['size']
+        assert 'CSV' == resource['format']
+        assert 'some-namespace/{}'.format(dataset['id']) == resource['lfs_prefix']
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_register_resources_missing_fields():
+    dataset = factories.Dataset()
+
+    with pytest.raises(toolkit.ValidationError):
+        helpers.call_action(
+            'blob_storage_register_resources',
+            package_id=dataset['id'],
+            resources=[{'name': 'file.csv', 'size': 1000}]
+        )
+
+    with pytest.raises(toolkit.ValidationError):
+        helpers.call_action('blob_storage_register_resources', package_id=dataset['id'], resources=[])
+
+
+@pytest.fixture()
+def parse_cache():
+    parse_cache = cache.get_cache('parsed_resource_fields')
+    parse_cache.clear()
+    yield parse_cache
+    parse_cache.clear()
+
+
+@pytest.mark.usefixtures("parse_cache")
+def test_resource_schema_show_parses_json_and_python_literals():
+    schema = {'fields': [{'name': 'id', 'type': 'integer'}]}
+    json_resource = {'id': 'res-1', 'schema': '{"fields": [{"name": "id", "type": "integer"}]}'}
+    python_resource = {'id': 'res-2', 'schema': repr(schema)}
+
+    assert actions.resource_schema_show({}, {'resource': json_resource}) == schema
+    assert actions.resource_schema_show({}, {'resource': python_resource}) == schema
+    assert actions.resource_schema_show({}, {'resource': {'id': 'res-3'}}) == {}
+
+
+@pytest.mark.usefixtures("parse_cache")
+def test_resource_sample_show_caches_parsed_value():
+    resource = {'id': 'res-1', 'sample': "[{'id': 1}]", 'metadata_modified': '2021-01-01T00:00:00'}
+
+    with mock.patch('ckanext.blob_storage.actions.ast.literal_eval', return_value=[{'id': 1}]) as literal_eval, \
+            mock.patch('ckanext.blob_storage.actions.metrics.call_action', return_value=resource) as resource_show:
+        actions.resource_sample_show({}, {'id': 'res-1'})
+        actions.resource_sample_show({}, {'id': 'res-1'})
+        assert literal_eval.call_count == 1
+
+        resource_show.return_value = dict(resource, sample="[{'id': 2}]", metadata_modified='2021-01-02T00:00:00')
+        actions.resource_sample_show({}, {'id': 'res-1'})
+        assert literal_eval.call_count == 2
+
+
+@pytest.mark.usefixtures("parse_cache")
+def test_resource_schema_show_does_not_cache_caller_resources():
+    stored = {'id': 'res-1', 'schema': "{'fields': []}", 'metadata_modified': '2021-01-01T00:00:00'}
+    forged = dict(stored, schema="{'fields': ['forged']}", schema_ref='sha256:abc')
+
+    with mock.patch('ckanext.blob_storage.model.get_resource_metadata') as get_resource_metadata:
+        assert actions.resource_schema_show({}, {'resource': forged}) == {'fields': ['forged']}
+        assert actions.resource_schema_show({}, {'resource': dict(forged, schema='')}) == {}
+        assert not get_resource_metadata.called
+
+    with mock.patch('ckanext.blob_storage.actions.metrics.call_action', return_value=stored):
+        assert actions.resource_schema_show({}, {'id': 'res-1'}) == {'fields': []}
+
+
+@pytest.mark.usefixtures("parse_cache")
+def test_serialize_resource_field_caches_serialized_value():
+    cache.get_cache('serialized_resource_fields').clear()
+    resource = {'id': 'res-1', 'sample': "[{'id': 1}]", 'metadata_modified': '2021-01-01T00:00:00'}
+
+    with mock.patch('ckanext.blob_storage.actions.json.dumps', wraps=json.dumps) as dumps:
+        assert actions.serialize_resource_field(resource, 'sample') == '[{"id":1}]'
+        assert actions.serialize_resource_field(resource, 'sample') == '[{"id":1}]'
+        assert dumps.call_count == 1
+
+    resource = dict(resource, sample="[{'id': 2}]", metadata_modified='2021-01-02T00:00:00')
+    assert actions.serialize_resource_field(resource, 'sample') == '[{"id":2}]'
+    assert actions.serialize_resource_field({'id': 'res-2'}, 'schema') == '{}'
+
+
+@pytest.mark.usefixtures("parse_cache")
+@pytest.mark.ckan_config('ckanext.blob_storage.parse_max_size', '10')
+def test_resource_sample_show_size_limit():
+    with pytest.raises(toolkit.ValidationError):
+        actions.resource_sample_show({}, {'resource': {'id': 'res-1', 'sample': repr(list(range(100)))}})
+
+
+@pytest.mark.usefixtures("parse_cache")
+@pytest.mark.ckan_config('ckanext.blob_storage.parse_max_depth', '3')
+def test_resource_schema_show_depth_limit():
+    resource = {'id': 'res-1', 'schema': '[[[["too deep"]]]]'}
+    with pytest.raises(toolkit.ValidationError):
+        actions.resource_schema_show({}, {'resource': resource})
+
+
+@pytest.mark.usefixtures("parse_cache")
+def test_resource_sample_show_pagination_and_projection():
+    sample = [{'id': i, 'name': 'row {}'.format(i), 'value': i * 10} for i in range(20)]
+    resource = {'id': 'res-1', 'sample': repr(sample)}
+
+    assert actions.resource_sample_show({}, {'resource': resource}) == sample
+    assert actions.resource_sample_show({}, {'resource': resource, 'offset': 5, 'limit': 2}) == sample[5:7]
+    assert actions.resource_sample_show({}, {'resource': resource, 'limit': '2', 'fields': 'id,value'}) == [
+        {'id': 0, 'value': 0}, {'id': 1, 'value': 10}]
+
+
+@pytest.mark.usefixtures("parse_cache")
+def test_resource_sample_show_columns_format():
+    sample = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}, {'id': 3, 'name': 'c'}]
+    resource = {'id': 'res-1', 'sample': repr(sample)}
+
+    result = actions.resource_sample_show({}, {'resource': resource, 'format': 'columns', 'offset': 1})
+    assert result == {'fields': ['id', 'name'], 'rows': [[2, 'b'], [3, 'c']], 'total': 3}
+
+    result = actions.resource_sample_show({}, {'resource': resource, 'format': 'columns', 'fields': ['name']})
+    assert result == {'fields': ['name'], 'rows': [['a'], ['b'], ['c']], 'total': 3}
+
+
+@pytest.mark.usefixtures("parse_cache")
+def test_resource_sample_show_list_rows():
+    resource = {'id': 'res-1', 'sample': '[["id", "name"], [1, "a"], [2, "b"]]'}
+
+    assert actions.resource_sample_show({}, {'resource': resource, 'offset': 1, 'limit': 1}) == [[1, 'a']]
+    with pytest.raises(toolkit.ValidationError):
+        actions.resource_sample_show({}, {'resource': resource, 'fields': 'id'})
+    with pytest.raises(toolkit.ValidationError):
+        actions.resource_sample_show({}, {'resource': resource, 'format': 'columns'})
+
+
+@pytest.mark.usefixtures("parse_cache")
+@pytest.mark.parametrize('params', [
+    {'limit': -1},
+    {'offset': 'foo'},
+    {'format': 'csv'},
+    {'fields': {'id': 1}},
+    {'fields': [['id']]},
+])
+def test_resource_sample_show_invalid_params(params):
+    resource = {'id': 'res-1', 'sample': "[{'id': 1}]"}
+    with pytest.raises(toolkit.ValidationError):
+        actions.resource_sample_show({}, dict(params, resource=resource))
+
+
+@pytest.mark.usefixtures("clean_db", "parse_cache")
+@pytest.mark.ckan_config('ckanext.blob_storage.external_metadata', 'true')
+@pytest.mark.ckan_config('ckanext.blob_storage.external_metadata.min_size', '100')
+def test_large_sample_stored_externally():
+    model.create_tables()
+    sample = [{'id': i, 'name': 'row {}'.format(i)} for i in range(20)]
+    schema = {'fields': [{'name': 'id', 'type': 'integer'}]}
+    dataset = factories.Dataset(resources=[{'url': 'https://example.com/data.csv',
+                                            'sample': repr(sample),
+                                            'schema': repr(schema)}])
+
+    resource = dataset['resources'][0]
+    assert 'sample' not in resource
+    assert resource['sample_ref'].startswith('sha256:')
+    assert resource['schema'] == repr(schema)
+    assert 'schema_ref' not in resource
+
+    assert helpers.call_action('resource_sample_show', id=resource['id']) == sample
+    assert helpers.call_action('resource_schema_show', id=resource['id']) == schema
+
+
+@pytest.mark.usefixtures("clean_db", "parse_cache")
+@pytest.mark.ckan_config('ckanext.blob_storage.external_metadata', 'true')
+@pytest.mark.ckan_config('ckanext.blob_storage.external_metadata.min_size', '100')
+def test_external_sample_reference_not_accepted_from_clients():
+    model.create_tables()
+    sample = [{'id': i, 'name': 'row {}'.format(i)} for i in range(20)]
+    dataset = factories.Dataset(resources=[{'url': 'https://example.com/data.csv', 'sample': repr(sample)}])
+    resource = dataset['resources'][0]
+    sample_ref = resource['sample_ref']
+
+    updated = helpers.call_action('resource_update', **dict(resource, sample_ref='sha256:' + 'a' * 64))
+    assert updated['sample_ref'] == sample_ref
+
+    other = factories.Dataset(resources=[{'url': 'https://example.com/other.csv', 'sample_ref': sample_ref}])
+    assert 'sample_ref' not in other['resources'][0]
+
+    updated = helpers.call_action('resource_update', **dict(updated, sample=''))
+    assert 'sample_ref' not in updated
+    assert helpers.call_action('resource_sample_show', id=resource['id']) == {}
+
+
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_namespace', 'some-namespace')
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_upload_spec():
+    sysadmin = factories.Sysadmin()
+    dataset = factories.Dataset()
+    existing_sha = 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    new_sha = 'ab71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+
+    client = mock.Mock()
+    client.batch.return_value = {'objects': [
+        {'oid': existing_sha, 'size': 10},
+        {'oid': new_sha, 'size': 20, 'actions': {'upload': {'href': 'https://lfs.example.com/upload'}}},
+    ]}
+    context = {'user': sysadmin['name'], 'upload_lfs_client': client}
+
+    with mock.patch('ckanext.blob_storage.actions.get_upload_authz_token', return_value='token'):
+        result = helpers.call_action('blob_storage_upload_spec', context=context, package_id=dataset['id'], objects=[
+            {'sha256': existing_sha, 'size': 10, 'filename': 'existing.csv'},
+            {'sha256': new_sha, 'size': 20, 'filename': 'new.csv'},
+        ])
+
+    assert result['lfs_prefix'] == 'some-namespace/{}'.format(dataset['id'])
+    assert result['token'] == 'token'
+    assert [o['exists'] for o in result['objects']] == [True, False]
+    client.batch.assert_called_once_with(result['lfs_prefix'], 'upload', [
+        {'oid': existing_sha, 'size': 10, 'x-filename': 'existing.csv'},
+        {'oid': new_sha, 'size': 20, 'x-filename': 'new.csv'},
+    ], transfers=None)
+
+
+def test_upload_spec_invalid_objects():
+    with pytest.raises(toolkit.ValidationError) as e:
+        actions.blob_storage_upload_spec({}, {'package_id': 'some-dataset', 'objects': [
+            {'sha256': 'not-a-sha256', 'size': 10},
+            {'sha256': 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919', 'size': -1},
+        ]})
+    errors = e.value.error_dict['objects']
+    assert list(errors[0]) == ['sha256']
+    assert list(errors[1]) == ['size']
+
+
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_multipart_upload_resume():
+    model.create_tables()
+    sysadmin = factories.Sysadmin()
+    dataset = factories.Dataset()
+    sha256 = 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    parts = [{'href': 'https://lfs.example.com/part/{}'.format(i), 'pos': i * 100, 'size': 100} for i in range(3)]
+
+    client = mock.Mock()
+    client.batch.return_value = {'transfer': 'multipart-basic', 'objects': [
+        {'oid': sha256, 'size': 300, 'actions': {'parts': parts, 'commit': {'href': 'https://lfs.example.com/c'}}},
+    ]}
+    context = {'user': sysadmin['name'], 'upload_lfs_client': client}
+    start_params = {'package_id': dataset['id'], 'sha256': sha256, 'size': 300, 'filename': 'big.csv'}
+
+    with mock.patch('ckanext.blob_storage.actions.get_upload_authz_token', return_value='token'):
+        started = helpers.call_action('blob_storage_multipart_upload_start', context=dict(context), **start_params)
+        assert started['transfer'] == 'multipart-basic'
+        assert started['object']['actions']['parts'] == parts
+        assert started['uploaded_parts'] == []
+
+        helpers.call_action('blob_storage_multipart_upload_part_done', context=dict(context),
+                            upload_id=started['upload_id'], pos=200, size=100)
+        status = helpers.call_action('blob_storage_multipart_upload_part_done', context=dict(context),
+                                     upload_id=started['upload_id'], pos=0, size=100)
+        assert status['uploaded_parts'] == [0, 200]
+        assert status['uploaded_size'] == 200
+
+        resumed = helpers.call_action('blob_storage_multipart_upload_start', context=dict(context), **start_params)
+        assert resumed['upload_id'] == started['upload_id']
+        assert resumed['uploaded_parts'] == [0, 200]
+
+    helpers.call_action('blob_storage_multipart_upload_delete', context=dict(context), upload_id=started['upload_id'])
+    with pytest.raises(toolkit.ObjectNotFound):
+        helpers.call_action('blob_storage_multipart_upload_show', context=dict(context),
+                            upload_id=started['upload_id'])
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_objects_exist():
+    cache.get_cache('objects_exist').clear()
+    existing_sha = 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    missing_sha = 'ab71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    client = mock.Mock()
+    client.batch.return_value = {'objects': [
+        {'oid': existing_sha, 'size': 10, 'actions': {'download': {'href': 'https://lfs.example.com/obj'}}},
+        {'oid': missing_sha, 'size': 20, 'error': {'code': 404, 'message': 'Object does not exist'}},
+    ]}
+    objects = [{'lfs_prefix': 'myorg/mydataset', 'sha256': existing_sha, 'size': 10},
+               {'lfs_prefix': 'myorg/mydataset', 'sha256': missing_sha, 'size': 20}]
+    authz_result = {'token': 'token', 'granted_scopes': ['obj:myorg/mydataset/*:read']}
+
+    with mock.patch('ckanext.blob_storage.actions._authorize_scope', return_value=authz_result):
+        result = actions.blob_storage_objects_exist({'download_lfs_client': client}, {'objects': objects})
+        assert [o['exists'] for o in result['objects']] == [True, False]
+
+        # Existing objects are cached, missing objects are checked again
+        actions.blob_storage_objects_exist({'download_lfs_client': client}, {'objects': objects})
+        assert client.batch.call_args[0][2] == [{'oid': missing_sha, 'size': 20}]
+
+
+def test_objects_exist_not_authorized():
+    objects = [{'lfs_prefix': 'myorg/mydataset',
+                'sha256': 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919',
+                'size': 10}]
+    authz_result = {'token': 'token', 'granted_scopes': []}
+    with mock.patch('ckanext.blob_storage.actions._authorize_scope', return_value=authz_result):
+        with pytest.raises(toolkit.NotAuthorized):
+            actions.blob_storage_objects_exist({}, {'objects': objects})
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_top_downloads():
+    model.create_tables()
+    sysadmin = factories.Sysadmin()
+    user = factories.User()
+    now = datetime.datetime.utcnow()
+    model.add_download_counts([{'resource_id': 'res-1', 'package_id': 'pkg-1', 'count': 3, 'last_download': now},
+                               {'resource_id': 'res-2', 'package_id': 'pkg-1', 'count': 5, 'last_download': now}])
+    model.add_download_counts([{'resource_id': 'res-1', 'package_id': 'pkg-1', 'count': 4, 'last_download': now}])
+
+    top = helpers.call_action('blob_storage_top_downloads', context={'user': sysadmin['name']}, limit=1)
+    assert [(r['resource_id'], r['count']) for r in top] == [('res-1', 7)]
+
+    with pytest.raises(toolkit.NotAuthorized):
+        helpers.call_action('blob_storage_top_downloads', context={'user': user['name']})
+
+
+def _jwt(payload):
+    segments = [base64.urlsafe_b64encode(json.dumps(d).encode('utf-8')).decode('ascii').rstrip('=')
+                for d in ({'alg': 'HS256'}, payload)]
+    return '{}.{}.signature'.format(*segments)
+
+
+def test_dataset_download_authz_token_is_cached_per_user_and_prefix():
+    cache.get_cache('dataset_read_tokens').clear()
+    token = _jwt({'exp': time.time() + 3600})
+    authz_result = {'token': token, 'granted_scopes': ['obj:ckan/dataset-id/*:read']}
+
+    with mock.patch('ckanext.blob_storage.actions._authorize_scope', return_value=authz_result) as authorize, \
+            mock.patch('ckanext.blob_storage.actions.toolkit.check_access') as check_access:
+        assert token == actions.get_dataset_download_authz_token({'user': 'jane'}, 'ckan/dataset-id', 'res-1')
+        assert token == actions.get_dataset_download_authz_token({'user': 'jane'}, 'ckan/dataset-id', 'res-2')
+        assert authorize.call_count == 1
+        assert authorize.call_args[0][1] == 'obj:ckan/dataset-id/*:read'
+
+        # Access to each resource is still checked
+        assert check_access.call_count == 2
+        assert check_access.call_args[0][2] == {'id': 'res-2'}
+
+        actions.get_dataset_download_authz_token({'user': 'john'}, 'ckan/dataset-id', 'res-1')
+        assert authorize.call_count == 2
+
+
+def test_dataset_download_authz_token_not_granted():
+    cache.get_cache('dataset_read_tokens').clear()
+    authz_result = {'token': _jwt({}), 'granted_scopes': []}
+
+    with mock.patch('ckanext.blob_storage.actions._authorize_scope', return_value=authz_result) as authorize, \
+            mock.patch('ckanext.blob_storage.actions.toolkit.check_access'):
+        assert actions.get_dataset_download_authz_token({'user': 'jane'}, 'ckan/dataset-id', 'res-1') is None
+        assert actions.get_dataset_download_authz_token({'user': 'jane'}, 'ckan/dataset-id', 'res-2') is None
+        assert authorize.call_count == 1
+
+
+@pytest.mark.parametrize('dataset_read_tokens, batch_sizes', [
+    (True, [2]),
+    (False, [1, 1]),
+])
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_lfs_download_specs(dataset_read_tokens, batch_sizes):
+    resources = [{'id': 'res-{}'.format(i), 'lfs_prefix': 'myorg/mydataset', 'sha256': 'sha-{}'.format(i),
+                  'size': 10} for i in range(2)]
+    package = {'name': 'mydataset', 'organization': {'name': 'myorg'}, 'resources': resources}
+    client = mock.Mock()
+    client.batch.side_effect = lambda prefix, operation, objects, transfers=None: {'objects': [
+        dict(o, actions={'download': {'href': 'https://lfs.example.com/{}'.format(o['oid'])}}) for o in objects]}
+
+    with mock.patch.dict('ckanext.blob_storage.actions.toolkit.config',
+                         {'ckanext.blob_storage.dataset_read_tokens': dataset_read_tokens}), \
+            mock.patch('ckanext.blob_storage.actions.toolkit.check_access') as check_access, \
+            mock.patch('ckanext.blob_storage.actions.get_dataset_download_authz_token',
+                       return_value='dataset-token') as get_dataset_token, \
+            mock.patch('ckanext.blob_storage.actions.get_download_authz_token', return_value='token'), \
+            mock.patch('ckanext.blob_storage.lfs.get_client', return_value=client):
+        specs = actions.get_lfs_download_specs({'user': 'jane'}, package, resources)
+
+    assert specs == {'res-0': {'href': 'https://lfs.example.com/sha-0'},
+                     'res-1': {'href': 'https://lfs.example.com/sha-1'}}
+    assert [c[0][2] for c in check_access.call_args_list] == [{'id': 'res-0'}, {'id': 'res-1'}]
+    assert get_dataset_token.called is dataset_read_tokens
+    assert [len(c[0][2]) for c in client.batch.call_args_list] == batch_sizes
+
+
+def test_token_expires_in():
+    assert 590 < actions._token_expires_in(_jwt({'exp': time.time() + 600})) <= 600
+    assert actions._token_expires_in(_jwt({})) == float('inf')
+    assert actions._token_expires_in('not a jwt') == float('inf')
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_download_spec_served_from_cache_when_lfs_unavailable():
+    from ckanext.blob_storage import lfs
+    cache.get_cache('download_specs').clear()
+    sha256 = 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    resource = {'id': 'res-1', 'package_id': 'pkg-1', 'lfs_prefix': 'myorg/mydataset', 'sha256': sha256,
+                'size': 10, 'url': 'data.csv'}
+    download_spec = {'href': 'https://lfs.example.com/obj', 'expires_in': 900}
+    client = mock.Mock()
+    client.batch.return_value = {'objects': [{'oid': sha256, 'size': 10, 'actions': {'download': download_spec}}]}
+    package = {'name': 'mydataset', 'organization': {'name': 'myorg'}, 'resources': [resource]}
+
+    with mock.patch('ckanext.blob_storage.actions.metrics.call_action', return_value=package), \
+            mock.patch('ckanext.blob_storage.actions.get_download_authz_token', return_value='token') as get_token, \
+            mock.patch('ckanext.blob_storage.lfs.get_circuit_breaker', return_value=lfs.CircuitBreaker(5, 30)):
+        assert download_spec == actions.get_lfs_download_spec({'download_lfs_client': client}, resource)
+
+        client.batch.side_effect = lfs.LfsUnavailable('down', retry_after=30)
+        assert download_spec == actions.get_lfs_download_spec({'download_lfs_client': client}, resource,
+                                                              allow_stale=True)
+        assert get_token.call_count == 2
+
+        with pytest.raises(lfs.LfsUnavailable):
+            actions.get_lfs_download_spec({'download_lfs_client': client}, resource)
+        with pytest.raises(lfs.LfsUnavailable):
+            actions.get_lfs_download_spec({'download_lfs_client': client}, resource, inline=True, allow_stale=True)
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_download_spec_of_caller_resource_not_served_from_cache():
+    from ckanext.blob_storage import lfs
+    cache.get_cache('download_specs').clear()
+    sha256 = 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    resource = {'id': 'res-1', 'package_id': 'pkg-1', 'lfs_prefix': 'myorg/mydataset', 'sha256': sha256,
+                'size': 10, 'url': 'data.csv'}
+    download_spec = {'href': 'https://lfs.example.com/obj', 'expires_in': 900}
+    client = mock.Mock()
+    client.batch.return_value = {'objects': [{'oid': sha256, 'size': 10, 'actions': {'download': download_spec}}]}
+    package = {'name': 'mydataset', 'organization': {'name': 'myorg'}, 'resources': [resource]}
+
+    with mock.patch('ckanext.blob_storage.actions.metrics.call_action', return_value=package), \
+            mock.patch('ckanext.blob_storage.actions.get_download_authz_token', return_value='token'), \
+            mock.patch('ckanext.blob_storage.lfs.get_circuit_breaker', return_value=lfs.CircuitBreaker(5, 30)):
+        context = {'download_lfs_client': client}
+        assert download_spec == actions.get_resource_download_spec(context, {'resource': resource})
+
+        # Object fields of other resources can be passed by API callers
+        client.batch.side_effect = lfs.LfsUnavailable('down', retry_after=30)
+        forged = dict(resource, id='res-2')
+        with pytest.raises(actions.StorageUnavailable) as e:
+            actions.get_resource_download_spec(context, {'resource': forged})
+        assert e.value.error_dict['retry_after'] == [30]
+
+        context = dict(context, **{actions.RESOURCE_LOADED_CONTEXT_KEY: True})
+        assert download_spec == actions.get_resource_download_spec(context, {'resource': resource})
@@ -1,3 +1,4 @@
+import mock
 import pytest
 from ckan.plugins import toolkit
 from ckan.tests import factories, helpers
@@ -104,3 +105,40 @@ def test_normalize_object_scope_with_activity_id():
         normalized_scope = authz.normalize_object_scope(None, scope)
 
     assert expected_scope == str(normalized_scope)
+
+
+@pytest.mark.usefixtures('clean_db', 'reset_db', 'with_request_context')
+def test_object_scopes_snapshot():
+    sysadmin = factories.Sysadmin()
+    org = factories.Organization()
+    dataset = factories.Dataset(owner_org=org['id'])
+    other_dataset = factories.Dataset(owner_org=org['id'])
+    resource = factories.Resource(
+        url='/my/file.csv',
+        url_type='upload',
+        sha256='cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919',
+        size=123456,
+        lfs_prefix='lfs_prefix',
+        package_id=dataset['id']
+    )
+    scopes = ['obj:ckan/{}/*:read'.format(dataset['id']),
+              'obj:{}/{}/{}:read'.format(org['name'], dataset['name'], resource['id']),
+              'obj:{}/{}/{}:read'.format(org['name'], other_dataset['name'], resource['id'])]
+
+    with user_context(sysadmin), authz.object_scopes_snapshot(scopes) as snapshot, \
+            mock.patch('ckanext.blob_storage.metrics.call_action') as call_action:
+        assert snapshot.get_package(dataset['id']).name == dataset['name']
+        assert snapshot.get_organization_name(snapshot.get_package(dataset['name'])) == org['name']
+
+        # Resources are only found in the dataset they belong to
+        package = snapshot.get_package(dataset['name'])
+        assert snapshot.get_resource(package, resource['id']).id == resource['id']
+        assert snapshot.get_resource(snapshot.get_package(other_dataset['name']), resource['id']) is None
+        assert 'resource' not in snapshot.authz_context({}, snapshot.get_package(other_dataset['name']),
+                                                        resource['id'])
+
+        assert 'read' in authz.check_object_permissions('*', dataset['id'], 'ckan')
+        normalized_scope = authz.normalize_object_scope(None, Scope.from_string(scopes[1]))
+        assert not call_action.called
+
+    assert 'obj:lfs_prefix/{}:read'.format(resource['sha256']) == str(normalized_scope)
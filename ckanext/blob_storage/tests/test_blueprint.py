@@ -3,6 +3,9 @@ import pytest
 from ckan.plugins import toolkit
 from ckan.tests import factories
 
+from ckanext.blob_storage.actions import StorageUnavailable
+from ckanext.blob_storage.lfs import LfsUnavailable
+
 
 @pytest.mark.usefixtures('clean_db')
 def test_preview_arg(app):
@@ -64,3 +67,125 @@ def test_preview_arg(app):
         args = m.call_args
 
         assert args[0][3] is False                   # inline
+
+
+@pytest.mark.usefixtures('clean_db')
+@pytest.mark.ckan_config('ckanext.blob_storage.server_timing', 'true')
+def test_server_timing_header(app):
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'])
+
+    with mock.patch('ckanext.blob_storage.blueprints.call_download_handlers') as m:
+        m.return_value = ''
+        url = toolkit.url_for('blob_storage.download', id=dataset['id'], resource_id=resource['id'])
+        response = app.get(url)
+
+    server_timing = response.headers['Server-Timing']
+    assert 'resource_show;dur=' in server_timing
+    assert 'package_show;dur=' in server_timing
+
+
+@pytest.mark.usefixtures('clean_db')
+def test_no_server_timing_header_by_default(app):
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'])
+
+    with mock.patch('ckanext.blob_storage.blueprints.call_download_handlers') as m:
+        m.return_value = ''
+        url = toolkit.url_for('blob_storage.download', id=dataset['id'], resource_id=resource['id'])
+        response = app.get(url)
+
+    assert 'Server-Timing' not in response.headers
+
+
+@pytest.mark.usefixtures('clean_db')
+def test_head_request_answered_from_metadata(app):
+    sha256 = 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919'
+    dataset = factories.Dataset()
+    resource = factories.Resource(
+        package_id=dataset['id'],
+        url='data.csv',
+        url_type='upload',
+        sha256=sha256,
+        size=12,
+        lfs_prefix='lfs/prefix'
+    )
+    url = toolkit.url_for('blob_storage.download', id=dataset['id'], resource_id=resource['id'])
+
+    with mock.patch('ckanext.blob_storage.blueprints.call_download_handlers') as m:
+        response = app.test_client().head(url)
+        assert not m.called
+
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == '12'
+    assert response.headers['ETag'] == '"{}"'.format(sha256)
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Content-Disposition'] == 'attachment; filename="data.csv"'
+
+    response = app.test_client().head(url, headers={'If-None-Match': '"{}"'.format(sha256)})
+    assert response.status_code == 304
+
+
+@pytest.mark.usefixtures('clean_db')
+@pytest.mark.parametrize('error', [
+    LfsUnavailable('LFS server is unavailable', retry_after=12),
+    StorageUnavailable(retry_after=12),
+])
+def test_lfs_unavailable_returns_503(app, error):
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'])
+    url = toolkit.url_for('blob_storage.download', id=dataset['id'], resource_id=resource['id'])
+
+    with mock.patch('ckanext.blob_storage.blueprints.call_download_handlers') as m:
+        m.side_effect = error
+        response = app.get(url, status=503)
+
+    assert response.headers['Retry-After'] == '12'
+
+
+@pytest.mark.usefixtures('clean_db')
+def test_download_zip(app):
+    import io
+    import zipfile
+    dataset = factories.Dataset()
+    resources = [factories.Resource(package_id=dataset['id'], url=name, url_type='upload',
+                                    sha256=str(i) * 64, size=len(content), lfs_prefix='lfs/prefix')
+                 for i, (name, content) in enumerate([('data.csv', b'id\n1\n'), ('data.json', b'{}')])]
+    factories.Resource(package_id=dataset['id'], url='https://example.com/linked.csv')
+    contents = {'0' * 64: b'id\n1\n', '1' * 64: b'{}'}
+    specs = {r['id']: {'href': 'https://storage/{}'.format(r['sha256'])} for r in resources}
+
+    with mock.patch('ckanext.blob_storage.blueprints._get_lfs_download_specs', return_value=specs), \
+            mock.patch('ckanext.blob_storage.zipstream.download_chunks',
+                       side_effect=lambda action, sha256, size: [contents[sha256]]):
+        response = app.get(toolkit.url_for('blob_storage.download_zip', id=dataset['id']))
+        with zipfile.ZipFile(io.BytesIO(response.body)) as archive:
+            assert archive.namelist() == ['data.csv', 'data.json']
+            assert archive.read('data.csv') == b'id\n1\n'
+        assert response.headers['Content-Length'] == str(len(response.body))
+
+        response = app.get(toolkit.url_for('blob_storage.download_zip', id=dataset['id'],
+                                           resources=resources[1]['id']))
+        with zipfile.ZipFile(io.BytesIO(response.body)) as archive:
+            assert archive.namelist() == ['data.json']
+
+        app.get(toolkit.url_for('blob_storage.download_zip', id=dataset['id'], resources='unknown'), status=404)
+
+
+@pytest.mark.usefixtures('clean_db')
+def test_resource_schema_and_sample_json(app):
+    dataset = factories.Dataset()
+    resource = factories.Resource(package_id=dataset['id'], schema="{'fields': [{'name': 'id'}]}",
+                                  sample="[{'id': 1}]")
+
+    response = app.get(toolkit.url_for('blob_storage.resource_schema_json', id=dataset['id'],
+                                       resource_id=resource['id']))
+    assert response.headers['Content-Type'] == 'application/json'
+    assert response.json == {'fields': [{'name': 'id'}]}
+
+    response = app.get(toolkit.url_for('blob_storage.resource_sample_json', id=dataset['id'],
+                                       resource_id=resource['id']))
+    assert response.json == [{'id': 1}]
+
+    app.get(toolkit.url_for('blob_storage.resource_sample_json', id='other-dataset', resource_id=resource['id']),
+            status=404)
@@ -0,0 +1,238 @@
+"""Tests for cache.py
+"""
+import threading
+import time
+
+import fakeredis
+import mock
+import pytest
+import redis
+from six.moves import queue
+
+from ckanext.blob_storage import cache
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = cache.SingleFlight('test')
+    started = threading.Event()
+    release = threading.Event()
+    waiting = queue.Queue()
+    calls = []
+    results = []
+
+    def compute(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return {'value': value}
+
+    def call(value):
+        results.append(single_flight.do('key', compute, value))
+
+    def increment(name, value=1, **labels):
+        if labels.get('result') == 'shared':
+            waiting.put(labels)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(6)]
+    with mock.patch('ckanext.blob_storage.cache.metrics.increment', side_effect=increment):
+        threads[0].start()
+        assert started.wait(5)
+        for t in threads[1:]:
+            t.start()
+        for _ in threads[1:]:
+            waiting.get(timeout=5)
+        release.set()
+        for t in threads:
+            t.join(5)
+
+    assert calls == [0]
+    assert results == [{'value': 0}] * 6
+
+    # Once done, calls are made again
+    assert single_flight.do('key', lambda: 'new') == 'new'
+
+
+def test_single_flight_shares_exceptions():
+    single_flight = cache.SingleFlight('test')
+    started = threading.Event()
+    release = threading.Event()
+    waiting = queue.Queue()
+    calls = []
+    errors = []
+
+    def fail():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        raise ValueError('failed')
+
+    def call():
+        try:
+            single_flight.do('key', fail)
+        except ValueError as e:
+            errors.append(e)
+
+    def increment(name, value=1, **labels):
+        if labels.get('result') == 'shared':
+            waiting.put(labels)
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    with mock.patch('ckanext.blob_storage.cache.metrics.increment', side_effect=increment):
+        threads[0].start()
+        assert started.wait(5)
+        threads[1].start()
+        waiting.get(timeout=5)
+        release.set()
+        for t in threads:
+            t.join(5)
+
+    assert len(calls) == 1
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = cache.LRUCache('test', maxsize=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert len(lru) == 2
+
+
+@pytest.mark.parametrize('ttl, expected', [(None, 1), (-1, None)])
+def test_lru_cache_ttl(ttl, expected):
+    lru = cache.LRUCache('test')
+    lru.set('a', 1, ttl=ttl)
+    assert lru.get('a') == expected
+
+
+@pytest.fixture()
+def redis_client():
+    client = fakeredis.FakeStrictRedis()
+    client.flushall()
+    return client
+
+
+def test_redis_cache_shared_between_instances(redis_client):
+    worker_1 = cache.RedisCache('specs', redis_client, 'blob_storage:test')
+    worker_2 = cache.RedisCache('specs', redis_client, 'blob_storage:test')
+    other_site = cache.RedisCache('specs', redis_client, 'blob_storage:other')
+
+    worker_1.set(('jane', 'ckan/dataset'), {'href': 'https://lfs.example.com/obj'})
+    assert worker_2.get(('jane', 'ckan/dataset')) == {'href': 'https://lfs.example.com/obj'}
+    assert other_site.get(('jane', 'ckan/dataset')) is None
+    assert len(worker_2) == 1
+
+    worker_2.delete(('jane', 'ckan/dataset'))
+    assert worker_1.get(('jane', 'ckan/dataset'), False) is False
+
+
+def test_redis_cache_ttl(redis_client):
+    redis_cache = cache.RedisCache('tokens', redis_client, 'blob_storage:test', ttl=60, default_ttl=3600)
+    redis_cache.set('a', 'token')
+    redis_cache.set('b', 'token', ttl=10)
+    assert 0 < redis_client.pttl('blob_storage:test:tokens:"a"') <= 60000
+    assert 0 < redis_client.pttl('blob_storage:test:tokens:"b"') <= 10000
+
+    no_ttl_cache = cache.RedisCache('parsed', redis_client, 'blob_storage:test', default_ttl=3600)
+    no_ttl_cache.set('a', 'value')
+    assert 60000 < redis_client.pttl('blob_storage:test:parsed:"a"') <= 3600000
+
+
+def test_redis_cache_compresses_large_values(redis_client):
+    redis_cache = cache.RedisCache('samples', redis_client, 'blob_storage:test')
+    value = [{'id': i, 'name': 'row'} for i in range(100)]
+    redis_cache.set('sample', value)
+    assert redis_client.get('blob_storage:test:samples:"sample"')[0:1] == b'z'
+    assert redis_cache.get('sample') == value
+
+    redis_cache.set('not-json', {1, 2})
+    assert redis_cache.get('not-json') is None
+
+    redis_cache.clear()
+    assert len(redis_cache) == 0
+
+
+def test_redis_errors_are_cache_misses():
+    client = mock.Mock()
+    client.get.side_effect = redis.ConnectionError('Connection refused')
+    client.set.side_effect = redis.ConnectionError('Connection refused')
+    redis_cache = cache.RedisCache('specs', client, 'blob_storage:test')
+    redis_cache.set('a', 'value')
+    assert redis_cache.get('a', 'default') == 'default'
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.cache.backend', 'redis')
+@pytest.mark.ckan_config('ckanext.blob_storage.cache.namespace', 'my-site')
+def test_get_cache_with_redis_backend(redis_client):
+    with mock.patch.dict(cache._caches, clear=True), \
+            mock.patch('ckanext.blob_storage.cache._get_redis_client', return_value=redis_client):
+        cache.get_cache('specs').set('a', 1)
+        assert isinstance(cache.get_cache('specs'), cache.RedisCache)
+    assert redis_client.get('my-site:specs:"a"') == b'j1'
+
+
+def test_redis_single_flight_shares_results_between_processes(redis_client):
+    worker_1 = cache.RedisSingleFlight('specs', redis_client, 'blob_storage:test', timeout=5)
+    worker_2 = cache.RedisSingleFlight('specs', redis_client, 'blob_storage:test', timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def compute(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return {'value': value}
+
+    waiting = threading.Event()
+    sleep = time.sleep
+
+    def wait(seconds):
+        waiting.set()
+        sleep(seconds)
+
+    thread = threading.Thread(target=lambda: results.append(worker_1.do('key', compute, 1)))
+    thread.start()
+    assert started.wait(5)
+    with mock.patch('ckanext.blob_storage.cache.time.sleep', side_effect=wait):
+        waiter = threading.Thread(target=lambda: results.append(worker_2.do('key', compute, 2)))
+        waiter.start()
+        assert waiting.wait(5)
+        release.set()
+        thread.join(5)
+        waiter.join(5)
+
+    assert calls == [1]
+    assert results == [{'value': 1}] * 2
+    assert redis_client.get('blob_storage:test:single_flight:specs:lock:"key"') is None
+
+
+def test_redis_single_flight_waiters_call_if_the_call_fails(redis_client):
+    single_flight = cache.RedisSingleFlight('specs', redis_client, 'blob_storage:test', timeout=5)
+    redis_client.set('blob_storage:test:single_flight:specs:lock:"key"', b'other-process', px=200)
+
+    # The lock expires without a result, as if the other process had crashed
+    assert single_flight.do('key', lambda: 'computed') == 'computed'
+
+    with pytest.raises(ValueError):
+        single_flight.do('other-key', mock.Mock(side_effect=ValueError('failed')))
+    assert redis_client.get('blob_storage:test:single_flight:specs:lock:"other-key"') is None
+
+
+def test_redis_single_flight_without_redis():
+    client = mock.Mock()
+    client.set.side_effect = redis.ConnectionError('Connection refused')
+    single_flight = cache.RedisSingleFlight('specs', client, 'blob_storage:test')
+    assert single_flight.do('key', lambda: 'computed') == 'computed'
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.cache.backend', 'redis')
+def test_get_single_flight_with_redis_backend(redis_client):
+    with mock.patch.dict(cache._single_flights, clear=True), \
+            mock.patch('ckanext.blob_storage.cache._get_redis_client', return_value=redis_client):
+        assert isinstance(cache.get_single_flight('specs'), cache.RedisSingleFlight)
@@ -0,0 +1,213 @@
+"""Tests for cli.py
+"""
+import hashlib
+import io
+
+import mock
+import pytest
+from giftless_client import exc
+
+from ckanext.blob_storage import cli, lfs
+
+
+def _response(status_code=200, body=b'', headers=None):
+    response = mock.MagicMock(status_code=status_code, headers=headers or {})
+    response.is_redirect = status_code in {301, 302, 303, 307, 308}
+    response.iter_content.return_value = [body[i:i + 4] for i in range(0, len(body), 4)]
+    response.__enter__.return_value = response
+    return response
+
+
+def test_initdb_creates_tables():
+    command = cli.BlobStorageCommand('blob-storage')
+    command.args = ['initdb']
+    with mock.patch.object(command, '_load_config', create=True), \
+            mock.patch('ckanext.blob_storage.model.create_tables') as create_tables:
+        command.command()
+    assert create_tables.called
+
+
+def test_fetch_linked_resource_hashes_while_fetching():
+    body = b'id,name\n1,foo\n'
+    f = io.BytesIO()
+    with mock.patch('requests.get', return_value=_response(body=body)) as get:
+        sha256, size = cli.fetch_linked_resource('https://data.example.com/data.csv', f, {'example.com'}, 1024)
+
+    assert (sha256, size) == (hashlib.sha256(body).hexdigest(), len(body))
+    assert f.getvalue() == body
+    assert get.call_args[1]['allow_redirects'] is False
+
+
+def test_fetch_linked_resource_size_limit():
+    with mock.patch('requests.get', return_value=_response(body=b'x' * 100)):
+        with pytest.raises(cli.LinkedResourceError):
+            cli.fetch_linked_resource('https://example.com/data.csv', io.BytesIO(), {'example.com'}, 99)
+
+    response = _response(body=b'x' * 10, headers={'Content-Length': '1000'})
+    with mock.patch('requests.get', return_value=response):
+        with pytest.raises(cli.LinkedResourceError):
+            cli.fetch_linked_resource('https://example.com/data.csv', io.BytesIO(), {'example.com'}, 99)
+    assert not response.iter_content.called
+
+
+def test_fetch_linked_resource_redirects_only_to_allowed_domains():
+    redirect = _response(302, headers={'Location': '/files/data.csv'})
+    with mock.patch('requests.get', side_effect=[redirect, _response(body=b'data')]) as get:
+        cli.fetch_linked_resource('https://example.com/data.csv', io.BytesIO(), {'example.com'}, 1024)
+    assert get.call_args[0][0] == 'https://example.com/files/data.csv'
+
+    redirect = _response(302, headers={'Location': 'http://169.254.169.254/latest/meta-data'})
+    with mock.patch('requests.get', side_effect=[redirect]) as get:
+        with pytest.raises(cli.LinkedResourceError):
+            cli.fetch_linked_resource('https://example.com/data.csv', io.BytesIO(), {'example.com'}, 1024)
+    assert get.call_count == 1
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_ingest_linked_resource_uploads_known_object():
+    body = b'id,name\n1,foo\n'
+    with mock.patch('requests.get', return_value=_response(body=body)), \
+            mock.patch('ckanext.blob_storage.lfs.upload') as upload:
+        props = cli.ingest_linked_resource('https://example.com/files/data.csv', 'ckan/dataset-id', 'token',
+                                           {'example.com'}, 1024)
+
+    sha256 = hashlib.sha256(body).hexdigest()
+    assert props == {'sha256': sha256, 'size': len(body)}
+    assert upload.call_args[0][2] == 'ckan/dataset-id'
+    assert upload.call_args[0][3] == {'oid': sha256, 'size': len(body), 'x-filename': 'data.csv'}
+
+
+def test_needs_ingestion():
+    resource = mock.Mock(url='https://example.com/data.csv', package_id='dataset-id',
+                         extras={'lfs_prefix': 'ckan/dataset-id', 'sha256': 'abc',
+                                 'lfs_source_url': 'https://example.com/data.csv'})
+    assert not cli._needs_ingestion(resource)
+
+    resource.url = 'https://example.com/new.csv'
+    assert cli._needs_ingestion(resource)
+
+
+@pytest.mark.parametrize('object_spec, relinked', [
+    ({'actions': {'download': {'href': 'https://lfs.example.com/obj'}}}, True),
+    ({'error': {'code': 404, 'message': 'Object does not exist'}}, False),
+])
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_relink_resource(object_spec, relinked):
+    resource = mock.Mock(id='res-1', package_id='dataset-id', size=10,
+                         extras={'lfs_prefix': 'old-ns/dataset-id', 'sha256': 'abc'})
+    client = mock.Mock()
+    client.batch.return_value = {'objects': [dict(object_spec, oid='abc', size=10)]}
+    command = cli.MigrateResourcesCommand('migrate-resources')
+
+    with mock.patch('ckanext.blob_storage.cli.get_authz_token', return_value='token') as get_token, \
+            mock.patch('ckanext.blob_storage.lfs.get_client', return_value=client), \
+            mock.patch('sqlalchemy.orm.attributes.flag_modified'):
+        assert command.relink_resource(resource) is relinked
+
+    assert get_token.call_args[0][1] == 'obj:old-ns/dataset-id/*:read'
+    assert client.batch.call_args[0][2] == [{'oid': 'abc', 'size': 10}]
+    assert cli._needs_migration(resource) is not relinked
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_relink_resource_falls_back_on_lfs_client_error():
+    resource = mock.Mock(id='res-1', package_id='dataset-id', size=10,
+                         extras={'lfs_prefix': 'old-ns/dataset-id', 'sha256': 'abc'})
+    client = mock.Mock()
+    client.batch.side_effect = exc.LfsError("Unexpected response from LFS server: 422", status_code=422)
+    command = cli.MigrateResourcesCommand('migrate-resources')
+
+    with mock.patch('ckanext.blob_storage.cli.get_authz_token', return_value='token'), \
+            mock.patch('ckanext.blob_storage.lfs.get_client', return_value=client):
+        assert command.relink_resource(resource) is False
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+def test_relink_resource_raises_if_lfs_unavailable():
+    resource = mock.Mock(id='res-1', package_id='dataset-id', size=10,
+                         extras={'lfs_prefix': 'old-ns/dataset-id', 'sha256': 'abc'})
+    client = mock.Mock()
+    client.batch.side_effect = exc.LfsError("Unexpected response from LFS server: 503", status_code=503)
+    command = cli.MigrateResourcesCommand('migrate-resources')
+
+    with mock.patch('ckanext.blob_storage.cli.get_authz_token', return_value='token'), \
+            mock.patch('ckanext.blob_storage.lfs.get_client', return_value=client), \
+            mock.patch('ckanext.blob_storage.lfs._breaker', None):
+        with pytest.raises(lfs.LfsUnavailable):
+            command.relink_resource(resource)
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_namespace', 'ckan')
+def test_ingest_linked_resources_reindexes_every():
+    resources = [{'id': 'res-{}'.format(i), 'package_id': 'dataset-{}'.format(i),
+                  'url': 'https://example.com/{}.csv'.format(i)} for i in range(3)]
+    props = {'sha256': 'abc', 'size': 10}
+    command = cli.MigrateResourcesCommand('migrate-resources')
+
+    with mock.patch('ckanext.blob_storage.cli.get_linked_resources', return_value=iter(resources)), \
+            mock.patch('ckanext.blob_storage.cli.ingest_linked_resource', return_value=props), \
+            mock.patch('ckanext.blob_storage.cli.update_linked_resource_storage_props', return_value=True), \
+            mock.patch.object(command, 'get_upload_authz_token', return_value='token'), \
+            mock.patch('ckan.lib.search.rebuild') as rebuild, mock.patch('ckan.lib.search.commit'):
+        command.ingest_linked_resources(['example.com'], 1024, workers=1, reindex_every=2)
+
+    assert [c[1]['package_ids'] for c in rebuild.call_args_list] == [['dataset-0', 'dataset-1'], ['dataset-2']]
+
+
+def test_download_resource_does_not_count_downloads():
+    from ckanext.blob_storage import download_handler
+    response = mock.Mock(status_code=200)
+    with mock.patch('ckanext.blob_storage.download_handler._call_download_handlers',
+                    return_value=(response, 'fallback')), \
+            mock.patch('ckanext.blob_storage.cli._save_downloaded_response_data'), \
+            mock.patch('ckanext.blob_storage.tracking.record_download') as record_download:
+        with cli.download_resource({'id': 'res-1'}, {'id': 'dataset-id'}):
+            pass
+        assert not record_download.called
+
+        download_handler.call_download_handlers({'id': 'res-1'}, {'id': 'dataset-id'})
+        record_download.assert_called_once_with('res-1', 'dataset-id')
+
+
+def test_deferred_reindex_reindexes_committed_datasets_once():
+    reindex = cli.DeferredReindex(every=3)
+    with mock.patch('ckan.lib.search.rebuild') as rebuild, mock.patch('ckan.lib.search.commit'):
+        reindex.add('dataset-2')
+        reindex.add('dataset-1')
+        reindex.committed()
+        reindex.add('dataset-2')
+        assert not rebuild.called
+
+        reindex.committed()
+        rebuild.assert_called_once_with(package_ids=['dataset-1', 'dataset-2'], force=True, defer_commit=True)
+
+        reindex.flush()
+        assert rebuild.call_count == 1
+
+
+def test_deferred_reindex_does_not_reindex_uncommitted_changes():
+    reindex = cli.DeferredReindex(every=1)
+    with mock.patch('ckan.lib.search.rebuild') as rebuild, mock.patch('ckan.lib.search.commit'):
+        reindex.add('dataset-1')
+        reindex.flush()
+        assert not rebuild.called
+
+
+def test_infer_all_fetches_in_workers_and_saves_results():
+    from ckanext.blob_storage import inference
+    resources = [{'id': 'res-{}'.format(i), 'url': 'data.csv'} for i in range(3)]
+    command = cli.InferResourceMetadataCommand('infer-resource-metadata')
+    command.site_user = {'name': 'site'}
+
+    def infer_resource(resource, action):
+        if resource['id'] == 'res-1':
+            raise inference.InferenceError('No header row found')
+        return {'schema': {'fields': []}}
+
+    with mock.patch('ckanext.blob_storage.actions.get_lfs_download_spec', return_value={'href': 'https://x'}), \
+            mock.patch('ckanext.blob_storage.inference.infer_resource', side_effect=infer_resource), \
+            mock.patch('ckanext.blob_storage.inference.save_inferred', return_value={'schema': '{}'}) as save:
+        totals = command.infer_all(resources, workers=2)
+
+    assert totals == {'success': 2, 'skipped': 1, 'failed': 0}
+    assert [c[0][1]['id'] for c in save.call_args_list] == ['res-0', 'res-2']
@@ -0,0 +1,148 @@
+"""Tests for export.py
+"""
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import mock
+import pytest
+
+from ckanext.blob_storage import export
+
+CONTENTS = [b'id,name\n1,foo\n', b'id,name\n2,bar\n']
+SHA256 = [hashlib.sha256(c).hexdigest() for c in CONTENTS]
+
+
+def _dataset():
+    resources = [{'id': 'res-{}'.format(i), 'url': 'data-{}.csv'.format(i), 'url_type': 'upload',
+                  'lfs_prefix': 'ckan/dataset-id', 'sha256': SHA256[i], 'size': len(CONTENTS[i])}
+                 for i in range(2)]
+    # Resources with the same file are only downloaded once
+    resources.append(dict(resources[0], id='res-copy'))
+    resources.append({'id': 'res-linked', 'url': 'https://example.com/data.csv'})
+    return {'id': 'dataset-id', 'name': 'dataset', 'organization': {'name': 'org'}, 'resources': resources}
+
+
+def _batch(prefix, operation, objects, transfers=None):
+    return {'objects': [{'oid': o['oid'], 'size': o['size'],
+                         'actions': {'download': {'href': 'https://lfs.example.com/{}'.format(o['oid'])}}}
+                        for o in objects]}
+
+
+def _get(url, **kwargs):
+    response = mock.MagicMock()
+    response.iter_content.return_value = [CONTENTS[SHA256.index(url.rsplit('/', 1)[1])]]
+    response.__enter__.return_value = response
+    return response
+
+
+@pytest.fixture()
+def lfs_server():
+    client = mock.Mock()
+    client.batch.side_effect = _batch
+    with mock.patch('ckanext.blob_storage.lfs.get_client', return_value=client), \
+            mock.patch('requests.get', side_effect=_get) as get:
+        yield get
+
+
+def test_export_to_directory_is_incremental(tmpdir, lfs_server):
+    writer = export.DirectoryWriter(str(tmpdir))
+    totals = export.export_resources([_dataset()], writer, lambda prefix: 'token', workers=2)
+    writer.close()
+
+    assert totals == {'exported': 3, 'present': 0, 'failed': 0}
+    assert lfs_server.call_count == 2
+    with open(os.path.join(str(tmpdir), *export.object_path(SHA256[1]).split('/')), 'rb') as f:
+        assert f.read() == CONTENTS[1]
+    with open(os.path.join(str(tmpdir), 'manifest.jsonl')) as f:
+        manifest = [json.loads(line) for line in f]
+    assert [e['resource']['id'] for e in manifest] == ['res-0', 'res-1', 'res-copy']
+    assert manifest[0]['dataset'] == {'id': 'dataset-id', 'name': 'dataset', 'organization': 'org'}
+
+    writer = export.DirectoryWriter(str(tmpdir))
+    totals = export.export_resources([_dataset()], writer, lambda prefix: 'token')
+    writer.close()
+    assert totals == {'exported': 0, 'present': 3, 'failed': 0}
+    assert lfs_server.call_count == 2
+    with open(os.path.join(str(tmpdir), 'manifest.jsonl')) as f:
+        manifest = [json.loads(line) for line in f]
+    assert [e['status'] for e in manifest] == ['exported'] * 3 + ['present'] * 3
+
+
+def test_resumed_export_appends_to_manifest(tmpdir, lfs_server):
+    manifest_path = os.path.join(str(tmpdir), 'manifest.jsonl')
+    with open(manifest_path, 'w') as f:
+        f.write(json.dumps({'resource': {'sha256': 'a' * 64}, 'status': 'exported'}) + '\n{"resource": {"sha')
+
+    writer = export.DirectoryWriter(str(tmpdir))
+    export.export_resources([_dataset()], writer, lambda prefix: 'token')
+    writer.close()
+
+    assert export.read_manifest_digests(manifest_path) == {'a' * 64, SHA256[0], SHA256[1]}
+
+
+def test_export_to_tar_stream(lfs_server):
+    output = io.BytesIO()
+    writer = export.TarWriter(output, skip={SHA256[0]})
+    totals = export.export_resources([_dataset()], writer, lambda prefix: 'token')
+    writer.close()
+
+    assert totals == {'exported': 1, 'present': 2, 'failed': 0}
+    output.seek(0)
+    with tarfile.open(fileobj=output) as tar:
+        assert tar.getnames() == [export.object_path(SHA256[1]), export.MANIFEST_NAME]
+        assert tar.extractfile(export.object_path(SHA256[1])).read() == CONTENTS[1]
+
+
+def test_export_fails_on_digest_mismatch(tmpdir, lfs_server):
+    lfs_server.side_effect = lambda url, **kwargs: _get('/' + SHA256[0])
+    writer = export.DirectoryWriter(str(tmpdir))
+    totals = export.export_resources([_dataset()], writer, lambda prefix: 'token')
+    writer.close()
+
+    assert totals == {'exported': 2, 'present': 0, 'failed': 1}
+    assert not os.path.exists(os.path.join(str(tmpdir), *export.object_path(SHA256[1]).split('/')))
+    assert os.listdir(os.path.join(str(tmpdir), 'objects', SHA256[1][0:2], SHA256[1][2:4])) == []
+
+
+def test_export_bounds_downloads_in_progress(tmpdir, lfs_server):
+    contents = ['row {}\n'.format(i).encode('ascii') for i in range(10)]
+    digests = [hashlib.sha256(c).hexdigest() for c in contents]
+    dataset = {'id': 'dataset-id', 'name': 'dataset', 'resources': [
+        {'id': 'res-{}'.format(i), 'url': 'data.csv', 'url_type': 'upload', 'lfs_prefix': 'ckan/dataset-id',
+         'sha256': digests[i], 'size': len(contents[i])} for i in range(10)]}
+
+    def get(url, **kwargs):
+        response = mock.MagicMock()
+        response.iter_content.return_value = [contents[digests.index(url.rsplit('/', 1)[1])]]
+        response.__enter__.return_value = response
+        return response
+
+    lfs_server.side_effect = get
+    writer = export.DirectoryWriter(str(tmpdir))
+    open_files = []
+    max_open_files = []
+    object_file, add_object = writer.object_file, writer.add_object
+
+    def track_object_file(sha256):
+        open_files.append(sha256)
+        max_open_files.append(len(open_files))
+        return object_file(sha256)
+
+    def track_add_object(sha256, size, file_obj):
+        open_files.remove(sha256)
+        return add_object(sha256, size, file_obj)
+
+    client = mock.Mock()
+    client.batch.side_effect = _batch
+    with mock.patch('ckanext.blob_storage.lfs.get_client', return_value=client), \
+            mock.patch.object(writer, 'object_file', side_effect=track_object_file), \
+            mock.patch.object(writer, 'add_object', side_effect=track_add_object):
+        totals = export.export_resources([dataset], writer, lambda prefix: 'token', workers=2)
+    writer.close()
+
+    assert totals == {'exported': 10, 'present': 0, 'failed': 0}
+    assert [len(c[0][2]) for c in client.batch.call_args_list] == [2] * 5
+    assert max(max_open_files) <= 4
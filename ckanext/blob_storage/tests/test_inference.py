@@ -0,0 +1,138 @@
+"""Tests for inference.py
+"""
+import json
+import struct
+
+import mock
+import pytest
+
+from ckanext.blob_storage import inference
+
+RESOURCE = {'id': 'resource-id', 'url': 'data.csv', 'url_type': 'upload', 'lfs_prefix': 'ckan/dataset-id',
+            'sha256': 'cc71500070cf26cd6e8eab7c9eec3a937be957d144f445ad24003157e2bd0919', 'size': 1000}
+
+
+def _varint(n):
+    data = b''
+    while True:
+        if n < 0x80:
+            return data + struct.pack('<B', n)
+        data += struct.pack('<B', (n & 0x7F) | 0x80)
+        n >>= 7
+
+
+def _struct(fields):
+    """Encode a struct in the Thrift compact protocol, from a list of (field ID, type, value)
+    """
+    data = b''
+    last_id = 0
+    for field_id, field_type, value in fields:
+        data += struct.pack('<B', ((field_id - last_id) << 4) | field_type)
+        last_id = field_id
+        if field_type == 5:
+            data += _varint((value << 1) ^ (value >> 31))
+        elif field_type == 8:
+            data += _varint(len(value)) + value
+        elif field_type == 9:
+            data += struct.pack('<B', (len(value) << 4) | 12) + b''.join(value)
+        elif field_type == 12:
+            data += value
+    return data + b'\x00'
+
+
+def _parquet_file():
+    schema = [
+        _struct([(4, 8, b'schema'), (5, 5, 3)]),
+        _struct([(1, 5, 2), (3, 5, 0), (4, 8, b'id')]),
+        _struct([(1, 5, 6), (3, 5, 1), (4, 8, b'name'), (6, 5, 0)]),
+        _struct([(3, 5, 1), (4, 8, b'tags'), (5, 5, 1), (6, 5, 3)]),
+        _struct([(3, 5, 2), (4, 8, b'element'), (5, 5, 1)]),
+        _struct([(1, 5, 6), (3, 5, 1), (4, 8, b'item'), (6, 5, 0)]),
+    ]
+    # Row groups and other fields after the schema are not needed, and are left out
+    metadata = _struct([(1, 5, 1), (2, 9, schema)])
+    return b'PAR1' + b'\x00' * 100 + metadata + struct.pack('<I', len(metadata)) + b'PAR1'
+
+
+def _ranged_get(content, honor_range=True):
+    def get(url, headers, **kwargs):
+        start, end = [int(v) for v in headers['Range'][len('bytes='):].split('-')]
+        body = content[start:end + 1] if honor_range else content
+        response = mock.MagicMock(status_code=206 if honor_range else 200)
+        response.iter_content.return_value = [body[i:i + 7] for i in range(0, len(body), 7)]
+        response.__enter__.return_value = response
+        return response
+    return get
+
+
+def test_infer_csv_sniffs_delimiter_and_skips_incomplete_rows():
+    data = b'id;name;score\n1;foo;1.5\n2;"bar\nbaz";2\n3;"qu\nux'
+    result = inference.infer_csv(data, True, 10)
+    assert result['schema'] == {'fields': [{'name': 'id', 'type': 'integer'},
+                                           {'name': 'name', 'type': 'string'},
+                                           {'name': 'score', 'type': 'number'}]}
+    assert result['sample'] == [{'id': '1', 'name': 'foo', 'score': '1.5'},
+                                {'id': '2', 'name': 'bar\nbaz', 'score': '2'}]
+
+
+def test_infer_jsonl_limits_sample_rows():
+    data = b''.join(json.dumps({'id': i}).encode('ascii') + b'\n' for i in range(5))
+    result = inference.infer_jsonl(data, False, 2)
+    assert result['schema'] == {'fields': [{'name': 'id', 'type': 'integer'}]}
+    assert result['sample'] == [{'id': 0}, {'id': 1}]
+
+    with pytest.raises(inference.InferenceError):
+        inference.infer_jsonl(b'[1, 2]\n', False, 2)
+
+
+def test_infer_parquet_schema_from_footer():
+    content = _parquet_file()
+    with mock.patch('requests.get', side_effect=_ranged_get(content)) as get:
+        result = inference.infer({'href': 'https://storage/x'}, 'parquet', len(content), max_bytes=96)
+
+    assert result == {'schema': {'fields': [{'name': 'id', 'type': 'integer', 'constraints': {'required': True}},
+                                            {'name': 'name', 'type': 'string'},
+                                            {'name': 'tags', 'type': 'array'}]}}
+    # Only the end of the file is fetched
+    assert all(int(c[1]['headers']['Range'][len('bytes='):].split('-')[0]) > 0 for c in get.call_args_list)
+
+
+def test_infer_parquet_requires_range_support():
+    content = _parquet_file()
+    with mock.patch('requests.get', side_effect=_ranged_get(content, honor_range=False)):
+        with pytest.raises(inference.InferenceError):
+            inference.infer({'href': 'https://storage/x'}, 'parquet', len(content), max_bytes=64)
+
+
+def test_infer_csv_fetches_only_the_beginning():
+    content = b'id,name\n' + b''.join(b'%d,name-%d\n' % (i, i) for i in range(1000))
+    with mock.patch('requests.get', side_effect=_ranged_get(content, honor_range=False)) as get:
+        result = inference.infer({'href': 'https://storage/x', 'header': {'Authorization': 'Bearer t'}},
+                                 'csv', len(content), max_bytes=100, sample_rows=3)
+
+    assert get.call_args[1]['headers'] == {'Authorization': 'Bearer t', 'Range': 'bytes=0-99'}
+    assert result['sample'] == [{'id': '0', 'name': 'name-0'}, {'id': '1', 'name': 'name-1'},
+                                {'id': '2', 'name': 'name-2'}]
+
+
+@pytest.mark.parametrize('resource, expected', [
+    (RESOURCE, True),
+    (dict(RESOURCE, schema='{}'), True),
+    (dict(RESOURCE, schema='{}', sample_ref='sha256:abc'), False),
+    (dict(RESOURCE, url='data.parquet', schema='{}'), False),
+    (dict(RESOURCE, url='report.pdf'), False),
+    (dict(RESOURCE, lfs_prefix=None), False),
+])
+def test_needs_inference(resource, expected):
+    assert inference.needs_inference(resource) is expected
+
+
+def test_save_inferred_only_saves_missing_values():
+    inferred = {'schema': {'fields': [{'name': 'id', 'type': 'integer'}]}, 'sample': [{'id': '1'}]}
+    with mock.patch('ckan.plugins.toolkit.get_action') as get_action:
+        values = inference.save_inferred({'user': 'site'}, dict(RESOURCE, sample='[]'), inferred)
+
+    assert values == {'schema': json.dumps(inferred['schema'])}
+    context, data_dict = get_action.return_value.call_args[0]
+    assert context[inference.CONTEXT_FLAG] is True
+    assert data_dict == {'id': 'resource-id', 'schema': json.dumps(inferred['schema'])}
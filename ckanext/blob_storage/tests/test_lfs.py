@@ -0,0 +1,101 @@
+"""Tests for lfs.py
+"""
+import mock
+import pytest
+import requests
+from giftless_client.exc import LfsError
+
+from ckanext.blob_storage import lfs
+
+
+@pytest.fixture()
+def breaker():
+    breaker = lfs.CircuitBreaker(failure_threshold=2, retry_after=30)
+    with mock.patch('ckanext.blob_storage.lfs.get_circuit_breaker', return_value=breaker):
+        yield breaker
+
+
+def test_breaker_opens_after_consecutive_failures(breaker):
+    client = mock.Mock()
+    client.batch.side_effect = requests.Timeout('read timed out')
+    for _ in range(2):
+        with pytest.raises(lfs.LfsUnavailable):
+            lfs.batch(client, 'myorg/mydataset', 'download', [])
+    assert breaker.is_open
+
+    with pytest.raises(lfs.LfsUnavailable) as e:
+        lfs.batch(client, 'myorg/mydataset', 'download', [])
+    assert client.batch.call_count == 2
+    assert 0 < e.value.retry_after <= 30
+
+
+def test_breaker_lets_a_trial_request_through_after_retry_after(breaker):
+    client = mock.Mock()
+    client.batch.side_effect = LfsError('Unexpected response from LFS server: 502', status_code=502)
+    for _ in range(2):
+        with pytest.raises(lfs.LfsUnavailable):
+            lfs.batch(client, 'myorg/mydataset', 'download', [])
+
+    with mock.patch('ckanext.blob_storage.lfs.time.time', return_value=breaker._opened_at + 31):
+        breaker.before_call()
+        with pytest.raises(lfs.LfsUnavailable):
+            breaker.before_call()
+
+    client.batch.side_effect = None
+    client.batch.return_value = {'objects': []}
+    breaker.record_success()
+    assert {'objects': []} == lfs.batch(client, 'myorg/mydataset', 'download', [])
+    assert not breaker.is_open
+
+
+@pytest.mark.parametrize('error, raised', [
+    (requests.exceptions.ChunkedEncodingError('connection broken'), lfs.LfsUnavailable),
+    (ValueError('invalid JSON'), ValueError),
+])
+def test_failed_trial_request_reopens_breaker(breaker, error, raised):
+    client = mock.Mock()
+    client.batch.side_effect = requests.Timeout('read timed out')
+    for _ in range(2):
+        with pytest.raises(lfs.LfsUnavailable):
+            lfs.batch(client, 'myorg/mydataset', 'download', [])
+
+    client.batch.side_effect = error
+    with mock.patch('ckanext.blob_storage.lfs.time.time', return_value=breaker._opened_at + 31):
+        with pytest.raises(raised):
+            lfs.batch(client, 'myorg/mydataset', 'download', [])
+    assert breaker.is_open
+
+    # Another trial is let through once retry_after has passed again
+    client.batch.side_effect = None
+    client.batch.return_value = {'objects': []}
+    with mock.patch('ckanext.blob_storage.lfs.time.time', return_value=breaker._opened_at + 31):
+        assert {'objects': []} == lfs.batch(client, 'myorg/mydataset', 'download', [])
+    assert not breaker.is_open
+
+
+def test_client_errors_are_not_failures(breaker):
+    client = mock.Mock()
+    client.batch.side_effect = LfsError('Unexpected response from LFS server: 404', status_code=404)
+    for _ in range(3):
+        with pytest.raises(LfsError):
+            lfs.batch(client, 'myorg/mydataset', 'download', [])
+    assert not breaker.is_open
+
+
+def test_breaker_disabled():
+    breaker = lfs.CircuitBreaker(failure_threshold=0, retry_after=30)
+    for _ in range(3):
+        breaker.record_failure()
+    breaker.before_call()
+    assert not breaker.is_open
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.storage_service_url', 'https://lfs.example.com')
+@pytest.mark.ckan_config('ckanext.blob_storage.lfs.read_timeout', '10')
+def test_client_sends_batch_requests_with_timeouts():
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {'objects': []}
+    with mock.patch('ckanext.blob_storage.lfs.requests.post', return_value=response) as post:
+        lfs.get_client('token').batch('myorg/mydataset', 'download', [])
+    assert post.call_args[1]['timeout'] == (5.0, 10.0)
+    assert post.call_args[1]['headers']['Authorization'] == 'Bearer token'
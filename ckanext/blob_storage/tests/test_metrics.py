@@ -0,0 +1,68 @@
+"""Tests for metrics.py
+"""
+import mock
+import pytest
+
+from ckanext.blob_storage import metrics
+
+
+def test_registry_renders_counters():
+    registry = metrics.PrometheusRegistry()
+    registry.increment('downloads_total', labels={'outcome': 'redirect'})
+    registry.increment('downloads_total', labels={'outcome': 'redirect'})
+    registry.increment('downloads_total', labels={'outcome': 'fallback'})
+
+    output = registry.render()
+
+    assert '# TYPE blob_storage_downloads_total counter' in output
+    assert 'blob_storage_downloads_total{outcome="redirect"} 2' in output
+    assert 'blob_storage_downloads_total{outcome="fallback"} 1' in output
+
+
+def test_registry_renders_cumulative_histogram_buckets():
+    registry = metrics.PrometheusRegistry(buckets=(0.1, 1.0))
+    registry.observe('lfs_batch_duration_seconds', 0.05, {'status': '200'})
+    registry.observe('lfs_batch_duration_seconds', 0.5, {'status': '200'})
+    registry.observe('lfs_batch_duration_seconds', 5, {'status': '200'})
+
+    lines = registry.render().splitlines()
+
+    assert '# TYPE blob_storage_lfs_batch_duration_seconds histogram' in lines
+    assert 'blob_storage_lfs_batch_duration_seconds_bucket{status="200",le="0.1"} 1' in lines
+    assert 'blob_storage_lfs_batch_duration_seconds_bucket{status="200",le="1.0"} 2' in lines
+    assert 'blob_storage_lfs_batch_duration_seconds_bucket{status="200",le="+Inf"} 3' in lines
+    assert 'blob_storage_lfs_batch_duration_seconds_sum{status="200"} 5.55' in lines
+    assert 'blob_storage_lfs_batch_duration_seconds_count{status="200"} 3' in lines
+
+
+def test_timer_reports_duration_with_updated_labels():
+    plugin = mock.Mock()
+    with mock.patch('ckanext.blob_storage.metrics.plugins.PluginImplementations', return_value=[plugin]):
+        with pytest.raises(ValueError):
+            with metrics.timer('lfs_batch_duration_seconds', status='error') as labels:
+                labels['status'] = '500'
+                raise ValueError("LFS server failure")
+
+    name, duration, labels = plugin.observe.call_args[0]
+    assert 'lfs_batch_duration_seconds' == name
+    assert duration >= 0
+    assert {'status': '500'} == labels
+
+
+def test_failing_metrics_plugin_is_ignored():
+    plugin = mock.Mock()
+    plugin.increment.side_effect = RuntimeError("Metrics backend is down")
+    with mock.patch('ckanext.blob_storage.metrics.plugins.PluginImplementations', return_value=[plugin]):
+        metrics.increment('downloads_total', outcome='redirect')
+
+    plugin.increment.assert_called_once_with('downloads_total', 1, {'outcome': 'redirect'})
+
+
+def test_request_timings_as_dict():
+    timings = metrics.RequestTimings()
+    timings.add('resource_show', 0.01)
+    timings.add('package_show', 0.02)
+    timings.add('package_show', 0.03)
+
+    assert {'resource_show': {'duration_ms': 10.0, 'calls': 1},
+            'package_show': {'duration_ms': 50.0, 'calls': 2}} == timings.as_dict()
@@ -1,8 +1,76 @@
 """Tests for plugin.py
 """
+import subprocess
+import sys
+
+import pytest
+
 import ckanext.blob_storage.plugin as plugin
 
+# Maximal time, in microseconds, that importing a module may take once CKAN itself has been imported
+IMPORT_TIME_BUDGET_US = 150000
+
+LAZY_LOADED_MODULES = {
+    'giftless_client',
+    'ckanext.blob_storage.actions',
+    'ckanext.blob_storage.authz',
+    'ckanext.blob_storage.blueprints',
+    'ckanext.blob_storage.download_handler',
+    'ckanext.blob_storage.lfs',
+    'ckanext.blob_storage.model',
+}
+
 
 def test_plugin():
     p = plugin.BlobStoragePlugin()
     assert p
+
+
+# Modules which are only loaded by views that need them, not when blueprints are registered
+BLUEPRINT_LAZY_LOADED_MODULES = {
+    'giftless_client',
+    'redis',
+    'ckanext.blob_storage.lfs',
+    'ckanext.blob_storage.zipstream',
+}
+
+# Modules which are only loaded by actions that need them, or with the redis cache backend
+ACTIONS_LAZY_LOADED_MODULES = {
+    'giftless_client',
+    'redis',
+    'ckanext.blob_storage.lfs',
+}
+
+
+@pytest.mark.parametrize('module, lazy_loaded_modules', [
+    ('ckanext.blob_storage.plugin', LAZY_LOADED_MODULES),
+    ('ckanext.blob_storage.blueprints', BLUEPRINT_LAZY_LOADED_MODULES),
+    ('ckanext.blob_storage.actions', ACTIONS_LAZY_LOADED_MODULES),
+])
+def test_import_does_not_load_heavy_modules(module, lazy_loaded_modules):
+    code = 'import sys, {}; print("\\n".join(sys.modules))'.format(module)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    loaded_modules = set(output.decode('utf-8').splitlines())
+    assert set() == lazy_loaded_modules & loaded_modules
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires Python 3.7 or newer')
+@pytest.mark.parametrize('module, preloaded', [
+    ('ckanext.blob_storage.plugin', 'ckan.plugins.toolkit, ckanext.authz_service.interfaces'),
+    ('ckanext.blob_storage.cli', 'ckan.lib.cli, ckan.plugins.toolkit'),
+])
+def test_import_time_budget(module, preloaded):
+    for m in preloaded.split(', '):
+        pytest.importorskip(m)
+
+    code = 'import {}; import {}'.format(preloaded, module)
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', code], stderr=subprocess.STDOUT)
+
+    # Lines are formatted as "import time: <self us> | <cumulative us> | <module>"
+    for line in output.decode('utf-8').splitlines():
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            assert int(parts[1]) < IMPORT_TIME_BUDGET_US
+            break
+    else:
+        pytest.fail("Import time for {} not found in output".format(module))
@@ -0,0 +1,97 @@
+"""Tests for profiling.py
+"""
+import os
+import pstats
+
+import pytest
+
+from ckanext.blob_storage import profiling
+
+
+@pytest.fixture
+def profile_dir(tmpdir, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_DIR_CONF_KEY, str(tmpdir))
+    return str(tmpdir)
+
+
+def _slow_view(resource_id=None):
+    profiling.annotate(dataset_size=3)
+    total = 0
+    for i in range(200000):
+        total += i
+    return total
+
+
+def test_no_profiles_if_not_configured(tmpdir):
+    view = profiling.profiled('download')(_slow_view)
+    assert view(resource_id='some-resource')
+    assert [] == tmpdir.listdir()
+
+
+def test_every_nth_call_is_profiled(profile_dir, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_EVERY_N_CONF_KEY, '1')
+    view = profiling.profiled('download')(_slow_view)
+
+    view(resource_id='some-resource')
+
+    files = os.listdir(profile_dir)
+    assert 1 == len(files)
+    assert files[0].endswith('.prof')
+    assert '-download-some-resource-3res-' in files[0]
+    stats = pstats.Stats(os.path.join(profile_dir, files[0]))
+    assert stats.total_calls > 0
+
+
+def test_slow_calls_are_sampled(profile_dir, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_SLOW_MS_CONF_KEY, '1')
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_INTERVAL_CONF_KEY, '1')
+    view = profiling.profiled('download')(lambda resource_id: _slow_view() + _slow_view() + _slow_view())
+
+    view(resource_id='some-resource')
+
+    files = os.listdir(profile_dir)
+    assert 1 == len(files)
+    assert files[0].endswith('.folded')
+    with open(os.path.join(profile_dir, files[0])) as f:
+        assert '_slow_view' in f.read()
+
+
+def test_nested_calls_are_not_profiled_separately(profile_dir, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_EVERY_N_CONF_KEY, '1')
+    action = profiling.profiled('get_resource_download_spec')(_slow_view)
+    view = profiling.profiled('download')(lambda resource_id: action(resource_id=resource_id))
+
+    view(resource_id='some-resource')
+
+    assert 1 == len(os.listdir(profile_dir))
+
+
+def test_disk_quota_deletes_oldest_profiles(profile_dir, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_MAX_DISK_CONF_KEY, '1')
+    old_file = os.path.join(profile_dir, 'old.prof')
+    with open(old_file, 'wb') as f:
+        f.write(b'0' * 1024 * 1024)
+    os.utime(old_file, (1, 1))
+    new_file = os.path.join(profile_dir, 'new.prof')
+    with open(new_file, 'wb') as f:
+        f.write(b'0' * 1024)
+
+    profiling._enforce_disk_quota(profile_dir, new_file)
+
+    assert ['new.prof'] == os.listdir(profile_dir)
+
+
+def test_unwritable_profile_dir_does_not_fail_calls(tmpdir, ckan_config, monkeypatch):
+    not_a_dir = tmpdir.join('file')
+    not_a_dir.write('')
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_DIR_CONF_KEY, str(not_a_dir))
+    monkeypatch.setitem(ckan_config, profiling.PROFILER_EVERY_N_CONF_KEY, '1')
+    view = profiling.profiled('download')(_slow_view)
+
+    assert view(resource_id='some-resource')
+
+    def failing_view(resource_id):
+        raise ValueError('view error')
+
+    with pytest.raises(ValueError):
+        profiling.profiled('download')(failing_view)(resource_id='some-resource')
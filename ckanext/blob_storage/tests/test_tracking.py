@@ -0,0 +1,51 @@
+"""Tests for tracking.py
+"""
+import threading
+
+import mock
+import pytest
+
+from ckanext.blob_storage import tracking
+
+
+def test_counts_are_aggregated_per_resource():
+    write = mock.Mock()
+    counter = tracking.DownloadCounter(flush_interval=3600, flush_threshold=1000, write=write)
+    counter.record('res-1', 'pkg-1')
+    counter.record('res-1', 'pkg-1')
+    counter.record('res-2', 'pkg-1')
+    assert not write.called
+
+    counter.flush()
+    counts = {c['resource_id']: c['count'] for c in write.call_args[0][0]}
+    assert counts == {'res-1': 2, 'res-2': 1}
+
+    counter.flush()
+    assert write.call_count == 1
+
+
+def test_flush_in_background_once_threshold_reached():
+    flushed = threading.Event()
+    write = mock.Mock(side_effect=lambda counts: flushed.set())
+    counter = tracking.DownloadCounter(flush_interval=3600, flush_threshold=3, write=write)
+    counter.record('res-1', 'pkg-1')
+    counter.record('res-1', 'pkg-1')
+    assert not flushed.wait(0.1)
+
+    counter.record('res-1', 'pkg-1')
+    assert flushed.wait(5)
+    assert write.call_args[0][0][0]['count'] == 3
+
+
+def test_write_errors_are_not_raised():
+    counter = tracking.DownloadCounter(flush_interval=3600, flush_threshold=1000,
+                                       write=mock.Mock(side_effect=RuntimeError('database is down')))
+    counter.record('res-1', 'pkg-1')
+    counter.flush()
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.download_tracking', 'false')
+def test_tracking_disabled_by_default():
+    with mock.patch('ckanext.blob_storage.tracking.get_counter') as get_counter:
+        tracking.record_download('res-1', 'pkg-1')
+    assert not get_counter.called
@@ -1,4 +1,6 @@
+import mock
 import pytest
+from ckan.plugins import toolkit
 from ckan.plugins.toolkit import Invalid
 
 from ckanext.blob_storage import validators
@@ -94,3 +96,61 @@ def test_lfs_prefix_doesnt_raise_if_not_upload():
         (u'resources', 0, u'url'): u'https://www.google.com',
     }
     validators.upload_has_lfs_prefix(key, flattened_data, {}, {})
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.external_metadata.min_size', '10')
+def test_store_large_value_externally():
+    key = ('resources', 0, 'sample')
+    flattened_data = {
+        (u'resources', 0, u'url'): u'/my/file.csv',
+        (u'resources', 0, u'sample'): u"[{'id': 1}, {'id': 2}]",
+    }
+    with mock.patch('ckanext.blob_storage.model.save_resource_metadata', return_value='sha256:abc') as save:
+        validators.store_large_value_externally(key, flattened_data, {}, {})
+
+    save.assert_called_once_with(u"[{'id': 1}, {'id': 2}]")
+    assert key not in flattened_data
+    assert flattened_data[('resources', 0, 'sample_ref')] == 'sha256:abc'
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.external_metadata.min_size', '10')
+def test_store_large_value_externally_keeps_small_values():
+    key = ('resources', 0, 'schema')
+    flattened_data = {
+        (u'resources', 0, u'schema'): u"{}",
+        (u'resources', 0, u'schema_ref'): u'sha256:abc',
+    }
+    with mock.patch('ckanext.blob_storage.model.save_resource_metadata') as save:
+        validators.store_large_value_externally(key, flattened_data, {}, {})
+
+    assert not save.called
+    assert flattened_data == {(u'resources', 0, u'schema'): u"{}"}
+
+
+@pytest.mark.ckan_config('ckanext.blob_storage.external_metadata.min_size', '10')
+def test_store_large_value_externally_clears_reference():
+    key = ('resources', 0, 'schema')
+    flattened_data = {
+        (u'resources', 0, u'schema'): u'',
+        (u'resources', 0, u'schema_ref'): u'sha256:abc',
+    }
+    validators.store_large_value_externally(key, flattened_data, {}, {})
+
+    assert flattened_data == {(u'resources', 0, u'schema'): u''}
+
+
+@pytest.mark.parametrize('stored_ref, expected', [
+    (None, {}),
+    ('sha256:stored', {(u'resources', 0, u'schema_ref'): 'sha256:stored'}),
+])
+def test_store_large_value_externally_ignores_client_references(stored_ref, expected):
+    key = ('resources', 0, 'schema')
+    flattened_data = {
+        (u'resources', 0, u'schema'): toolkit.missing,
+        (u'resources', 0, u'schema_ref'): u'sha256:other',
+    }
+    with mock.patch('ckanext.blob_storage.validators._stored_ref', return_value=stored_ref):
+        validators.store_large_value_externally(key, flattened_data, {}, {})
+
+    flattened_data.pop(key)
+    assert flattened_data == expected
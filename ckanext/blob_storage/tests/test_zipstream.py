@@ -0,0 +1,82 @@
+import datetime
+import hashlib
+import io
+import threading
+import zipfile
+
+import mock
+import pytest
+
+from ckanext.blob_storage import zipstream
+
+
+def _write_archive(files):
+    stream = zipstream.ZipStream()
+    data = b''
+    for name, content in files:
+        chunks = [content[i:i + 5] for i in range(0, len(content), 5)]
+        data += b''.join(stream.write_file(name, len(content), chunks, datetime.datetime(2021, 1, 15, 10, 20, 30)))
+    return data + b''.join(stream.finish())
+
+
+@pytest.mark.parametrize('zip64_limit', [zipstream.ZIP64_LIMIT, 0])
+def test_zip_stream_is_readable(zip64_limit):
+    files = [(u'data.csv', b'id,name\n1,foo\n'), (u'd\xe9j\xe0 vu.txt', b''), (u'more/data.json', b'{"x": 1}')]
+    with mock.patch.object(zipstream, 'ZIP64_LIMIT', zip64_limit):
+        data = _write_archive(files)
+        assert len(data) == zipstream.archive_size((name, len(content)) for name, content in files)
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == [name for name, _ in files]
+        for name, content in files:
+            assert archive.read(name) == content
+        assert archive.getinfo(u'data.csv').date_time == (2021, 1, 15, 10, 20, 30)
+
+
+def test_zip_stream_checks_file_size():
+    stream = zipstream.ZipStream()
+    with pytest.raises(zipstream.ZipStreamError):
+        b''.join(stream.write_file('data.csv', 5, [b'1234']))
+    with pytest.raises(zipstream.ZipStreamError):
+        b''.join(stream.write_file('data.csv', 5, [b'1234', b'56']))
+
+
+def test_fetch_ahead_keeps_order_and_fetches_concurrently():
+    started = []
+    both_started = threading.Event()
+
+    def fetch(item):
+        started.append(item)
+        if len(started) == 2:
+            both_started.set()
+        assert both_started.wait(5)
+        return [item.encode('ascii')] * 3
+
+    results = [(item, b''.join(chunks)) for item, chunks in zipstream.fetch_ahead(['a', 'b', 'c'], fetch, 2)]
+    assert results == [('a', b'aaa'), ('b', b'bbb'), ('c', b'ccc')]
+
+
+def test_fetch_ahead_raises_fetch_errors():
+    def fetch(item):
+        if item == 'b':
+            raise ValueError('Failed fetching b')
+        return [b'data']
+
+    results = zipstream.fetch_ahead(['a', 'b'], fetch, 2)
+    assert b''.join(next(results)[1]) == b'data'
+    with pytest.raises(ValueError):
+        b''.join(next(results)[1])
+
+
+def test_download_chunks_checks_digest():
+    content = b'id,name\n1,foo\n'
+    sha256 = hashlib.sha256(content).hexdigest()
+    with mock.patch('requests.get') as get:
+        get.return_value.__enter__.return_value.iter_content.return_value = [content[:5], content[5:]]
+        assert b''.join(zipstream.download_chunks({'href': 'https://storage/x'}, sha256, len(content))) == content
+
+        chunks = zipstream.download_chunks({'href': 'https://storage/x'}, '0' * 64, len(content))
+        assert next(chunks) == content[:5]
+        with pytest.raises(zipstream.ZipStreamError):
+            next(chunks)
@@ -0,0 +1,136 @@
+"""Low overhead download counting
+
+When ``ckanext.blob_storage.download_tracking`` is enabled, each download is
+counted in an in-memory buffer, kept by each worker process. Buffered counts
+are aggregated per resource, and written to the database by a background
+thread in a single statement, every ``ckanext.blob_storage.download_tracking.flush_interval``
+seconds or once ``ckanext.blob_storage.download_tracking.flush_threshold``
+downloads have been buffered, whichever comes first. No database access is
+done while handling the download request itself.
+
+Note that buffered counts which were not written yet are lost if the worker
+process is killed.
+"""
+import atexit
+import datetime
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from ckan.plugins import toolkit
+
+DOWNLOAD_TRACKING_CONF_KEY = 'ckanext.blob_storage.download_tracking'
+FLUSH_INTERVAL_CONF_KEY = 'ckanext.blob_storage.download_tracking.flush_interval'
+FLUSH_THRESHOLD_CONF_KEY = 'ckanext.blob_storage.download_tracking.flush_threshold'
+
+DEFAULT_FLUSH_INTERVAL = 60
+DEFAULT_FLUSH_THRESHOLD = 1000
+
+log = logging.getLogger(__name__)
+
+
+class DownloadCounter(object):
+    """Buffer of download counts, periodically flushed by a background thread
+    """
+
+    def __init__(self, flush_interval, flush_threshold, write=None):
+        # type: (float, int, Any) -> None
+        self._flush_interval = flush_interval
+        self._flush_threshold = flush_threshold
+        self._write = write or _write_counts
+        self._lock = threading.Lock()
+        self._buffer = {}  # type: Dict[str, Dict[str, Any]]
+        self._buffered_events = 0
+        self._flush_requested = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._pid = None  # type: Optional[int]
+
+    def record(self, resource_id, package_id):
+        # type: (str, str) -> None
+        """Count a download of a resource
+        """
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            entry = self._buffer.get(resource_id)
+            if entry is None:
+                entry = self._buffer[resource_id] = {'resource_id': resource_id,
+                                                     'package_id': package_id,
+                                                     'count': 0}
+            entry['count'] += 1
+            entry['last_download'] = now
+            self._buffered_events += 1
+            threshold_reached = self._buffered_events >= self._flush_threshold
+
+        self._ensure_thread()
+        if threshold_reached:
+            self._flush_requested.set()
+
+    def flush(self):
+        # type: () -> None
+        """Write all buffered counts to the database
+        """
+        with self._lock:
+            counts = list(self._buffer.values())
+            self._buffer = {}
+            self._buffered_events = 0
+        if not counts:
+            return
+        try:
+            self._write(counts)
+            log.debug("Flushed download counts of %d resources", len(counts))
+        except Exception:
+            log.exception("Failed writing download counts of %d resources", len(counts))
+
+    def _ensure_thread(self):
+        # Threads do not survive forking, so a forked worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='blob-storage-download-counter')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._flush_requested.wait(self._flush_interval)
+            self._flush_requested.clear()
+            self.flush()
+
+
+def _write_counts(counts):
+    # type: (List[Dict[str, Any]]) -> None
+    from . import model
+    model.add_download_counts(counts)
+
+
+_counter = None  # type: Optional[DownloadCounter]
+_counter_lock = threading.Lock()
+
+
+def record_download(resource_id, package_id):
+    # type: (str, str) -> None
+    """Count a download of a resource, if download tracking is enabled
+    """
+    if not toolkit.asbool(toolkit.config.get(DOWNLOAD_TRACKING_CONF_KEY, False)):
+        return
+    get_counter().record(resource_id, package_id)
+
+
+def get_counter():
+    # type: () -> DownloadCounter
+    """Get this process's download counter
+    """
+    global _counter
+    if _counter is None:
+        with _counter_lock:
+            if _counter is None:
+                _counter = DownloadCounter(
+                    flush_interval=toolkit.asint(toolkit.config.get(FLUSH_INTERVAL_CONF_KEY, DEFAULT_FLUSH_INTERVAL)),
+                    flush_threshold=toolkit.asint(toolkit.config.get(FLUSH_THRESHOLD_CONF_KEY,
+                                                                     DEFAULT_FLUSH_THRESHOLD)))
+                atexit.register(_counter.flush)
+    return _counter
@@ -1,4 +1,14 @@
+import json
+from typing import Any, Dict, Optional
+
+from ckan.plugins import toolkit
 from ckan.plugins.toolkit import Invalid
+from six import string_types
+
+EXTERNAL_METADATA_CONF_KEY = 'ckanext.blob_storage.external_metadata'
+EXTERNAL_METADATA_MIN_SIZE_CONF_KEY = 'ckanext.blob_storage.external_metadata.min_size'
+
+DEFAULT_EXTERNAL_METADATA_MIN_SIZE = 4096
 
 
 def upload_has_sha256(key, flattened_data, errors, context):
@@ -31,6 +41,56 @@ def valid_lfs_prefix(value):
     return value
 
 
+def store_large_value_externally(key, flattened_data, errors, context):
+    """Move a large resource field value (e.g. ``schema``) to a side object, keeping a ``<field>_ref`` reference
+
+    Values smaller than the configured minimal size are kept on the resource,
+    in which case any existing reference is removed, as it is if the value is
+    cleared. References are never accepted from clients: If no value is
+    passed, the reference currently stored on the resource is kept, if any.
+    """
+    value = flattened_data.get(key)
+    ref_key = key[0:-1] + ('{}_ref'.format(key[-1]),)
+    if value is None or value is toolkit.missing:
+        stored_ref = _stored_ref(flattened_data, ref_key)
+        if stored_ref:
+            flattened_data[ref_key] = stored_ref
+        else:
+            flattened_data.pop(ref_key, None)
+        return
+    if value == '':
+        flattened_data.pop(ref_key, None)
+        return
+
+    if not isinstance(value, string_types):
+        value = json.dumps(value)
+
+    min_size = toolkit.asint(toolkit.config.get(EXTERNAL_METADATA_MIN_SIZE_CONF_KEY,
+                                                DEFAULT_EXTERNAL_METADATA_MIN_SIZE))
+    if len(value) < min_size:
+        flattened_data.pop(ref_key, None)
+        return
+
+    from . import model
+    flattened_data[ref_key] = model.save_resource_metadata(value)
+    flattened_data.pop(key)
+
+
+def _stored_ref(flattened_data, ref_key):
+    # type: (Dict[tuple, Any], tuple) -> Optional[str]
+    """Get a side object reference stored on the existing resource being validated, if any
+    """
+    resource_id = flattened_data.get(ref_key[0:-1] + ('id',))
+    if not resource_id or resource_id is toolkit.missing:
+        return None
+
+    from ckan.model import Resource
+    resource = Resource.get(resource_id)
+    if resource is None or resource.package_id != flattened_data.get(('id',)):
+        return None
+    return (resource.extras or {}).get(ref_key[-1])
+
+
 def _is_hex_str(value, chars=40):
     # type: (str, int) -> bool
     """Check if a string is a hex-only string of exactly :param:`chars` characters length.
@@ -0,0 +1,334 @@
+"""Streaming ZIP archives of files in blob storage
+
+Archives are generated on the fly, without temporary files or seeking: Files
+are stored without compression, with their CRC-32 written after their data,
+and ZIP64 extensions are used where sizes or offsets require them. As the size
+of each file is known in advance, so is the size of the whole archive.
+
+Files are downloaded by a few threads ahead of the one writing the archive.
+Each of them only buffers a limited number of chunks, so memory use is bounded
+no matter how large files are.
+"""
+import datetime
+import hashlib
+import logging
+import struct
+import threading
+import zlib
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from six import ensure_binary
+from six.moves import queue
+
+CHUNK_SIZE = 1024 * 64
+
+# Number of chunks buffered for each file being downloaded ahead
+PREFETCH_CHUNKS = 16
+
+# Connect and read timeouts, in seconds, for downloading files
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# Sizes, offsets and counts from which ZIP64 extensions are needed
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+# Values of fields whose actual value is in a ZIP64 extension
+_ZIP64_MARKER = 0xFFFFFFFF
+_ZIP64_COUNT_MARKER = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_OF_CENTRAL_DIR = struct.Struct('<IHHHHIIH')
+_END_OF_CENTRAL_DIR64 = struct.Struct('<IQHHIIQQQQ')
+_END_OF_CENTRAL_DIR64_LOCATOR = struct.Struct('<IIQI')
+
+# Data descriptor follows the file data, file name is UTF-8
+_FLAGS = 0x08 | 0x800
+_VERSION = 20
+_VERSION64 = 45
+_CREATED_BY_UNIX = 3 << 8
+_FILE_ATTRIBUTES = 0o100644 << 16
+
+log = logging.getLogger(__name__)
+
+
+class ZipStreamError(Exception):
+    """A file could not be added to the archive
+    """
+
+
+class _Entry(object):
+
+    def __init__(self, name, size, date_time, offset):
+        # type: (str, int, Optional[datetime.datetime], int) -> None
+        self.name = ensure_binary(name, 'utf-8')
+        self.size = size
+        self.offset = offset
+        self.crc = 0
+        self.dos_time, self.dos_date = _dos_date_time(date_time)
+
+    @property
+    def zip64(self):
+        # type: () -> bool
+        return self.size >= ZIP64_LIMIT
+
+    def local_header(self):
+        # type: () -> bytes
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            size = _ZIP64_MARKER
+        else:
+            extra = b''
+            size = 0
+        return _LOCAL_HEADER.pack(0x04034b50, _VERSION64 if self.zip64 else _VERSION, _FLAGS, 0,
+                                  self.dos_time, self.dos_date, 0, size, size,
+                                  len(self.name), len(extra)) + self.name + extra
+
+    def data_descriptor(self):
+        # type: () -> bytes
+        if self.zip64:
+            return _DATA_DESCRIPTOR64.pack(0x08074b50, self.crc, self.size, self.size)
+        return _DATA_DESCRIPTOR.pack(0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self):
+        # type: () -> bytes
+        fields = []
+        size = self.size
+        offset = self.offset
+        if self.zip64:
+            fields += [self.size, self.size]
+            size = _ZIP64_MARKER
+        if self.offset >= ZIP64_LIMIT:
+            fields.append(self.offset)
+            offset = _ZIP64_MARKER
+        extra = struct.pack('<HH{}Q'.format(len(fields)), 1, 8 * len(fields), *fields) if fields else b''
+        version = _VERSION64 if fields else _VERSION
+        return _CENTRAL_HEADER.pack(0x02014b50, _CREATED_BY_UNIX | version, version, _FLAGS, 0,
+                                    self.dos_time, self.dos_date, self.crc, size, size,
+                                    len(self.name), len(extra), 0, 0, 0, _FILE_ATTRIBUTES, offset) + self.name + extra
+
+    def total_size(self):
+        # type: () -> int
+        return len(self.local_header()) + self.size + len(self.data_descriptor())
+
+
+class ZipStream(object):
+    """Write a ZIP archive as a stream of byte strings
+
+    Call :meth:`write_file` for each file, and then :meth:`finish`, consuming
+    the byte strings they yield in order.
+    """
+
+    def __init__(self):
+        self._entries = []  # type: List[_Entry]
+        self._offset = 0
+
+    def write_file(self, name, size, chunks, date_time=None):
+        # type: (str, int, Iterable[bytes], Optional[datetime.datetime]) -> Iterator[bytes]
+        """Write a file, whose data is given as chunks adding up to exactly ``size`` bytes
+        """
+        entry = _Entry(name, size, date_time, self._offset)
+        yield entry.local_header()
+
+        crc = 0
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            if written > size:
+                raise ZipStreamError("{} is larger than expected".format(name))
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+        if written != size:
+            raise ZipStreamError("{} is smaller than expected".format(name))
+
+        entry.crc = crc & 0xFFFFFFFF
+        yield entry.data_descriptor()
+        self._add(entry)
+
+    def finish(self):
+        # type: () -> Iterator[bytes]
+        """Write the central directory, ending the archive
+        """
+        yield self._central_directory()
+
+    def _add(self, entry):
+        # type: (_Entry) -> None
+        self._entries.append(entry)
+        self._offset += entry.total_size()
+
+    def _central_directory(self):
+        # type: () -> bytes
+        directory = b''.join(entry.central_header() for entry in self._entries)
+        count = len(self._entries)
+        if count < ZIP64_COUNT_LIMIT and len(directory) < ZIP64_LIMIT and self._offset < ZIP64_LIMIT:
+            return directory + _END_OF_CENTRAL_DIR.pack(0x06054b50, 0, 0, count, count, len(directory),
+                                                        self._offset, 0)
+
+        end = _END_OF_CENTRAL_DIR64.pack(0x06064b50, _END_OF_CENTRAL_DIR64.size - 12,
+                                         _CREATED_BY_UNIX | _VERSION64, _VERSION64, 0, 0,
+                                         count, count, len(directory), self._offset)
+        end += _END_OF_CENTRAL_DIR64_LOCATOR.pack(0x07064b50, 0, self._offset + len(directory), 1)
+        end += _END_OF_CENTRAL_DIR.pack(0x06054b50, 0, 0, _ZIP64_COUNT_MARKER, _ZIP64_COUNT_MARKER,
+                                        _ZIP64_MARKER, _ZIP64_MARKER, 0)
+        return directory + end
+
+
+def archive_size(files):
+    # type: (Iterable[Tuple[str, int]]) -> int
+    """Get the size of the archive :class:`ZipStream` writes for files, given as ``(name, size)``
+
+    >>> archive_size([('data.csv', 12)])
+    142
+    """
+    stream = ZipStream()
+    for name, size in files:
+        stream._add(_Entry(name, size, None, stream._offset))
+    return stream._offset + len(stream._central_directory())
+
+
+def stream_zip(files, fetch, workers=4):
+    # type: (List[Dict[str, Any]], Callable[[Dict[str, Any]], Iterable[bytes]], int) -> Iterator[bytes]
+    """Stream a ZIP archive of files, each downloaded by ``fetch(file)``
+
+    Each file must have a ``name`` and a ``size``, and may have a
+    ``date_time``. Up to ``workers`` files are downloaded at the same time.
+    """
+    stream = ZipStream()
+    for f, chunks in fetch_ahead(files, fetch, workers):
+        for data in stream.write_file(f['name'], f['size'], chunks, f.get('date_time')):
+            yield data
+    for data in stream.finish():
+        yield data
+
+
+def fetch_ahead(items, fetch, workers):
+    # type: (Iterable[Any], Callable[[Any], Iterable[bytes]], int) -> Iterator[Tuple[Any, Iterator[bytes]]]
+    """Get the chunks of each item in order, while fetching the next ones in the background
+
+    Each item is fetched in a thread, up to ``workers`` at a time. If the
+    caller stops early, fetching is cancelled.
+    """
+    items = iter(items)
+    window = deque()  # type: deque
+    current = None
+    try:
+        while True:
+            while len(window) < workers:
+                item = next(items, _Prefetch._DONE)
+                if item is _Prefetch._DONE:
+                    break
+                window.append((item, _Prefetch(fetch, item)))
+            if not window:
+                return
+            item, current = window.popleft()
+            yield item, current.chunks()
+            current.cancel()
+    finally:
+        if current is not None:
+            current.cancel()
+        for _, prefetch in window:
+            prefetch.cancel()
+
+
+class _Prefetch(object):
+    """Fetch an item's chunks in a thread, buffering up to :data:`PREFETCH_CHUNKS` of them
+    """
+
+    _DONE = object()
+
+    def __init__(self, fetch, item):
+        # type: (Callable[[Any], Iterable[bytes]], Any) -> None
+        self._queue = queue.Queue(maxsize=PREFETCH_CHUNKS)  # type: queue.Queue
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(fetch, item), name='blob-storage-zip-fetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def chunks(self):
+        # type: () -> Iterator[bytes]
+        while True:
+            value = self._queue.get()
+            if value is self._DONE:
+                return
+            elif isinstance(value, Exception):
+                raise value
+            yield value
+
+    def cancel(self):
+        # type: () -> None
+        self._cancelled.set()
+
+    def _run(self, fetch, item):
+        chunks = None
+        try:
+            chunks = iter(fetch(item))
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+            self._put(self._DONE)
+        except Exception as e:
+            log.warning("Failed fetching file to stream: %s", e)
+            self._put(e)
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def _put(self, value):
+        # type: (Any) -> bool
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(value, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def download_chunks(action, sha256, size):
+    # type: (Dict[str, Any], str, int) -> Iterator[bytes]
+    """Download an object from a download action, checking its size and SHA256 digest
+
+    If the object does not match, :exc:`ZipStreamError` is raised before its
+    last chunk is returned.
+    """
+    import requests
+    digest = hashlib.sha256()
+    written = 0
+    with requests.get(action['href'], headers=action.get('header', {}), stream=True,
+                      timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        previous = None
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            written += len(chunk)
+            if written > size:
+                raise ZipStreamError("Object {} is larger than expected".format(sha256))
+            digest.update(chunk)
+            if previous is not None:
+                yield previous
+            previous = chunk
+
+    if written != size or digest.hexdigest() != sha256:
+        raise ZipStreamError("Object {} does not match its size or SHA256 digest".format(sha256))
+    if previous is not None:
+        yield previous
+
+
+def _dos_date_time(date_time):
+    # type: (Optional[datetime.datetime]) -> Tuple[int, int]
+    """Get the MS-DOS time and date of a timestamp, as used in ZIP archives
+
+    >>> _dos_date_time(datetime.datetime(2021, 1, 15, 10, 20, 30))
+    (21135, 21039)
+    >>> _dos_date_time(datetime.datetime(1970, 1, 1))
+    (0, 33)
+    """
+    if date_time is None:
+        date_time = datetime.datetime.utcnow()
+    if date_time.year < 1980:
+        date_time = datetime.datetime(1980, 1, 1)
+    return ((date_time.hour << 11) | (date_time.minute << 5) | (date_time.second // 2),
+            ((date_time.year - 1980) << 9) | (date_time.month << 5) | date_time.day)
@@ -83,12 +83,16 @@ setup(
     entry_points='''
         [ckan.plugins]
         blob_storage=ckanext.blob_storage.plugin:BlobStoragePlugin 
+        blob_storage_prometheus=ckanext.blob_storage.plugin:BlobStoragePrometheusPlugin
 
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
         
         [paste.paster_command]
+        blob-storage = ckanext.blob_storage.cli:BlobStorageCommand
         migrate-resources = ckanext.blob_storage.cli:MigrateResourcesCommand
+        export-resources = ckanext.blob_storage.cli:ExportResourcesCommand
+        infer-resource-metadata = ckanext.blob_storage.cli:InferResourceMetadataCommand
     ''',
 
     # If you are changing from the default layout of your extension, you may